@@ -0,0 +1,133 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+"""Document contents the server and runners share by hash, sending only changes."""
+
+import collections
+import hashlib
+import threading
+from typing import Any, Dict, Optional
+
+DOCUMENT_CACHE_SIZE = 64
+
+
+class DocumentCacheMiss(Exception):
+    """Runner does not have the document contents a request refers to."""
+
+
+def get_source_hash(source: str) -> str:
+    """Returns the content hash used to identify document contents."""
+    return hashlib.blake2b(source.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _common_prefix_length(old: str, new: str) -> int:
+    # Binary search with slice comparisons keeps the scanning in C.
+    low, high = 0, min(len(old), len(new))
+    while low < high:
+        mid = (low + high + 1) // 2
+        if old[low:mid] == new[low:mid]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+def _common_suffix_length(old: str, new: str, limit: int) -> int:
+    low, high = 0, limit
+    while low < high:
+        mid = (low + high + 1) // 2
+        if old[len(old) - mid : len(old) - low] == new[len(new) - mid : len(new) - low]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+def get_text_delta(old: str, new: str) -> Dict[str, Any]:
+    """Returns a single replacement that turns `old` into `new`."""
+    start = _common_prefix_length(old, new)
+    suffix = _common_suffix_length(old, new, min(len(old), len(new)) - start)
+    return {
+        "start": start,
+        "end": len(old) - suffix,
+        "text": new[start : len(new) - suffix],
+    }
+
+
+class DocumentSync:
+    """Tracks the document contents a runner holds, to avoid resending them.
+
+    For each URI, the server remembers the last contents it sent. A request
+    then carries only the content hash when nothing changed, or a delta
+    against the previous contents otherwise.
+    """
+
+    def __init__(self, capacity: int = DOCUMENT_CACHE_SIZE):
+        self._capacity = capacity
+        self._documents: collections.OrderedDict = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def encode(self, uri: str, source: str) -> Dict[str, Any]:
+        """Returns the message fields that transfer `source` to the runner."""
+        source_hash = get_source_hash(source)
+        with self._lock:
+            known = self._documents.pop(uri, None)
+            self._documents[uri] = (source_hash, source)
+            while len(self._documents) > self._capacity:
+                self._documents.popitem(last=False)
+
+        fields = {"uri": uri, "sourceHash": source_hash}
+        if known is None:
+            fields["source"] = source
+        elif known[0] != source_hash:
+            fields["delta"] = {"base": known[0], **get_text_delta(known[1], source)}
+        return fields
+
+    def forget(self, uri: str) -> None:
+        """Drops what is known about a document, so it is sent in full next time."""
+        with self._lock:
+            self._documents.pop(uri, None)
+
+
+# pylint: disable-next=too-few-public-methods
+class DocumentCache:
+    """LRU of document contents kept by the runner, keyed by URI."""
+
+    def __init__(self, capacity: int = DOCUMENT_CACHE_SIZE):
+        self._capacity = capacity
+        self._documents: collections.OrderedDict = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def resolve(self, msg: Dict[str, Any]) -> Optional[str]:
+        """Returns the source for a `run` message, using cached contents as needed.
+
+        Raises `DocumentCacheMiss` if the message refers to contents that are
+        not in the cache.
+        """
+        uri = msg.get("uri")
+        if uri is None:
+            return msg.get("source")
+        with self._lock:
+            return self._resolve(uri, msg)
+
+    def _resolve(self, uri: str, msg: Dict[str, Any]) -> str:
+        source_hash = msg["sourceHash"]
+        if "source" in msg:
+            source = msg["source"]
+        else:
+            known = self._documents.pop(uri, None)
+            delta = msg.get("delta")
+            if delta is not None and known is not None and known[0] == delta["base"]:
+                base = known[1]
+                source = base[: delta["start"]] + delta["text"] + base[delta["end"] :]
+                if get_source_hash(source) != source_hash:
+                    raise DocumentCacheMiss(uri)
+            elif delta is None and known is not None and known[0] == source_hash:
+                source = known[1]
+            else:
+                raise DocumentCacheMiss(uri)
+
+        self._documents.pop(uri, None)
+        self._documents[uri] = (source_hash, source)
+        while len(self._documents) > self._capacity:
+            self._documents.popitem(last=False)
+        return source
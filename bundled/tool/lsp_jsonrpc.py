@@ -5,19 +5,191 @@
 
 import atexit
 import contextlib
-import io
+import functools
+import hashlib
+import importlib
+import itertools
 import json
+import mmap
+import os
 import pathlib
+import socket
+import stat
+import struct
 import subprocess
+import tempfile
 import threading
-import uuid
-from concurrent.futures import ThreadPoolExecutor
-from typing import BinaryIO, Dict, Optional, Sequence, Union
+import time
+from concurrent.futures import Future
+from typing import Any, BinaryIO, Callable, Dict, Optional, Sequence
 
 CONTENT_LENGTH = "Content-Length: "
+_CONTENT_LENGTH_BYTES = CONTENT_LENGTH.encode("ascii")
+_INITIAL_BUFFER_SIZE = 64 * 1024
+_MAX_RETAINED_BUFFER_SIZE = 4 * 1024 * 1024
 RUNNER_SCRIPT = str(pathlib.Path(__file__).parent / "lsp_runner.py")
 
 
+HANDSHAKE_TIMEOUT = 30  # seconds
+
+
+def _json_dumps(data: Any) -> bytes:
+    return json.dumps(data).encode("utf-8")
+
+
+def _json_loads(body: memoryview) -> Any:
+    return json.loads(str(body, "utf-8"))
+
+
+# pylint: disable-next=too-few-public-methods
+class Codec:
+    """Serializer used for message bodies on a JSON-RPC connection."""
+
+    def __init__(
+        self,
+        name: str,
+        dumps: Callable[[Any], bytes],
+        loads: Callable[[memoryview], Any],
+    ):
+        self.name: str = name
+        self.dumps: Callable[[Any], bytes] = dumps
+        self.loads: Callable[[memoryview], Any] = loads
+
+
+JSON_CODEC = Codec("json", _json_dumps, _json_loads)
+
+# Codecs importable in this environment, fastest first. Both ends of a
+# connection start with stdlib json and switch to the fastest one they share
+# during the `initialize` handshake.
+CODECS: Dict[str, Codec] = {}
+
+try:
+    # pylint: disable-next=import-error
+    import msgpack
+
+    CODECS["msgpack"] = Codec(
+        "msgpack",
+        functools.partial(msgpack.packb, use_bin_type=True),
+        functools.partial(msgpack.unpackb, raw=False),
+    )
+except ImportError:
+    pass
+
+try:
+    # pylint: disable-next=import-error
+    import orjson
+
+    # pylint: disable-next=no-member
+    CODECS["orjson"] = Codec("orjson", orjson.dumps, orjson.loads)
+except ImportError:
+    pass
+
+CODECS[JSON_CODEC.name] = JSON_CODEC
+
+
+def select_codec(preferred: Sequence[str]) -> Codec:
+    """Returns the first codec from `preferred` available here, falling back to json."""
+    for name in preferred:
+        if name in CODECS:
+            return CODECS[name]
+    return JSON_CODEC
+
+
+# Message bodies at least this large are passed through a shared memory segment
+# instead of the pipe, when both ends support it. Only the segment name, offset
+# and length go through the pipe. Segment names start with the pid of the
+# process that wrote them, so the segments of a process that is gone can be
+# found and removed.
+SHARED_MEMORY_THRESHOLD = 512 * 1024
+SHARED_MEMORY_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+_SHARED_MEMORY_KEY = "sharedMemory"
+_SEGMENT_PREFIX = "lsp-rpc-"
+_segment_ids = itertools.count(1)
+
+
+def _write_segment(body: bytes) -> Dict[str, Any]:
+    """Copies `body` into a new shared memory segment and returns its reference."""
+    name = f"{_SEGMENT_PREFIX}{os.getpid()}-{next(_segment_ids)}"
+    path = os.path.join(SHARED_MEMORY_DIR, name)
+    fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o600)
+    try:
+        os.ftruncate(fd, len(body))
+        with mmap.mmap(fd, len(body)) as segment:
+            segment[:] = body
+    except Exception:
+        with contextlib.suppress(OSError):
+            os.unlink(path)
+        raise
+    finally:
+        os.close(fd)
+    return {"name": name, "offset": 0, "length": len(body)}
+
+
+def _read_segment(reference: Dict[str, Any], loads: Callable[[memoryview], Any]) -> Any:
+    """Decodes a message body from a shared memory segment and removes the segment."""
+    name = reference["name"]
+    if not name.startswith(_SEGMENT_PREFIX) or os.path.basename(name) != name:
+        raise ValueError(f"Invalid shared memory segment: {name}")
+    path = os.path.join(SHARED_MEMORY_DIR, name)
+    offset = reference["offset"]
+    try:
+        with open(path, "rb") as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as segment:
+                with memoryview(segment) as view:
+                    with view[offset : offset + reference["length"]] as body:
+                        return loads(body)
+    finally:
+        with contextlib.suppress(OSError):
+            os.unlink(path)
+
+
+def _get_segment_pid(name: str) -> Optional[int]:
+    if not name.startswith(_SEGMENT_PREFIX):
+        return None
+    pid = name[len(_SEGMENT_PREFIX) :].partition("-")[0]
+    return int(pid) if pid.isdigit() else None
+
+
+def pid_exists(pid: int) -> bool:
+    """Returns True while a process with the given id is running."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # Exists, but belongs to someone else.
+        return True
+    return True
+
+
+def remove_segments(pid: Optional[int] = None) -> None:
+    """Removes the shared memory segments written by process `pid`.
+
+    Without `pid`, removes those of processes that are no longer running,
+    which were left behind when the reader went away before reading them.
+    """
+    if SHARED_MEMORY_DIR is None:
+        return
+    try:
+        names = os.listdir(SHARED_MEMORY_DIR)
+    except OSError:
+        return
+    for name in names:
+        owner = _get_segment_pid(name)
+        if owner is None:
+            continue
+        if pid is None:
+            if owner == os.getpid() or pid_exists(owner):
+                continue
+        elif owner != pid:
+            continue
+        with contextlib.suppress(OSError):
+            os.unlink(os.path.join(SHARED_MEMORY_DIR, name))
+
+
+atexit.register(lambda: remove_segments(os.getpid()))
+
+
 def to_str(text) -> str:
     """Convert bytes to string as needed."""
     return text.decode("utf-8") if isinstance(text, bytes) else text
@@ -32,35 +204,77 @@ class StreamClosedException(Exception):
 class JsonWriter:
     """Manages writing JSON-RPC messages to the writer stream."""
 
-    def __init__(self, writer: io.TextIOWrapper):
+    def __init__(self, writer: BinaryIO):
         self._writer = writer
         self._lock = threading.Lock()
+        self._codec = JSON_CODEC
+        self._shared_memory = False
+        # Paths of the segments written on this stream, which the reader
+        # removes once it read them.
+        self._segments: set = set()
+
+    def set_codec(self, codec: Codec):
+        """Sets the codec used for messages written after this call."""
+        self._codec = codec
+
+    def enable_shared_memory(self):
+        """Sends large message bodies through shared memory from now on."""
+        self._shared_memory = SHARED_MEMORY_DIR is not None
 
     def close(self):
         """Closes the underlying writer stream."""
         with self._lock:
             if not self._writer.closed:
                 self._writer.close()
+        self.remove_segments()
+
+    def remove_segments(self):
+        """Removes the segments written on this stream that were not read."""
+        with self._lock:
+            segments = self._segments
+            self._segments = set()
+        for path in segments:
+            with contextlib.suppress(OSError):
+                os.unlink(path)
+
+    def _track_segment(self, name: str):
+        with self._lock:
+            self._segments.add(os.path.join(SHARED_MEMORY_DIR, name))
+            if len(self._segments) > 256:
+                # Forget the ones the reader already removed.
+                self._segments = {p for p in self._segments if os.path.exists(p)}
 
     def write(self, data):
         """Writes given data to stream in JSON-RPC format."""
         if self._writer.closed:
             raise StreamClosedException()
 
+        # Encode the payload once, outside the lock, and write the header and
+        # body as bytes so the body is never copied into a combined string.
+        body = self._codec.dumps(data)
+        if self._shared_memory and len(body) >= SHARED_MEMORY_THRESHOLD:
+            with contextlib.suppress(OSError):
+                reference = _write_segment(body)
+                self._track_segment(reference["name"])
+                body = self._codec.dumps({_SHARED_MEMORY_KEY: reference})
+        header = b"%s%d\r\n\r\n" % (_CONTENT_LENGTH_BYTES, len(body))
         with self._lock:
-            content = json.dumps(data)
-            length = len(content.encode("utf-8"))
-            self._writer.write(
-                f"{CONTENT_LENGTH}{length}\r\n\r\n{content}".encode("utf-8")
-            )
+            self._writer.write(header)
+            self._writer.write(body)
             self._writer.flush()
 
 
 class JsonReader:
     """Manages reading JSON-RPC messages from stream."""
 
-    def __init__(self, reader: io.TextIOWrapper):
+    def __init__(self, reader: BinaryIO):
         self._reader = reader
+        self._buffer = bytearray(_INITIAL_BUFFER_SIZE)
+        self._codec = JSON_CODEC
+
+    def set_codec(self, codec: Codec):
+        """Sets the codec used to decode message bodies read after this call."""
+        self._codec = codec
 
     def close(self):
         """Closes the underlying reader stream."""
@@ -71,39 +285,110 @@ class JsonReader:
         """Reads data from the stream in JSON-RPC format."""
         if self._reader.closed:
             raise StreamClosedException
+        length = self._read_headers()
+        with self._read_body(length) as body:
+            data = self._codec.loads(body)
+        if isinstance(data, dict) and len(data) == 1 and _SHARED_MEMORY_KEY in data:
+            return _read_segment(data[_SHARED_MEMORY_KEY], self._codec.loads)
+        return data
+
+    def _read_headers(self) -> int:
         length = None
         while not length:
-            line = to_str(self._readline())
-            if line.startswith(CONTENT_LENGTH):
-                length = int(line[len(CONTENT_LENGTH) :])
-
-        line = to_str(self._readline()).strip()
-        while line:
-            line = to_str(self._readline()).strip()
-
-        content = to_str(self._reader.read(length))
-        return json.loads(content)
-
-    def _readline(self):
+            line = self._readline()
+            if line.startswith(_CONTENT_LENGTH_BYTES):
+                length = int(line[len(_CONTENT_LENGTH_BYTES) :])
+
+        while self._readline().strip():
+            pass
+        return length
+
+    def _read_body(self, length: int) -> memoryview:
+        """Reads the message body directly into a reusable buffer."""
+        if length > _MAX_RETAINED_BUFFER_SIZE:
+            # Do not hold on to very large buffers between messages.
+            buffer = bytearray(length)
+        else:
+            if len(self._buffer) < length:
+                self._buffer = bytearray(
+                    min(max(length, 2 * len(self._buffer)), _MAX_RETAINED_BUFFER_SIZE)
+                )
+            buffer = self._buffer
+
+        view = memoryview(buffer)[:length]
+        received = 0
+        while received < length:
+            count = self._reader.readinto(view[received:])
+            if not count:
+                view.release()
+                raise EOFError
+            received += count
+        return view
+
+    def _readline(self) -> bytes:
         line = self._reader.readline()
         if not line:
             raise EOFError
         return line
 
 
+# pylint: disable-next=too-many-instance-attributes
 class JsonRpc:
     """Manages sending and receiving data over JSON-RPC."""
 
-    def __init__(self, reader: io.TextIOWrapper, writer: io.TextIOWrapper):
+    def __init__(
+        self,
+        reader: BinaryIO,
+        writer: BinaryIO,
+        on_close: Optional[Callable[[], None]] = None,
+    ):
         self._reader = JsonReader(reader)
         self._writer = JsonWriter(writer)
+        self._on_close = on_close
+        self._ids = itertools.count(1)
+        self._pending: Dict[int, Future] = {}
+        self._partial_handlers: Dict[int, Callable[[Any], None]] = {}
+        self._lock = threading.Lock()
+        self._listener: Optional[threading.Thread] = None
+        self._closed = False
+        # What the runner reported about itself when the connection was set up.
+        self.peer: Dict[str, Any] = {}
 
     def close(self):
         """Closes the underlying streams."""
-        with contextlib.suppress(Exception):
-            self._reader.close()
+        with self._lock:
+            self._closed = True
+            listening = self._listener is not None and self._listener.is_alive()
+        if self._on_close is not None:
+            with contextlib.suppress(Exception):
+                self._on_close()
         with contextlib.suppress(Exception):
             self._writer.close()
+        if not listening:
+            # Closing a buffered stream blocks while another thread is reading
+            # from it, so the reader thread closes it when it sees end of stream.
+            with contextlib.suppress(Exception):
+                self._reader.close()
+        self._fail_pending()
+
+    @property
+    def closed(self) -> bool:
+        """True once the connection is closed or its peer went away."""
+        with self._lock:
+            return self._closed
+
+    def set_codec(self, codec: Codec):
+        """Switches both directions of this connection to the given codec."""
+        self._writer.set_codec(codec)
+        self._reader.set_codec(codec)
+
+    def enable_shared_memory(self):
+        """Sends large messages on this connection through shared memory."""
+        self._writer.enable_shared_memory()
+
+    def next_id(self) -> int:
+        """Returns a new message id, unique for this connection."""
+        return next(self._ids)
 
     def send_data(self, data):
         """Send given data in JSON-RPC format."""
@@ -113,142 +398,302 @@ class JsonRpc:
         """Receive data in JSON-RPC format."""
         return self._reader.read()
 
+    def send_request(
+        self,
+        data: Dict[str, Any],
+        on_partial: Optional[Callable[[Any], None]] = None,
+    ) -> Future:
+        """Sends a request and returns a future for its response.
+
+        Responses are read on a dedicated thread and routed to the future
+        with the matching id, so any number of requests can be in flight.
+        Messages carrying a `partialResult` for the request are passed to
+        `on_partial`, on the reader thread, before the future resolves.
+        Do not mix this with `receive_data` on the same connection.
+        """
+        msg_id = self.next_id()
+        data["id"] = msg_id
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise StreamClosedException()
+            self._pending[msg_id] = future
+            if on_partial is not None:
+                self._partial_handlers[msg_id] = on_partial
+            if self._listener is None:
+                self._listener = threading.Thread(
+                    target=self._listen, name="json-rpc-reader", daemon=True
+                )
+                self._listener.start()
+
+        try:
+            self._writer.write(data)
+        except Exception:
+            with self._lock:
+                self._pending.pop(msg_id, None)
+                self._partial_handlers.pop(msg_id, None)
+            raise
+        return future
 
-def create_json_rpc(readable: BinaryIO, writable: BinaryIO) -> JsonRpc:
-    """Creates JSON-RPC wrapper for the readable and writable streams."""
-    return JsonRpc(readable, writable)
+    def pending_count(self) -> int:
+        """Returns the number of requests waiting for a response."""
+        with self._lock:
+            return len(self._pending)
+
+    def _listen(self):
+        while True:
+            try:
+                data = self._reader.read()
+            except Exception:  # pylint: disable=broad-except
+                break
+
+            msg_id = data.get("id")
+            if "partialResult" in data:
+                with self._lock:
+                    handler = self._partial_handlers.get(msg_id)
+                if handler is not None:
+                    # A failing handler must not take down the connection.
+                    with contextlib.suppress(Exception):
+                        handler(data["partialResult"])
+                continue
 
+            with self._lock:
+                # Responses for unknown or abandoned ids are dropped.
+                future = self._pending.pop(msg_id, None)
+                self._partial_handlers.pop(msg_id, None)
+            if future is not None and future.set_running_or_notify_cancel():
+                future.set_result(data)
+        with contextlib.suppress(Exception):
+            self._reader.close()
+        # The peer went away, nothing reads what was sent to it anymore.
+        self._writer.remove_segments()
+        self._fail_pending()
 
-class ProcessManager:
-    """Manages sub-processes launched for running tools."""
+    def _fail_pending(self):
+        with self._lock:
+            self._closed = True
+            pending = list(self._pending.values())
+            self._pending.clear()
+            self._partial_handlers.clear()
+        for future in pending:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(StreamClosedException())
 
-    def __init__(self):
-        self._args: Dict[str, Sequence[str]] = {}
-        self._processes: Dict[str, subprocess.Popen] = {}
-        self._rpc: Dict[str, JsonRpc] = {}
-        self._lock = threading.Lock()
-        self._thread_pool = ThreadPoolExecutor(10)
 
-    def stop_all_processes(self):
-        """Send exit command to all processes and shutdown transport."""
-        for i in self._rpc.values():
-            with contextlib.suppress(Exception):
-                i.send_data({"id": str(uuid.uuid4()), "method": "exit"})
-        self._thread_pool.shutdown(wait=False)
-
-    def start_process(self, workspace: str, args: Sequence[str], cwd: str) -> None:
-        """Starts a process and establishes JSON-RPC communication over stdio."""
-        # pylint: disable=consider-using-with
-        proc = subprocess.Popen(
-            args,
-            cwd=cwd,
-            stdout=subprocess.PIPE,
-            stdin=subprocess.PIPE,
-        )
-        self._processes[workspace] = proc
-        self._rpc[workspace] = create_json_rpc(proc.stdout, proc.stdin)
-
-        def _monitor_process():
-            proc.wait()
-            with self._lock:
-                try:
-                    del self._processes[workspace]
-                    rpc = self._rpc.pop(workspace)
-                    rpc.close()
-                except:  # pylint: disable=bare-except
-                    pass
+def create_json_rpc(readable: BinaryIO, writable: BinaryIO) -> JsonRpc:
+    """Creates JSON-RPC wrapper for the readable and writable streams."""
+    return JsonRpc(readable, writable)
 
-        self._thread_pool.submit(_monitor_process)
 
-    def get_json_rpc(self, workspace: str) -> JsonRpc:
-        """Gets the JSON-RPC wrapper for the a given id."""
-        with self._lock:
-            if workspace in self._rpc:
-                return self._rpc[workspace]
-        raise StreamClosedException()
+def connect_socket_json_rpc(sock: socket.socket) -> JsonRpc:
+    """Creates JSON-RPC wrapper for a connected socket."""
+
+    def _shutdown():
+        # Unblocks a thread reading from the socket, and tells the peer.
+        with contextlib.suppress(OSError):
+            sock.shutdown(socket.SHUT_RDWR)
+
+    rpc = JsonRpc(sock.makefile("rb"), sock.makefile("wb"), on_close=_shutdown)
+    # The stream objects keep the socket open until both are closed.
+    sock.close()
+    return rpc
+
+
+# Set LS_RUNNER_TRANSPORT to "socket" to reach runners over Unix domain sockets
+# instead of stdio. Socket runners are shared by every server that uses the same
+# interpreter, outlive server restarts, and exit after a while without
+# connections. Set LS_RUNNER_SOCKET to use a runner listening on a given path,
+# for example one started by hand with `lsp_runner.py --listen <path>`.
+RUNNER_TRANSPORT = os.getenv("LS_RUNNER_TRANSPORT", "stdio")
+RUNNER_SOCKET = os.getenv("LS_RUNNER_SOCKET")
+RUNNER_CONNECTIONS = int(os.getenv("LS_RUNNER_CONNECTIONS", "4"))
+
+
+def use_socket_transport() -> bool:
+    """Returns True if runners should be reached over Unix domain sockets."""
+    return bool(RUNNER_TRANSPORT == "socket" or RUNNER_SOCKET) and hasattr(
+        socket, "AF_UNIX"
+    )
+
+
+def get_runner_socket_dir() -> str:
+    """Returns the directory for runner sockets, usable by the current user only.
+
+    This is a directory under `$XDG_RUNTIME_DIR` if that is set, or one named
+    after the user id in the temporary directory. Raises PermissionError if it
+    exists but other users could reach or replace the sockets in it.
+    """
+    runtime_dir = os.getenv("XDG_RUNTIME_DIR")
+    if runtime_dir and os.path.isdir(runtime_dir):
+        path = os.path.join(runtime_dir, "lsp-runner")
+    else:
+        path = os.path.join(tempfile.gettempdir(), f"lsp-runner-{os.getuid()}")
+    with contextlib.suppress(FileExistsError):
+        os.mkdir(path, 0o700)
+    info = os.lstat(path)
+    if (
+        not stat.S_ISDIR(info.st_mode)
+        or info.st_uid != os.getuid()
+        or info.st_mode & 0o077
+    ):
+        raise PermissionError(f"{path} is not a private directory of the current user.")
+    return path
+
+
+def get_runner_socket_path(args: Sequence[str], index: int = 0) -> str:
+    """Returns the socket path for the `index`th runner started with `args`."""
+    if RUNNER_SOCKET:
+        return RUNNER_SOCKET
+    key = "\0".join([*args, os.getenv("LS_IMPORT_STRATEGY", "useBundled")])
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).hexdigest()
+    suffix = f"-{index}" if index else ""
+    return os.path.join(get_runner_socket_dir(), f"{digest}{suffix}.sock")
+
+
+def check_socket_peer(sock: socket.socket) -> None:
+    """Raises PermissionError if the other end of `sock` runs as another user.
+
+    Only checked on platforms that report it, elsewhere the private socket
+    directory keeps other users out.
+    """
+    if not hasattr(socket, "SO_PEERCRED"):
+        return
+    credentials = sock.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+    )
+    _pid, uid, _gid = struct.unpack("3i", credentials)
+    if uid != os.getuid():
+        raise PermissionError(f"Socket peer runs as user {uid}, not {os.getuid()}.")
+
+
+def _connect_runner(path: str) -> JsonRpc:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        # Do not send source code to whatever another user left listening here.
+        check_socket_peer(sock)
+    except OSError:
+        sock.close()
+        raise
+    rpc = connect_socket_json_rpc(sock)
+    try:
+        negotiate_codec(rpc)
+    except Exception:
+        rpc.close()
+        raise
+    return rpc
 
 
-_process_manager = ProcessManager()
-atexit.register(_process_manager.stop_all_processes)
+class ConnectionPool:
+    """Pool of JSON-RPC connections to one runner listening on a socket.
 
+    Requests go to the least busy connection. A new connection is opened when
+    all of them are busy, up to `size` connections.
+    """
 
-def _get_json_rpc(workspace: str) -> Union[JsonRpc, None]:
-    try:
-        return _process_manager.get_json_rpc(workspace)
-    except StreamClosedException:
-        return None
-    except KeyError:
-        return None
+    def __init__(self, path: str, size: int = RUNNER_CONNECTIONS):
+        self.path = path
+        self.peer: Dict[str, Any] = {}
+        self._size = max(size, 1)
+        self._connections: list = []
+        self._lock = threading.Lock()
 
+    def acquire(self) -> JsonRpc:
+        """Returns a connection to send a request on."""
+        with self._lock:
+            self._connections = [c for c in self._connections if not c.closed]
+            best = min(self._connections, key=JsonRpc.pending_count, default=None)
+            if best is not None and (
+                best.pending_count() == 0 or len(self._connections) >= self._size
+            ):
+                return best
+
+        rpc = _connect_runner(self.path)
+        with self._lock:
+            self._connections.append(rpc)
+            self.peer = rpc.peer
+        return rpc
 
-def get_or_start_json_rpc(
-    workspace: str, interpreter: Sequence[str], cwd: str
-) -> Union[JsonRpc, None]:
-    """Gets an existing JSON-RPC connection or starts one and return it."""
-    res = _get_json_rpc(workspace)
-    if not res:
-        args = [*interpreter, RUNNER_SCRIPT]
-        _process_manager.start_process(workspace, args, cwd)
-        res = _get_json_rpc(workspace)
-    return res
-
-
-class RpcRunResult:
-    """Object to hold result from running tool over RPC."""
-
-    def __init__(self, stdout: str, stderr: str, exception: Optional[str] = None):
-        self.stdout: str = stdout
-        self.stderr: str = stderr
-        self.exception: Optional[str] = exception
-
-
-# pylint: disable=too-many-arguments
-def run_over_json_rpc(
-    workspace: str,
-    interpreter: Sequence[str],
-    module: str,
-    argv: Sequence[str],
-    use_stdin: bool,
-    cwd: str,
-    source: str = None,
-) -> RpcRunResult:
-    """Uses JSON-RPC to execute a command."""
-    rpc: Union[JsonRpc, None] = get_or_start_json_rpc(workspace, interpreter, cwd)
-    if not rpc:
-        raise Exception("Failed to run over JSON-RPC.")
-
-    msg_id = str(uuid.uuid4())
-    msg = {
-        "id": msg_id,
-        "method": "run",
-        "module": module,
-        "argv": argv,
-        "useStdin": use_stdin,
-        "cwd": cwd,
-    }
-    if source:
-        msg["source"] = source
-
-    rpc.send_data(msg)
-
-    data = rpc.receive_data()
-
-    if data["id"] != msg_id:
-        return RpcRunResult(
-            "", f"Invalid result for request: {json.dumps(msg, indent=4)}"
-        )
-
-    result = data["result"] if "result" in data else ""
-    if "error" in data:
-        error = data["error"]
-
-        if data.get("exception", False):
-            return RpcRunResult(result, "", error)
-        return RpcRunResult(result, error)
-
-    return RpcRunResult(result, "")
-
-
-def shutdown_json_rpc():
-    """Shutdown all JSON-RPC processes."""
-    _process_manager.stop_all_processes()
+    def close(self) -> None:
+        """Closes all connections. The runner itself keeps running."""
+        with self._lock:
+            connections = self._connections
+            self._connections = []
+        for rpc in connections:
+            rpc.close()
+
+
+def wait_for_socket(path: str, proc: subprocess.Popen, timeout: float) -> None:
+    """Waits until the runner started as `proc` accepts connections on `path`."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _connect_runner(path).close()
+            return
+        except (OSError, StreamClosedException):
+            if proc.poll() is not None or time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def negotiate_codec(rpc: JsonRpc) -> None:
+    """Switches a new runner connection to the fastest codec both sides support.
+
+    The handshake itself uses json. The runner answers with its choice and
+    switches right after replying, so nothing else may be sent on the
+    connection until this returns. Shared memory for large messages is used
+    when both sides can access it.
+    """
+    future = rpc.send_request(
+        {
+            "method": "initialize",
+            "codecs": list(CODECS),
+            "sharedMemory": SHARED_MEMORY_DIR is not None,
+        }
+    )
+    response = future.result(HANDSHAKE_TIMEOUT)
+    result = response.get("result", {})
+    rpc.peer = result
+    rpc.set_codec(CODECS.get(result.get("codec"), JSON_CODEC))
+    if result.get("sharedMemory", False):
+        rpc.enable_shared_memory()
+
+
+# Document sync, the runner processes and the run API used to live in this
+# module. They are still importable from here, loaded on first use since those
+# modules import this one.
+_MOVED = {
+    "lsp_documents": [
+        "DocumentCache",
+        "DocumentCacheMiss",
+        "DocumentSync",
+        "get_source_hash",
+        "get_text_delta",
+    ],
+    "lsp_process_manager": [
+        "ChildWatcher",
+        "ProcessManager",
+        "Runner",
+        "RunnerUnavailableError",
+        "get_runner_args",
+        "get_runner_key",
+    ],
+    "lsp_runner_client": [
+        "RpcRunResult",
+        "RunJob",
+        "forget_document",
+        "get_or_start_json_rpc",
+        "prewarm_json_rpc",
+        "run_many_over_json_rpc",
+        "run_over_json_rpc",
+        "shutdown_json_rpc",
+        "submit_over_json_rpc",
+    ],
+}
+
+
+def __getattr__(name: str) -> Any:
+    for module, names in _MOVED.items():
+        if name in names:
+            return getattr(importlib.import_module(module), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,765 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+"""Starts, pools, recycles and stops the runner processes tools run in."""
+
+import atexit
+import contextlib
+import itertools
+import os
+import select
+import signal
+import subprocess
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+# pylint: disable=import-error
+import lsp_documents as docsync
+import lsp_jsonrpc as jsonrpc
+
+# A runner that crashed or was killed for hanging is restarted on the next
+# request, but not before RESTART_BACKOFF seconds, doubled for each other
+# failure within CRASH_LOOP_WINDOW. After CRASH_LOOP_LIMIT failures in that
+# window the runner is considered to be crash looping and is not restarted
+# until older failures age out of the window.
+RESTART_BACKOFF = 1.0  # seconds
+RESTART_BACKOFF_MAX = 60.0  # seconds
+CRASH_LOOP_WINDOW = 300.0  # seconds
+CRASH_LOOP_LIMIT = 5
+
+# How long to wait for a hung runner to write the stacks of its threads.
+TRACEBACK_TIMEOUT = 1.0  # seconds
+
+# There is no SIGKILL on Windows, where killing a process terminates it.
+SIGKILL = getattr(signal, "SIGKILL", signal.SIGTERM)
+
+
+class RunnerUnavailableError(Exception):
+    """Raised when a runner that failed recently is not restarted yet."""
+
+
+def _dump_runner_traceback(pid: Optional[int], path: Optional[str]) -> str:
+    """Asks a runner to write the stacks of its threads and returns them."""
+    if not pid or not path or not hasattr(signal, "SIGUSR1"):
+        return ""
+    try:
+        os.kill(pid, signal.SIGUSR1)
+        # The dump is written from a signal handler in the runner, wait until
+        # the file stops growing.
+        deadline = time.monotonic() + TRACEBACK_TIMEOUT
+        size = -1
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            current = os.path.getsize(path)
+            if current and current == size:
+                break
+            size = current
+        with open(path, encoding="utf-8", errors="replace") as stream:
+            return stream.read()
+    except OSError:
+        return ""
+    finally:
+        with contextlib.suppress(OSError):
+            os.unlink(path)
+
+
+# Runners per interpreter. A runner runs one tool at a time, so lints of
+# several documents only run in parallel on separate runners. Extra runners are
+# started only when all existing ones are busy.
+RUNNER_POOL_SIZE = max(int(os.getenv("LS_RUNNER_POOL_SIZE", "2")), 1)
+
+# Runners are replaced once they have run RUNNER_MAX_REQUESTS requests, once
+# their resident memory exceeds RUNNER_MAX_RSS MiB (where the runner can tell,
+# on Linux), or after RUNNER_MAX_AGE seconds, so state and leaks in the tool do
+# not pile up. A value of 0 turns a limit off. The replacement is started and
+# has the tool imported before the old runner stops taking requests.
+RUNNER_MAX_REQUESTS = int(os.getenv("LS_RUNNER_MAX_REQUESTS", "500"))
+RUNNER_MAX_RSS = int(os.getenv("LS_RUNNER_MAX_RSS", "1024"))  # MiB
+RUNNER_MAX_AGE = float(os.getenv("LS_RUNNER_MAX_AGE", "0"))  # seconds
+
+# Runner processes across all interpreters. Pools do not grow past this, and
+# when an interpreter without a runner needs one, the least recently used idle
+# runner is stopped to make room, if there is one.
+RUNNER_MAX_PROCESSES = max(int(os.getenv("LS_RUNNER_MAX_PROCESSES", "8")), 1)
+
+# Runners that have not been used for this many seconds are stopped, so
+# interpreters of workspaces that are no longer open do not hold on to memory.
+# A value of 0 keeps idle runners until the server exits.
+RUNNER_IDLE_TIMEOUT = float(os.getenv("LS_RUNNER_IDLE_TIMEOUT", "600"))
+
+# On shutdown all runners are asked to exit at once and given this many seconds
+# together to do so. Runners still running after that, for example in the
+# middle of a long run, get SIGTERM and then, after TERMINATE_TIMEOUT, SIGKILL.
+SHUTDOWN_TIMEOUT = float(os.getenv("LS_RUNNER_SHUTDOWN_TIMEOUT", "3"))
+TERMINATE_TIMEOUT = 1.0  # seconds
+
+# Run each request in a child forked from the runner, which keeps the tool
+# imported, so state a tool leaves behind does not carry over to later runs
+# without paying for a new process and import per run. Not on Windows.
+RUNNER_FORK = os.getenv("LS_RUNNER_FORK", "0") == "1" and hasattr(os, "fork")
+
+# Runs each runner executes at the same time. Responses then come back in the
+# order runs complete. Worth raising together with LS_RUNNER_FORK, since runs
+# inside the runner process itself still take turns changing directory.
+RUNNER_WORKERS = max(int(os.getenv("LS_RUNNER_WORKERS", "1")), 1)
+
+# Send requests for a document to the runner that handled it before, unless it
+# is busy and another one is not, so caches the tool keeps in memory stay warm.
+RUNNER_STICKY = os.getenv("LS_RUNNER_STICKY", "1") != "0"
+
+
+# pylint: disable-next=too-many-instance-attributes
+class Runner:
+    """A runner process, the JSON-RPC connection to it and what it caches."""
+
+    def __init__(
+        self,
+        key: tuple,
+        rpc: Optional[jsonrpc.JsonRpc] = None,
+        pool: Optional[jsonrpc.ConnectionPool] = None,
+        proc: Optional[subprocess.Popen] = None,
+        socket_index: int = 0,
+    ):
+        self.key = key
+        self.proc = proc
+        self.socket_index = socket_index
+        self.documents = docsync.DocumentSync()
+        self._rpc = rpc
+        self._pool = pool
+        self._failed = False
+        # Requests assigned to this runner that have not completed yet, and
+        # how many of them it executes at the same time.
+        self.load = 0
+        self.capacity = 1
+        # Seconds from starting the process until it answered the handshake.
+        self.startup_time = 0.0
+        # How the runner was started, to start a replacement the same way.
+        self.args: Sequence[str] = ()
+        self.cwd: Optional[str] = None
+        # What the recycling policy looks at.
+        self.started_at = time.monotonic()
+        self.requests = 0
+        self.rss: Optional[int] = None
+        self.modules: set = set()
+        self.retiring = False
+        # Hit and miss counts of the runner's result cache, as last reported.
+        self.result_cache: Dict[str, Any] = {}
+        # When a request was last assigned to or completed on this runner.
+        self.last_used = time.monotonic()
+        # Set once the runner was asked to exit, so its exit is not a failure.
+        self.stopping = False
+
+    @property
+    def peer(self) -> Dict[str, Any]:
+        """What the runner reported about itself during the handshake."""
+        return self._rpc.peer if self._rpc is not None else self._pool.peer
+
+    @property
+    def closed(self) -> bool:
+        """True once the runner can no longer take requests."""
+        if self._failed or (self.proc is not None and self.proc.poll() is not None):
+            return True
+        return self._rpc is not None and self._rpc.closed
+
+    def connection(self) -> jsonrpc.JsonRpc:
+        """Returns a connection to send a request on."""
+        if self._rpc is not None:
+            if self._rpc.closed:
+                raise jsonrpc.StreamClosedException()
+            return self._rpc
+        try:
+            return self._pool.acquire()
+        except OSError:
+            # The runner went away.
+            self._failed = True
+            raise jsonrpc.StreamClosedException() from None
+
+    @property
+    def shared(self) -> bool:
+        """True for runners reached over a socket, which other servers may use."""
+        return self._pool is not None
+
+    def stop(self, retire: bool = False) -> None:
+        """Asks a runner started over stdio to exit.
+
+        Socket runners keep running for other servers, unless `retire` is set
+        because the runner is being recycled.
+        """
+        self.stopping = True
+        if self._rpc is not None:
+            with contextlib.suppress(Exception):
+                self._rpc.send_data({"id": self._rpc.next_id(), "method": "exit"})
+            return
+        if retire:
+            with contextlib.suppress(Exception):
+                rpc = self._pool.acquire()
+                rpc.send_data({"id": rpc.next_id(), "method": "exit"})
+        self._pool.close()
+
+    @property
+    def running(self) -> bool:
+        """True while the runner's process has not exited."""
+        if self.proc is not None:
+            return self.proc.poll() is None
+        pid = self.peer.get("pid")
+        return bool(pid) and jsonrpc.pid_exists(pid)
+
+    def close(self) -> None:
+        """Closes the connections to the runner."""
+        self._failed = True
+        if self._rpc is not None:
+            self._rpc.close()
+        else:
+            self._pool.close()
+
+
+def _normalize_executable(path: str) -> str:
+    if not os.path.isabs(path) and os.path.sep not in path:
+        # A command looked up on PATH, like `python` or `conda`.
+        return path
+    # Resolve the directory but not the executable itself: a virtual
+    # environment's python is a symlink to the base interpreter, and resolving
+    # it would lose the environment.
+    path = os.path.abspath(path)
+    return os.path.normcase(
+        os.path.join(os.path.realpath(os.path.dirname(path)), os.path.basename(path))
+    )
+
+
+def get_runner_args(interpreter: Sequence[str]) -> List[str]:
+    """Returns the command line that starts a runner with `interpreter`."""
+    args = [*interpreter, jsonrpc.RUNNER_SCRIPT]
+    if RUNNER_FORK:
+        args.append("--fork")
+    if RUNNER_WORKERS > 1:
+        args.extend(["--workers", str(RUNNER_WORKERS)])
+    return args
+
+
+def get_runner_key(interpreter: Sequence[str]) -> tuple:
+    """Returns the key of the runner pool for an interpreter.
+
+    Runners do not depend on the workspace, `cwd` is sent with each request,
+    so workspaces using the same interpreter and import settings share them.
+    """
+    if not interpreter:
+        return ()
+    return (
+        _normalize_executable(interpreter[0]),
+        *interpreter[1:],
+        os.getenv("LS_IMPORT_STRATEGY", "useBundled"),
+    )
+
+
+def _should_recycle(runner: Runner) -> bool:
+    if RUNNER_MAX_REQUESTS and runner.requests >= RUNNER_MAX_REQUESTS:
+        return True
+    if RUNNER_MAX_RSS and runner.rss and runner.rss >= RUNNER_MAX_RSS * 1024 * 1024:
+        return True
+    return bool(
+        RUNNER_MAX_AGE and time.monotonic() - runner.started_at >= RUNNER_MAX_AGE
+    )
+
+
+def _wait_for_exit(procs: List[subprocess.Popen], timeout: float) -> list:
+    """Waits up to `timeout` seconds in total for processes to exit.
+
+    Returns the processes that are still running.
+    """
+    deadline = time.monotonic() + timeout
+    running = []
+    for proc in procs:
+        try:
+            proc.wait(max(deadline - time.monotonic(), 0))
+        except subprocess.TimeoutExpired:
+            running.append(proc)
+    return running
+
+
+def _signal_group(pid: int, sig: int) -> bool:
+    """Sends `sig` to the process group led by a runner.
+
+    Runners are started in a session of their own, so the group holds the
+    runner and the children it forked for runs, which would otherwise keep
+    running after the runner is killed. Returns False where there are no
+    process groups or the group is gone.
+    """
+    if not hasattr(os, "killpg"):
+        return False
+    try:
+        os.killpg(pid, sig)
+    except OSError:
+        return False
+    return True
+
+
+# pylint: disable-next=too-few-public-methods
+class ChildWatcher:
+    """Calls back when child processes exit, using one thread for all of them.
+
+    Where the platform has pidfds (Linux 5.3 and later) the exits are waited
+    for with epoll, otherwise each process is waited for on its own thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._epoll = None
+        self._watched: Dict[int, Tuple[subprocess.Popen, Callable[[], None]]] = {}
+
+    def watch(self, proc: subprocess.Popen, callback: Callable[[], None]) -> None:
+        """Calls `callback` on the watcher thread after `proc` exits."""
+        try:
+            # The process is not reaped until the watcher waits for it, so its
+            # pid cannot have been reused yet.
+            fd = os.pidfd_open(proc.pid)
+        except (AttributeError, OSError):
+            threading.Thread(
+                target=self._wait, args=(proc, callback), daemon=True
+            ).start()
+            return
+
+        with self._lock:
+            if self._epoll is None:
+                self._epoll = select.epoll()
+                threading.Thread(
+                    target=self._poll, name="child-watcher", daemon=True
+                ).start()
+            self._watched[fd] = (proc, callback)
+            self._epoll.register(fd, select.EPOLLIN)
+
+    def _wait(self, proc: subprocess.Popen, callback: Callable[[], None]) -> None:
+        proc.wait()
+        callback()
+
+    def _poll(self) -> None:
+        while True:
+            for fd, _ in self._epoll.poll():
+                with self._lock:
+                    self._epoll.unregister(fd)
+                    proc, callback = self._watched.pop(fd)
+                os.close(fd)
+                try:
+                    self._wait(proc, callback)
+                except Exception:  # pylint: disable=broad-except
+                    # One failing callback must not stop watching the others.
+                    pass
+
+
+# pylint: disable-next=too-many-instance-attributes
+class ProcessManager:
+    """Manages sub-processes launched for running tools."""
+
+    def __init__(self):
+        self._runners: Dict[tuple, list] = {}
+        self._starting: Dict[tuple, int] = {}
+        self._sticky: Dict[str, Runner] = {}
+        self._failures: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._reaper: Optional[threading.Thread] = None
+        self._watcher = ChildWatcher()
+        # Socket indexes taken by runners that are being started.
+        self._reserved: Dict[tuple, set] = {}
+        # Socket runners that were recycled or killed, whose sockets are not
+        # reused until their process is gone.
+        self._retired: Dict[tuple, list] = {}
+
+    def stop_all_processes(self):
+        """Send exit command to all processes and shutdown transport.
+
+        Waits at most `SHUTDOWN_TIMEOUT` plus twice `TERMINATE_TIMEOUT`
+        seconds in total, however many runners there are.
+        """
+        with self._changed:
+            runners = [r for pool in self._runners.values() for r in pool]
+            self._runners.clear()
+            self._sticky.clear()
+            self._changed.notify_all()
+        # Socket runners are left running so they can be reused; they exit on
+        # their own once no server is connected.
+        for runner in runners:
+            runner.stop()
+
+        procs = [r.proc for r in runners if r.proc is not None and not r.shared]
+        procs = _wait_for_exit(procs, SHUTDOWN_TIMEOUT)
+        for proc in procs:
+            with contextlib.suppress(OSError):
+                if not _signal_group(proc.pid, signal.SIGTERM):
+                    proc.terminate()
+        procs = _wait_for_exit(procs, TERMINATE_TIMEOUT)
+        for proc in procs:
+            with contextlib.suppress(OSError):
+                if not _signal_group(proc.pid, SIGKILL):
+                    proc.kill()
+        _wait_for_exit(procs, TERMINATE_TIMEOUT)
+
+    def get_runners(self, key: tuple) -> list:
+        """Returns the live runners in a pool."""
+        with self._lock:
+            return [r for r in self._runners.get(key, []) if not r.closed]
+
+    def acquire_runner(
+        self, key: tuple, args: Sequence[str], cwd: str, uri: Optional[str] = None
+    ) -> Runner:
+        """Picks the runner for a request, starting one if needed.
+
+        The runner counts the request towards its load until `release_runner`
+        is called for it.
+        """
+        with self._changed:
+            while True:
+                runner = self._select(key, uri)
+                if runner is not None:
+                    self._assign(runner, uri)
+                    return runner
+                if self._can_start(key):
+                    self._starting[key] = self._starting.get(key, 0) + 1
+                    victim = self._take_idle_runner(key)
+                    break
+                # The pool is full of runners that are still starting.
+                self._changed.wait()
+
+        if victim is not None:
+            victim.stop()
+        try:
+            self.check_restart(key)
+            if jsonrpc.use_socket_transport():
+                runner = self.start_socket_process(key, args, cwd)
+            else:
+                runner = self.start_process(key, args, cwd)
+        except RunnerUnavailableError:
+            # Keep using the runners that are still up, if any.
+            with self._lock:
+                runners = [r for r in self._runners.get(key, []) if not r.closed]
+                if not runners:
+                    raise
+                runner = min(runners, key=lambda r: r.load)
+                self._assign(runner, uri)
+            return runner
+        finally:
+            with self._changed:
+                self._starting[key] -= 1
+                self._changed.notify_all()
+
+        with self._lock:
+            self._assign(runner, uri)
+        return runner
+
+    def release_runner(self, runner: Runner) -> None:
+        """Marks a request acquired with `acquire_runner` as completed."""
+        with self._changed:
+            runner.load -= 1
+            runner.last_used = time.monotonic()
+            # The reaper waits for runners to become idle.
+            self._changed.notify_all()
+            drained = runner.retiring and runner.load == 0
+            retire = not runner.retiring and _should_recycle(runner)
+            if retire:
+                runner.retiring = True
+            in_pool = runner in self._runners.get(runner.key, [])
+        if drained and not in_pool:
+            runner.stop(retire=True)
+        if retire:
+            threading.Thread(
+                target=self._replace, args=(runner,), name="runner-recycle", daemon=True
+            ).start()
+
+    def _replace(self, runner: Runner) -> None:
+        """Swaps a runner for a new one, once the new one has the tool imported."""
+        try:
+            if jsonrpc.use_socket_transport():
+                replacement = self.start_socket_process(
+                    runner.key, runner.args, runner.cwd
+                )
+            else:
+                replacement = self.start_process(runner.key, runner.args, runner.cwd)
+            if runner.modules:
+                replacement.connection().send_request(
+                    {"method": "preload", "modules": sorted(runner.modules)}
+                ).result(jsonrpc.HANDSHAKE_TIMEOUT)
+                replacement.modules.update(runner.modules)
+        except Exception:  # pylint: disable=broad-except
+            # Retire the runner anyway, the next request starts a new one.
+            pass
+
+        with self._lock:
+            self._drop(runner)
+            self._hold_socket(runner)
+            drained = runner.load == 0
+        # Requests still in flight finish first, the last one stops it.
+        if drained:
+            runner.stop(retire=True)
+
+    def _select(self, key: tuple, uri: Optional[str]) -> Optional[Runner]:
+        # Called with the lock held. Returns None when a runner should be
+        # started, or when all runners in the pool are still starting.
+        runners = [r for r in self._runners.get(key, []) if not r.closed]
+        self._runners[key] = runners
+        sticky = self._sticky.get(uri) if RUNNER_STICKY and uri else None
+        if sticky is not None and sticky not in runners:
+            sticky = None
+        if sticky is not None and sticky.load < sticky.capacity:
+            return sticky
+        idle = next((r for r in runners if r.load < r.capacity), None)
+        if idle is not None:
+            return idle
+        if not runners or self._can_start(key):
+            return None
+        if sticky is not None:
+            return sticky
+        return min(runners, key=lambda r: r.load)
+
+    def _can_start(self, key: tuple) -> bool:
+        # Called with the lock held.
+        count = len(self._runners.get(key, [])) + self._starting.get(key, 0)
+        if count >= RUNNER_POOL_SIZE:
+            return False
+        # Every interpreter gets at least one runner, the others make room.
+        return count == 0 or self._count() < RUNNER_MAX_PROCESSES
+
+    def _count(self) -> int:
+        # Called with the lock held.
+        return sum(len(p) for p in self._runners.values()) + sum(
+            self._starting.values()
+        )
+
+    def _take_idle_runner(self, key: tuple) -> Optional[Runner]:
+        # Called with the lock held. Removes the least recently used idle
+        # runner of another pool if the new runner would go over the limit.
+        if self._count() <= RUNNER_MAX_PROCESSES:
+            return None
+        candidates = [
+            runner
+            for pool_key, runners in self._runners.items()
+            if pool_key != key
+            for runner in runners
+            if runner.load == 0 and not runner.closed
+        ]
+        if not candidates:
+            return None
+        victim = min(candidates, key=lambda r: r.last_used)
+        self._drop(victim)
+        return victim
+
+    def _assign(self, runner: Runner, uri: Optional[str]) -> None:
+        # Called with the lock held.
+        runner.load += 1
+        runner.last_used = time.monotonic()
+        if uri:
+            self._sticky[uri] = runner
+
+    def _drop(self, runner: Runner) -> bool:
+        # Called with the lock held. Removes a runner from its pool and from
+        # the documents routed to it; returns False if it was already removed.
+        for uri in [u for u, r in self._sticky.items() if r is runner]:
+            del self._sticky[uri]
+        runners = self._runners.get(runner.key, [])
+        if runner not in runners:
+            return False
+        runners.remove(runner)
+        if not runners:
+            del self._runners[runner.key]
+        return True
+
+    def _hold_socket(self, runner: Runner) -> None:
+        # Called with the lock held. Keeps a socket runner that is going away
+        # from having its socket reused, since a new runner for the socket
+        # would find the old one still listening and connect to it instead.
+        if runner.shared:
+            self._retired.setdefault(runner.key, []).append(runner)
+
+    def _add(self, runner: Runner) -> None:
+        with self._changed:
+            self._runners.setdefault(runner.key, []).append(runner)
+            self._changed.notify_all()
+            if RUNNER_IDLE_TIMEOUT > 0 and self._reaper is None:
+                self._reaper = threading.Thread(
+                    target=self._reap_idle_runners, name="runner-reaper", daemon=True
+                )
+                self._reaper.start()
+
+        if runner.proc is None:
+            return
+
+        def _on_exit():
+            with self._lock:
+                # Runners that were stopped or killed are already dropped.
+                if self._drop(runner) and not runner.stopping:
+                    if runner.proc.returncode != 0:
+                        self._record_failure(runner.key)
+            # Also after an intentional exit, so the reader thread and any
+            # requests still waiting on the runner finish.
+            runner.close()
+
+        self._watcher.watch(runner.proc, _on_exit)
+
+    def _reap_idle_runners(self) -> None:
+        """Stops runners that have been idle for `RUNNER_IDLE_TIMEOUT` seconds.
+
+        Exits once there are no runners left, `_add` starts it again.
+        """
+        while True:
+            with self._changed:
+                if not any(self._runners.values()) or RUNNER_IDLE_TIMEOUT <= 0:
+                    self._reaper = None
+                    return
+                now = time.monotonic()
+                idle = [
+                    runner
+                    for runners in self._runners.values()
+                    for runner in runners
+                    if runner.load == 0
+                ]
+                expired = [r for r in idle if now - r.last_used >= RUNNER_IDLE_TIMEOUT]
+                for runner in expired:
+                    self._drop(runner)
+                if not expired:
+                    # Sleep until the next runner expires, or until a request
+                    # completes or a runner is added.
+                    timeout = min(
+                        (r.last_used + RUNNER_IDLE_TIMEOUT - now for r in idle),
+                        default=None,
+                    )
+                    self._changed.wait(timeout)
+                    continue
+            for runner in expired:
+                runner.stop()
+
+    def start_process(self, key: tuple, args: Sequence[str], cwd: str) -> Runner:
+        """Starts a process and establishes JSON-RPC communication over stdio."""
+        start = time.monotonic()
+        # pylint: disable=consider-using-with
+        proc = subprocess.Popen(
+            args,
+            cwd=cwd,
+            stdout=subprocess.PIPE,
+            stdin=subprocess.PIPE,
+            start_new_session=True,
+        )
+        rpc = jsonrpc.create_json_rpc(proc.stdout, proc.stdin)
+        try:
+            jsonrpc.negotiate_codec(rpc)
+        except Exception:
+            proc.kill()
+            rpc.close()
+            raise
+        runner = Runner(key, rpc=rpc, proc=proc)
+        runner.startup_time = time.monotonic() - start
+        runner.args = args
+        runner.cwd = cwd
+        runner.capacity = runner.peer.get("workers", 1)
+        self._add(runner)
+        return runner
+
+    def start_socket_process(self, key: tuple, args: Sequence[str], cwd: str) -> Runner:
+        """Connects to a runner listening on a socket for `args`.
+
+        Each runner in a pool listens on its own socket. The runner is started
+        first if nothing is listening on the socket yet.
+        """
+        with self._lock:
+            # Runners of a pool that start at the same time get different sockets.
+            reserved = self._reserved.setdefault(key, set())
+            retired = [r for r in self._retired.pop(key, []) if r.running]
+            if retired:
+                self._retired[key] = retired
+            used = {r.socket_index for r in self._runners.get(key, []) + retired}
+            used |= reserved
+            index = next(i for i in itertools.count() if i not in used)
+            reserved.add(index)
+        try:
+            path = jsonrpc.get_runner_socket_path(args, index)
+            pool = jsonrpc.ConnectionPool(path)
+            proc = None
+            start = time.monotonic()
+            try:
+                pool.acquire()
+            except (OSError, jsonrpc.StreamClosedException):
+                # pylint: disable=consider-using-with
+                proc = subprocess.Popen(
+                    [*args, "--listen", path],
+                    cwd=cwd,
+                    stdout=subprocess.DEVNULL,
+                    stdin=subprocess.DEVNULL,
+                    start_new_session=True,
+                )
+                try:
+                    jsonrpc.wait_for_socket(path, proc, jsonrpc.HANDSHAKE_TIMEOUT)
+                    pool.acquire()
+                except Exception:
+                    proc.kill()
+                    raise
+
+            runner = Runner(key, pool=pool, proc=proc, socket_index=index)
+            runner.startup_time = time.monotonic() - start
+            runner.args = args
+            runner.cwd = cwd
+            runner.capacity = runner.peer.get("workers", 1)
+            self._add(runner)
+        finally:
+            with self._lock:
+                self._reserved[key].discard(index)
+        return runner
+
+    def forget_document(self, uri: str) -> None:
+        """Drops what is known about a document for all runners."""
+        with self._lock:
+            self._sticky.pop(uri, None)
+            runners = [r for pool in self._runners.values() for r in pool]
+        for runner in runners:
+            runner.documents.forget(uri)
+
+    def kill_runner(self, runner: Runner) -> str:
+        """Kills a runner, so a new one is started when needed.
+
+        Returns the stacks of the runner's threads when it can dump them.
+        """
+        with self._lock:
+            self._drop(runner)
+            self._hold_socket(runner)
+            self._record_failure(runner.key)
+
+        peer = runner.peer
+        pid = peer.get("pid") or (runner.proc.pid if runner.proc is not None else None)
+        traceback = _dump_runner_traceback(pid, peer.get("tracebackFile"))
+        if runner.proc is not None:
+            if not _signal_group(runner.proc.pid, SIGKILL):
+                runner.proc.kill()
+        elif pid and not _signal_group(pid, SIGKILL):
+            with contextlib.suppress(OSError):
+                os.kill(pid, SIGKILL)
+        runner.close()
+        if pid:
+            # Responses it wrote that were never read.
+            jsonrpc.remove_segments(pid)
+        return traceback
+
+    def check_restart(self, key: tuple) -> None:
+        """Raises `RunnerUnavailableError` if a runner may not be started yet."""
+        now = time.monotonic()
+        with self._lock:
+            failures = [
+                t for t in self._failures.get(key, []) if now - t < CRASH_LOOP_WINDOW
+            ]
+            self._failures[key] = failures
+        if not failures:
+            return
+        if len(failures) >= CRASH_LOOP_LIMIT:
+            raise RunnerUnavailableError(
+                f"Runner failed {len(failures)} times in the last "
+                f"{CRASH_LOOP_WINDOW:.0f} seconds, not restarting it for now."
+            )
+        delay = min(RESTART_BACKOFF * 2 ** (len(failures) - 1), RESTART_BACKOFF_MAX)
+        if now - failures[-1] < delay:
+            raise RunnerUnavailableError(
+                f"Runner failed recently, restarting it in "
+                f"{delay - (now - failures[-1]):.1f} seconds."
+            )
+
+    def _record_failure(self, key: tuple) -> None:
+        # Called with the lock held.
+        self._failures.setdefault(key, []).append(time.monotonic())
+
+
+PROCESS_MANAGER = ProcessManager()
+atexit.register(PROCESS_MANAGER.stop_all_processes)
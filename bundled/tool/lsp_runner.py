@@ -4,10 +4,32 @@
 Runner to use when running under a different interpreter.
 """
 
+import _thread
+import argparse
+import atexit
+import collections
+import contextlib
+import ctypes
+import faulthandler
+import functools
+import gc
+import hashlib
+import importlib.metadata
+import importlib.util
+import itertools
+import json
 import os
 import pathlib
+import pickle
+import queue
+import signal
+import socket
 import sys
+import tempfile
+import threading
+import time
 import traceback
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 
 # **********************************************************
@@ -30,48 +52,906 @@ update_sys_path(
 
 
 # pylint: disable=wrong-import-position,import-error
+import lsp_documents as docsync
 import lsp_jsonrpc as jsonrpc
 import lsp_utils as utils
 
-RPC = jsonrpc.create_json_rpc(sys.stdin.buffer, sys.stdout.buffer)
+DOCUMENTS = docsync.DocumentCache()
 
-EXIT_NOW = False
-while not EXIT_NOW:
-    msg = RPC.receive_data()
+# Runs are executed one at a time on the main thread, in the order they arrive
+# from any connection. Connections are read on their own threads, so control
+# messages like `cancel` are handled while a run is in progress.
+WORK_QUEUE = queue.Queue()
 
-    method = msg["method"]
-    if method == "exit":
-        EXIT_NOW = True
-        continue
+# Set by `--workers`: with more than one, runs are executed on that many
+# threads instead, and responses go out in the order runs complete. Runs in
+# this process only wait for each other to change the working directory.
+WORKERS = 1
 
-    if method == "run":
-        is_exception = False
-        # This is needed to preserve sys.path, pylint modifies
-        # sys.path and that might not work for this scenario
-        # next time around.
-        with utils.substitute_attr(sys, "path", sys.path[:]):
+# Numbers the runs this runner handles, reported in the timing of each response.
+REQUEST_SEQUENCE = itertools.count(1)
+
+# Streamed output is batched so a tool printing many short lines does not
+# turn into one message per line.
+STREAM_INTERVAL = 0.05  # seconds
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# A runner listening on a socket exits after this long without connections.
+DEFAULT_IDLE_TIMEOUT = 300  # seconds
+
+# Set by `--fork`: each run happens in a child forked from this process, which
+# keeps the tool imported, so state a tool leaves behind is discarded with the
+# child instead of leaking into later runs. Not on Windows.
+FORK_RUNS = False
+
+# Held while the tool is imported and while forking, so no child is forked
+# while another thread holds an import lock it would never release there.
+FORK_LOCK = threading.Lock()
+
+# Tool modules whose objects were frozen out of the collector's reach after
+# they were imported for forked runs.
+_FROZEN_MODULES = set()
+
+# Responses of recent runs are reused for runs with the same inputs: module,
+# arguments, working directory, source, the tool's configuration files and the
+# tool's version. Only runs of a single document passed over stdin are cached;
+# runs given a directory, or reading the document from disk, are not. Set
+# LS_RUNNER_RESULT_CACHE_SIZE to 0 to turn this off, for example if the tool's
+# output depends on other files, like the modules a document imports.
+RESULT_CACHE_SIZE = int(os.getenv("LS_RUNNER_RESULT_CACHE_SIZE", "256"))
+
+# TODO: Update this with the configuration files your tool reads. They are
+# looked up in the working directory of the run and its parents; a change to
+# any of them invalidates cached results.
+CONFIG_FILES = ("pyproject.toml", "setup.cfg", "tox.ini")
+
+# Where the stacks of all threads are written on SIGUSR1, so the server can
+# tell what a hung runner was doing before it kills it. Not on Windows.
+TRACEBACK_FILE = None
+
+
+def enable_traceback_dump() -> None:
+    """Dumps the stacks of all threads to `TRACEBACK_FILE` on SIGUSR1."""
+    global TRACEBACK_FILE  # pylint: disable=global-statement
+    if not hasattr(faulthandler, "register"):
+        return
+    fd, path = tempfile.mkstemp(prefix=f"lsp-runner-{os.getpid()}-", suffix=".txt")
+    # pylint: disable-next=consider-using-with
+    stream = open(fd, "w", encoding="utf-8")
+    faulthandler.register(signal.SIGUSR1, file=stream, all_threads=True)
+    atexit.register(_remove_traceback_file, path)
+    TRACEBACK_FILE = path
+
+
+def _remove_traceback_file(path: str) -> None:
+    with contextlib.suppress(OSError):
+        os.unlink(path)
+
+
+def _interrupt_main() -> None:
+    if hasattr(signal, "pthread_kill"):
+        # A real signal also wakes the main thread from blocking calls.
+        signal.pthread_kill(threading.main_thread().ident, signal.SIGINT)
+    else:
+        _thread.interrupt_main()
+
+
+# pylint: disable-next=too-many-instance-attributes
+class RunInterrupter:
+    """Interrupts the run in progress on the main thread when it is cancelled.
+
+    Cancellation is delivered as a SIGINT to the main thread, whose handler raises
+    `utils.CancelledError` in the main thread, but only while the tool's own code
+    runs (see `in_tool`). Elsewhere it is deferred, so locks, the working
+    directory and `sys.path` are always restored, and the run stops at the next
+    token check or when the tool returns. Inside a `shielded` block, for
+    example while a message is being written, the interruption is deferred to
+    the end of the block so the connection is never left with half a message.
+
+    Runs on worker threads cannot be interrupted this way, they are cancelled
+    through the token `running` returns, at the points `utils.run_module` and
+    friends check it.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._running = None
+        self._tokens = {}
+        self._cancelled = set()
+        self._requested = False
+        self._pending_signals = 0
+        self._shielded = 0
+        self._in_tool = 0
+        self._deferred = False
+
+    def cancel(self, rpc: jsonrpc.JsonRpc, msg_id) -> None:
+        """Cancels a run, interrupting it if it is in progress."""
+        with self._lock:
+            token = self._tokens.get((rpc, msg_id))
+            if token is not None:
+                token.cancel()
+            if self._running == (rpc, msg_id):
+                if not self._requested:
+                    self._requested = True
+                    self._pending_signals += 1
+                    _interrupt_main()
+            elif token is None:
+                if len(self._cancelled) > 1024:
+                    self._cancelled.clear()
+                self._cancelled.add((rpc, msg_id))
+
+    @contextlib.contextmanager
+    def running(self, rpc: jsonrpc.JsonRpc, msg_id):
+        """Marks a run as in progress on this thread.
+
+        Yields a token that is cancelled along with the run.
+        """
+        on_main = threading.current_thread() is threading.main_thread()
+        token = utils.CancellationToken()
+        with self._lock:
+            if (rpc, msg_id) in self._cancelled:
+                self._cancelled.discard((rpc, msg_id))
+                raise utils.CancelledError()
+            self._tokens[(rpc, msg_id)] = token
+            if on_main:
+                self._running = (rpc, msg_id)
+        try:
+            yield token
+            with self._lock:
+                cancelled = self._requested if on_main else token.is_cancelled
+            if cancelled:
+                # The tool caught the interruption and returned anyway.
+                raise utils.CancelledError()
+        finally:
+            with self._lock:
+                del self._tokens[(rpc, msg_id)]
+                if on_main:
+                    self._running = None
+                    self._requested = False
+                    self._in_tool = 0
+                    self._deferred = False
+
+    @contextlib.contextmanager
+    def in_tool(self):
+        """Allows interruption during the block, which runs the tool's own code."""
+        if threading.current_thread() is not threading.main_thread():
+            yield
+            return
+        with self._lock:
+            if self._deferred:
+                self._deferred = False
+                raise utils.CancelledError()
+            self._in_tool += 1
+        try:
+            yield
+        finally:
+            self._in_tool -= 1
+
+    @contextlib.contextmanager
+    def shielded(self):
+        """Defers interruption until the end of the block."""
+        if threading.current_thread() is not threading.main_thread():
+            # Only the main thread is interrupted.
+            yield
+            return
+        self._shielded += 1
+        try:
+            yield
+        finally:
+            self._shielded -= 1
+        if self._shielded == 0 and self._in_tool and self._deferred:
+            self._deferred = False
+            raise utils.CancelledError()
+
+    def handle_signal(self, signum, frame):
+        """SIGINT handler, called on the main thread."""
+        with self._lock:
+            if self._pending_signals == 0:
+                # A real interrupt, not one of ours.
+                signal.default_int_handler(signum, frame)
+            self._pending_signals -= 1
+            if not self._requested or self._running is None:
+                return
+            if self._shielded or not self._in_tool:
+                self._deferred = True
+                return
+        raise utils.CancelledError()
+
+
+INTERRUPTER = RunInterrupter()
+utils.TOOL_CODE_CONTEXT = INTERRUPTER.in_tool
+
+
+class PartialResultSender:
+    """Sends tool output to the server in batches as `partialResult` messages."""
+
+    def __init__(self, send: Callable[[Dict[str, Any]], None], msg_id):
+        self._send = send
+        self._msg_id = msg_id
+        self._chunks = []
+        self._size = 0
+        self._last_sent = 0.0
+
+    def __call__(self, chunk: str):
+        self._chunks.append(chunk)
+        self._size += len(chunk)
+        if (
+            self._size >= STREAM_CHUNK_SIZE
+            or time.monotonic() - self._last_sent >= STREAM_INTERVAL
+        ):
+            with INTERRUPTER.shielded():
+                self._send({"id": self._msg_id, "partialResult": self.take_pending()})
+            self._last_sent = time.monotonic()
+
+    def take_pending(self) -> str:
+        """Returns output not sent yet, and clears it."""
+        pending = "".join(self._chunks)
+        self._chunks = []
+        self._size = 0
+        return pending
+
+
+def _get_file_stamp(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        stat = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _get_parents(path: str) -> List[str]:
+    # `path` and the directories above it, where tools look for configuration.
+    parents = [os.path.abspath(path)]
+    while os.path.dirname(parents[-1]) != parents[-1]:
+        parents.append(os.path.dirname(parents[-1]))
+    return parents
+
+
+@functools.lru_cache(maxsize=None)
+def _get_package_distributions() -> Dict[str, list]:
+    return importlib.metadata.packages_distributions()
+
+
+@functools.lru_cache(maxsize=None)
+def _get_installed_version(package: str) -> Optional[str]:
+    # The import name of a tool often differs from the name it is installed
+    # under, and a namespace package may come from several distributions.
+    versions = []
+    for name in sorted(set(_get_package_distributions().get(package, []))):
+        with contextlib.suppress(importlib.metadata.PackageNotFoundError):
+            versions.append(f"{name}=={importlib.metadata.version(name)}")
+    return ",".join(versions) or None
+
+
+def _get_tool_version(module: str) -> str:
+    package = module.partition(".")[0]
+    version = _get_installed_version(package)
+    if version is not None:
+        return version
+    # Not installed, for example a checkout on the path: edits to the package
+    # show in the modification time of its module file.
+    try:
+        spec = importlib.util.find_spec(package)
+    except (ImportError, ValueError):
+        return ""
+    origin = spec.origin if spec is not None else None
+    return str(_get_file_stamp(origin)) if origin else ""
+
+
+class ResultCache:
+    """LRU of run responses, keyed by everything the output of a run depends on."""
+
+    def __init__(self, capacity: int = RESULT_CACHE_SIZE):
+        self._capacity = capacity
+        self._responses: collections.OrderedDict = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, msg, source: Optional[str]) -> Optional[str]:
+        """Returns the cache key for a run, or None if it must not be cached."""
+        if self._capacity <= 0 or not msg["useStdin"] or source is None:
+            return None
+        cwd = msg["cwd"]
+        paths = [os.path.join(cwd, a) for a in msg["argv"][1:] if not a.startswith("-")]
+        if any(os.path.isdir(path) for path in paths):
+            # Edits to files inside a directory do not change its stamp.
+            return None
+        # Files named on the command line count by modification time.
+        files = {path: _get_file_stamp(path) for path in paths}
+        configs = {
+            path: _get_file_stamp(path)
+            for directory in _get_parents(cwd)
+            for path in (os.path.join(directory, name) for name in CONFIG_FILES)
+        }
+        inputs = [
+            msg["module"],
+            msg["argv"],
+            cwd,
+            msg["useStdin"],
+            docsync.get_source_hash(source) if source is not None else None,
+            sorted((k, v) for k, v in files.items() if v is not None),
+            sorted(configs.items()),
+            _get_tool_version(msg["module"]),
+        ]
+        data = json.dumps(inputs).encode("utf-8")
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Returns the stored response fields for `key`, counting the hit or miss."""
+        with self._lock:
+            response = self._responses.get(key)
+            if response is None:
+                self.misses += 1
+                return None
+            self._responses.move_to_end(key)
+            self.hits += 1
+            return response
+
+    def put(self, key: str, response: Dict[str, Any]) -> None:
+        """Stores the fields of a response."""
+        with self._lock:
+            self._responses[key] = response
+            self._responses.move_to_end(key)
+            while len(self._responses) > self._capacity:
+                self._responses.popitem(last=False)
+
+    def get_stats(self, hit: bool) -> Dict[str, Any]:
+        """Returns what responses report about the cache."""
+        with self._lock:
+            return {"hit": hit, "hits": self.hits, "misses": self.misses}
+
+
+RESULTS = ResultCache()
+
+
+def get_rss() -> Optional[int]:
+    """Returns the resident memory of this process in bytes, where available."""
+    try:
+        with open("/proc/self/statm", "rb") as statm:
+            pages = int(statm.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def handle_initialize(rpc: jsonrpc.JsonRpc, msg) -> None:
+    """Agrees on the codec and transport options for a connection."""
+    # Pick the first codec in the server's order of preference that can be
+    # imported here. The reply goes out in json, then both sides switch.
+    codec = jsonrpc.select_codec(msg.get("codecs", []))
+    shared_memory = bool(
+        msg.get("sharedMemory", False) and jsonrpc.SHARED_MEMORY_DIR is not None
+    )
+    rpc.send_data(
+        {
+            "id": msg["id"],
+            "result": {
+                "codec": codec.name,
+                "codecs": list(jsonrpc.CODECS),
+                "sharedMemory": shared_memory,
+                "pid": os.getpid(),
+                "tracebackFile": TRACEBACK_FILE,
+                "workers": WORKERS,
+            },
+        }
+    )
+    rpc.set_codec(codec)
+    if shared_memory:
+        rpc.enable_shared_memory()
+
+
+def handle_run(
+    rpc: jsonrpc.JsonRpc, msg, send: Optional[Callable[[Dict[str, Any]], None]] = None
+) -> None:
+    """Runs the tool for a `run` message and sends back the result.
+
+    The result goes to `send` instead of the connection, when given. The
+    response carries a `timing` object with the seconds spent in each phase.
+    """
+    start = time.monotonic()
+    timing = {
+        "pid": os.getpid(),
+        "seq": next(REQUEST_SEQUENCE),
+        "queued": start - msg.get("receivedAt", start),
+    }
+    send = _timing_sender(send or rpc.send_data, timing, start)
+    try:
+        source = DOCUMENTS.resolve(msg)
+        timing["resolve"] = time.monotonic() - start
+    except docsync.DocumentCacheMiss:
+        # The server sends the full source again when it sees this.
+        send(
+            {
+                "id": msg["id"],
+                "error": "Document not in runner cache.",
+                "cacheMiss": True,
+            }
+        )
+        return
+
+    key = RESULTS.get_key(msg, source)
+    cached = RESULTS.get(key) if key is not None else None
+    if cached is not None:
+        send({"id": msg["id"], **cached, "resultCache": RESULTS.get_stats(True)})
+        return
+
+    if key is not None:
+        send = _caching_sender(send, key)
+    if FORK_RUNS:
+        run_forked(rpc, msg, source, send)
+    else:
+        run_tool(rpc, msg, source, send)
+
+
+def _timing_sender(
+    send: Callable[[Dict[str, Any]], None], timing: Dict[str, Any], start: float
+) -> Callable[[Dict[str, Any]], None]:
+    """Wraps `send` to add `timing`, and the phases the run reports, to the response."""
+
+    def _send(data: Dict[str, Any]) -> None:
+        if "partialResult" not in data:
+            data = {
+                **data,
+                "timing": {
+                    **timing,
+                    **data.get("timing", {}),
+                    "total": time.monotonic() - start,
+                },
+            }
+        send(data)
+
+    return _send
+
+
+def _caching_sender(
+    send: Callable[[Dict[str, Any]], None], key: str
+) -> Callable[[Dict[str, Any]], None]:
+    """Wraps `send` to store the response of a run that completes normally."""
+    streamed = []
+
+    def _send(data: Dict[str, Any]) -> None:
+        if "partialResult" in data:
+            streamed.append(data["partialResult"])
+        elif not (data.get("cancelled") or data.get("exception")):
+            response = {
+                k: v for k, v in data.items() if k not in ("id", "rss", "timing")
+            }
+            output = "".join(streamed) + response.get("result", "")
+            if output:
+                response["result"] = output
+            RESULTS.put(key, response)
+            data = {**data, "resultCache": RESULTS.get_stats(False)}
+        send(data)
+
+    return _send
+
+
+def run_tool(
+    rpc: jsonrpc.JsonRpc,
+    msg,
+    source: Optional[str],
+    send: Optional[Callable[[Dict[str, Any]], None]] = None,
+) -> None:
+    """Runs the tool in this process and sends back the result."""
+    send = send or rpc.send_data
+    is_exception = False
+    sender = PartialResultSender(send, msg["id"]) if msg.get("stream") else None
+    timing = {}
+    try:
+        with INTERRUPTER.running(rpc, msg["id"]) as token:
+            # This is needed to preserve sys.path, pylint modifies
+            # sys.path and that might not work for this scenario
+            # next time around.
+            setup_start = time.monotonic()
+            with utils.preserve_sys_path():
+                timing["setup"] = time.monotonic() - setup_start
+                try:
+                    # TODO: `utils.run_module` is equivalent to running `python -m <pytool-module>`.
+                    # If your tool supports a programmatic API then replace the function below
+                    # with code for your tool. You can also use `utils.run_api` helper, which
+                    # handles changing working directories, managing io streams, etc.
+                    # Also update `_run_tool_on_document` and `_run_tool` functions in
+                    # `lsp_server.py`.
+                    result = utils.run_module(
+                        module=msg["module"],
+                        argv=msg["argv"],
+                        use_stdin=msg["useStdin"],
+                        cwd=msg["cwd"],
+                        source=source,
+                        on_output=sender,
+                        token=token,
+                        timing=timing,
+                        change_dir=msg.get("changeDir", True),
+                    )
+                except Exception:  # pylint: disable=broad-except
+                    result = utils.RunResult("", traceback.format_exc(chain=True))
+                    is_exception = True
+    except utils.CancelledError:
+        send({"id": msg["id"], "error": "Run cancelled.", "cancelled": True})
+        return
+
+    response = {"id": msg["id"], "timing": timing}
+    rss = get_rss()
+    if rss is not None:
+        # Lets the server recycle runners that grow too large.
+        response["rss"] = rss
+    if sender is not None:
+        # Only the output that has not been streamed yet goes in the response.
+        pending = sender.take_pending()
+        if pending:
+            response["result"] = pending
+    if result.stderr:
+        response["error"] = result.stderr
+        response["exception"] = is_exception
+    elif result.stdout and sender is None:
+        response["result"] = result.stdout
+
+    send(response)
+
+
+# pylint: disable-next=too-few-public-methods
+class _PipeSender:
+    """Takes the place of the connection in a forked child.
+
+    Messages are pickled to a pipe, and the parent relays them to the server.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def send_data(self, data) -> None:
+        """Sends a message to the parent."""
+        pickle.dump(data, self._stream)
+        self._stream.flush()
+
+
+def _exit_with_parent(parent: int) -> None:
+    # Has Linux kill the child when the runner dies, so a runner killed on its
+    # own does not leave the child running. Elsewhere the server kills the
+    # runner's process group instead.
+    if sys.platform.startswith("linux"):
+        with contextlib.suppress(OSError, AttributeError):
+            pr_set_pdeathsig = 1
+            libc = ctypes.CDLL(None, use_errno=True)
+            libc.prctl(pr_set_pdeathsig, signal.SIGKILL)
+    if os.getppid() != parent:
+        # The runner died before the request above took effect.
+        os._exit(1)  # pylint: disable=protected-access
+
+
+def _run_child(
+    parent: int, read_fd: int, write_fd: int, msg, source: Optional[str]
+) -> None:
+    # Runs in the forked child and never returns. Only the forking thread
+    # exists in the child, so locks other threads held at the fork are not used.
+    global INTERRUPTER  # pylint: disable=global-statement
+    status = 1
+    try:
+        _exit_with_parent(parent)
+        os.close(read_fd)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        INTERRUPTER = RunInterrupter()
+        utils.TOOL_CODE_CONTEXT = contextlib.nullcontext
+        with open(write_fd, "wb") as stream:
+            run_tool(_PipeSender(stream), msg, source)
+        status = 0
+    except BaseException:  # pylint: disable=broad-except
+        traceback.print_exc()
+    finally:
+        os._exit(status)  # pylint: disable=protected-access
+
+
+def _kill_on_cancel(pid: int, token: utils.CancellationToken):
+    # Worker threads are not interrupted, so the child is killed instead, which
+    # ends the read of its messages.
+    def _kill():
+        with contextlib.suppress(OSError):
+            os.kill(pid, signal.SIGKILL)
+
+    return utils.call_on_cancel(token, _kill)
+
+
+def run_forked(
+    rpc: jsonrpc.JsonRpc,
+    msg,
+    source: Optional[str],
+    send: Optional[Callable[[Dict[str, Any]], None]] = None,
+) -> None:
+    """Runs the tool in a child forked from this process and relays its messages.
+
+    The tool is imported here first, so each child starts with it imported
+    and shares its memory with this process until it writes to it.
+    """
+    send = send or rpc.send_data
+    parent = os.getpid()
+    with FORK_LOCK:
+        if msg["module"] not in _FROZEN_MODULES:
+            if msg["module"] not in sys.modules:
+                with contextlib.suppress(Exception):
+                    with utils.preserve_sys_path():
+                        utils.preload_module(msg["module"])
+            if hasattr(gc, "freeze"):
+                # Keeps the collector in the children from touching, and so
+                # copying, every object inherited from this process.
+                gc.collect()
+                gc.freeze()
+            _FROZEN_MODULES.add(msg["module"])
+        # The write end is closed here before any other run forks, so only
+        # this run's child keeps it open and its exit ends the read below.
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            _run_child(parent, read_fd, write_fd, msg, source)
+        os.close(write_fd)
+
+    response = None
+    try:
+        with open(read_fd, "rb") as stream, INTERRUPTER.running(
+            rpc, msg["id"]
+        ) as token, _kill_on_cancel(pid, token):
+            while response is None:
+                try:
+                    data = pickle.load(stream)
+                except (EOFError, pickle.UnpicklingError):
+                    break
+                if "partialResult" in data:
+                    with INTERRUPTER.shielded():
+                        send(data)
+                else:
+                    response = data
+    except utils.CancelledError:
+        os.kill(pid, signal.SIGKILL)
+        send({"id": msg["id"], "error": "Run cancelled.", "cancelled": True})
+        return
+    finally:
+        _, status = os.waitpid(pid, 0)
+
+    if response is None:
+        response = {
+            "id": msg["id"],
+            "error": f"Runner child exited with status {status} without a result.",
+            "exception": True,
+        }
+    rss = get_rss()
+    if rss is not None:
+        # The runner that is recycled is this process, not the child.
+        response["rss"] = rss
+    send(response)
+
+
+def handle_run_many(rpc: jsonrpc.JsonRpc, msg) -> None:
+    """Runs the jobs of a `runMany` message one after the other.
+
+    Each job is a `run` message without its method and id. The result of
+    each job is sent as a partial result carrying the job's `index` as soon
+    as it completes, and the response tells how many jobs ran. Cancelling the
+    request stops the batch after the job in progress.
+    """
+    cancelled = False
+    count = 0
+    for index, job in enumerate(msg["jobs"]):
+        job = {**job, "id": msg["id"], "receivedAt": msg["receivedAt"]}
+        # Jobs report their results whole, output is not streamed.
+        job.pop("stream", None)
+
+        def _send(data, index=index):
+            nonlocal cancelled
+            cancelled = cancelled or data.get("cancelled", False)
+            data = {k: v for k, v in data.items() if k != "id"}
+            rpc.send_data({"id": msg["id"], "partialResult": {"index": index, **data}})
+
+        handle_run(rpc, job, _send)
+        if cancelled:
+            rpc.send_data(
+                {"id": msg["id"], "error": "Run cancelled.", "cancelled": True}
+            )
+            return
+        count += 1
+    rpc.send_data({"id": msg["id"], "result": count})
+
+
+def handle_preload(rpc: jsonrpc.JsonRpc, msg) -> None:
+    """Imports tool modules ahead of the first run and reports the time taken."""
+    imports = {}
+    errors = []
+    for module in msg["modules"]:
+        try:
+            with FORK_LOCK, utils.preserve_sys_path():
+                imports[module] = utils.preload_module(module)
+        except Exception:  # pylint: disable=broad-except
+            errors.append(traceback.format_exc(chain=True))
+    response = {"id": msg["id"], "result": imports}
+    if errors:
+        response["error"] = "\n".join(errors)
+    rpc.send_data(response)
+
+
+def read_messages(rpc: jsonrpc.JsonRpc) -> bool:
+    """Reads messages from a connection until it closes.
+
+    Runs are queued for the main thread, everything else is handled right
+    away. Returns True if the server asked this runner to exit.
+    """
+    while True:
+        try:
+            msg = rpc.receive_data()
+        except (EOFError, OSError, ValueError, jsonrpc.StreamClosedException):
+            return False
+
+        method = msg["method"]
+        if method == "exit":
+            return True
+
+        if method == "initialize":
+            # Handled on this thread so the codec changes before the next read.
+            handle_initialize(rpc, msg)
+        elif method == "cancel":
+            INTERRUPTER.cancel(rpc, msg["cancelId"])
+        elif method in ("run", "runMany", "preload"):
+            WORK_QUEUE.put((rpc, msg, time.monotonic()))
+
+
+HANDLERS = {
+    "run": handle_run,
+    "runMany": handle_run_many,
+    "preload": handle_preload,
+}
+
+
+def run_queued() -> None:
+    """Executes queued runs until asked to stop.
+
+    Runs are executed on the main thread, or on `WORKERS` threads when there
+    is more than one.
+    """
+    signal.signal(signal.SIGINT, INTERRUPTER.handle_signal)
+    if WORKERS == 1:
+        _work()
+        return
+    workers = [
+        threading.Thread(target=_work, name=f"runner-worker-{i}", daemon=True)
+        for i in range(WORKERS)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def _work() -> None:
+    while True:
+        item = WORK_QUEUE.get()
+        if item is None:
+            # Leave it for the other workers.
+            WORK_QUEUE.put(None)
+            return
+        rpc, msg, received_at = item
+        msg["receivedAt"] = received_at
+        handler = HANDLERS[msg["method"]]
+        try:
+            handler(rpc, msg)
+        except (OSError, jsonrpc.StreamClosedException):
+            # The connection that sent this closed, others are unaffected.
+            pass
+        except utils.CancelledError:
+            # Cancelled as the run finished, nothing is waiting for it anymore.
+            pass
+
+
+def _read_stdio(stdin, stdout) -> None:
+    read_messages(jsonrpc.create_json_rpc(stdin, stdout))
+    WORK_QUEUE.put(None)
+
+
+def listen(path: str, idle_timeout: float) -> bool:
+    """Accepts connections on a Unix domain socket on a background thread.
+
+    Each connection is read on its own thread, so several servers, or
+    several threads of one server, can use this runner at the same time. The
+    runner stops after `idle_timeout` seconds without any connection, or when
+    a server asks it to exit. Returns False if another runner is already
+    serving the socket.
+    """
+    if os.path.exists(path):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(path)
+            except OSError:
+                # Left behind by a runner that is gone.
+                os.unlink(path)
+            else:
+                return False
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Create the socket file private, instead of making it so after the bind.
+    umask = os.umask(0o177)
+    try:
+        listener.bind(path)
+    finally:
+        os.umask(umask)
+    listener.listen()
+    listener.settimeout(min(idle_timeout, 1.0))
+
+    exit_now = threading.Event()
+
+    def _read_connection(conn: socket.socket):
+        rpc = jsonrpc.connect_socket_json_rpc(conn)
+        try:
+            if read_messages(rpc):
+                exit_now.set()
+        finally:
+            rpc.close()
+
+    def _accept():
+        active = []
+        idle_since = time.monotonic()
+        while not exit_now.is_set():
+            active = [t for t in active if t.is_alive()]
+            if active:
+                idle_since = time.monotonic()
+            elif time.monotonic() - idle_since >= idle_timeout:
+                break
             try:
-                # TODO: `utils.run_module` is equivalent to running `python -m <pytool-module>`.
-                # If your tool supports a programmatic API then replace the function below
-                # with code for your tool. You can also use `utils.run_api` helper, which
-                # handles changing working directories, managing io streams, etc.
-                # Also update `_run_tool_on_document` and `_run_tool` functions in `lsp_server.py`.
-                result = utils.run_module(
-                    module=msg["module"],
-                    argv=msg["argv"],
-                    use_stdin=msg["useStdin"],
-                    cwd=msg["cwd"],
-                    source=msg["source"] if "source" in msg else None,
-                )
-            except Exception:  # pylint: disable=broad-except
-                result = utils.RunResult("", traceback.format_exc(chain=True))
-                is_exception = True
-
-        response = {"id": msg["id"]}
-        if result.stderr:
-            response["error"] = result.stderr
-            response["exception"] = is_exception
-        elif result.stdout:
-            response["result"] = result.stdout
-
-        RPC.send_data(response)
+                conn, _ = listener.accept()
+            except socket.timeout:
+                continue
+            try:
+                jsonrpc.check_socket_peer(conn)
+            except OSError:
+                conn.close()
+                continue
+            thread = threading.Thread(
+                target=_read_connection, args=(conn,), daemon=True
+            )
+            thread.start()
+            active.append(thread)
+        listener.close()
+        with contextlib.suppress(OSError):
+            os.unlink(path)
+        WORK_QUEUE.put(None)
+
+    threading.Thread(target=_accept, daemon=True).start()
+    return True
+
+
+def main() -> None:
+    """Serves requests over stdio, or over a socket when `--listen` is given."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--listen", help="Path of a Unix domain socket to listen on.")
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=DEFAULT_IDLE_TIMEOUT,
+        help="Seconds without connections after which a listening runner exits.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of runs to execute at the same time.",
+    )
+    parser.add_argument(
+        "--fork",
+        action="store_true",
+        help="Run each request in a child process forked from the runner.",
+    )
+    args = parser.parse_args()
+    enable_traceback_dump()
+    # Left behind by runners or servers that were killed.
+    jsonrpc.remove_segments()
+    stdio = (sys.stdin.buffer, sys.stdout.buffer)
+    utils.install_thread_local_io()
+    global FORK_RUNS, WORKERS  # pylint: disable=global-statement
+    FORK_RUNS = args.fork and hasattr(os, "fork")
+    WORKERS = max(args.workers, 1)
+
+    if args.listen:
+        if not listen(args.listen, args.idle_timeout):
+            return
+    else:
+        threading.Thread(target=_read_stdio, args=stdio, daemon=True).start()
+    run_queued()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,524 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+"""Runs tools in runner processes over JSON-RPC."""
+
+import contextlib
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+# pylint: disable=import-error
+import lsp_jsonrpc as jsonrpc
+import lsp_process_manager as process_manager
+import lsp_utils as utils
+
+
+def get_or_start_json_rpc(
+    workspace: str,  # pylint: disable=unused-argument
+    interpreter: Sequence[str],
+    cwd: str,
+) -> Union[jsonrpc.JsonRpc, None]:
+    """Gets a JSON-RPC connection to a runner, starting one if needed.
+
+    Runners are shared by all workspaces that use the same interpreter, so
+    `workspace` does not affect which runner is used.
+    """
+    runner = process_manager.PROCESS_MANAGER.acquire_runner(
+        process_manager.get_runner_key(interpreter),
+        process_manager.get_runner_args(interpreter),
+        cwd,
+    )
+    process_manager.PROCESS_MANAGER.release_runner(runner)
+    try:
+        return runner.connection()
+    except jsonrpc.StreamClosedException:
+        return None
+
+
+class RpcRunResult:
+    """Object to hold result from running tool over RPC."""
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        stdout: str,
+        stderr: str,
+        exception: Optional[str] = None,
+        *,
+        cancelled: bool = False,
+        cached: bool = False,
+        timing: Optional[Dict[str, Any]] = None,
+    ):
+        self.stdout: str = stdout
+        self.stderr: str = stderr
+        self.exception: Optional[str] = exception
+        self.cancelled: bool = cancelled
+        # True if the runner answered from its result cache.
+        self.cached: bool = cached
+        # Seconds spent in each phase of the run, as reported by the runner:
+        # `queued`, `resolve`, `setup`, `import`, `run` and `total`, with the
+        # runner's `pid` and the `seq` number of the request. `roundTrip` is
+        # measured by the server, the difference to `total` is transport.
+        self.timing: Dict[str, Any] = timing or {}
+
+
+def _forward_future(source: Future, target: Future, func: Callable[[Any], Any]) -> None:
+    """Resolves `target` with `func` applied to the result of `source`."""
+
+    def _done(src: Future):
+        if src.cancelled():
+            target.cancel()
+            target.set_running_or_notify_cancel()
+            return
+        if target.done():
+            return
+        try:
+            result = func(src.result())
+        except Exception as ex:  # pylint: disable=broad-except
+            if target.set_running_or_notify_cancel():
+                target.set_exception(ex)
+            return
+        if result is not None and target.set_running_or_notify_cancel():
+            target.set_result(result)
+
+    source.add_done_callback(_done)
+
+
+def _to_run_result(data: Dict[str, Any], streamed: str = "") -> RpcRunResult:
+    # Output already streamed as partial results is not repeated in the response.
+    result = streamed + (data["result"] if "result" in data else "")
+    if data.get("cancelled", False):
+        return RpcRunResult(result, "", cancelled=True)
+    cached = data.get("resultCache", {}).get("hit", False)
+    timing = data.get("timing")
+    if "error" in data:
+        error = data["error"]
+
+        if data.get("exception", False):
+            return RpcRunResult(result, "", error, timing=timing)
+        return RpcRunResult(result, error, cached=cached, timing=timing)
+
+    return RpcRunResult(result, "", cached=cached, timing=timing)
+
+
+# pylint: disable=too-many-arguments,unused-argument
+def submit_over_json_rpc(
+    workspace: str,
+    interpreter: Sequence[str],
+    module: str,
+    argv: Sequence[str],
+    use_stdin: bool,
+    cwd: str,
+    source: str = None,
+    *,
+    on_output: Optional[Callable[[str], None]] = None,
+    uri: Optional[str] = None,
+    token: Optional[utils.CancellationToken] = None,
+    change_dir: bool = True,
+) -> Future:
+    """Uses JSON-RPC to execute a command without waiting for it to complete.
+
+    The returned future resolves to an `RpcRunResult`. If `on_output` is
+    given, the runner streams stdout and `on_output` is called with chunks of
+    complete lines as the tool produces them.
+
+    If `uri` is given, the runner caches the source by URI and later requests
+    send only a hash or a delta of it, falling back to the full text when the
+    runner no longer has the previous contents.
+
+    If `token` is cancelled before the run completes, the runner is asked to
+    stop it and the result has `cancelled` set.
+
+    With `change_dir=False` the runner leaves its working directory alone,
+    see `utils.run_module`.
+
+    Runners are shared by all workspaces that use the same interpreter, so
+    `workspace` does not affect which runner is used.
+    """
+    return _submit(
+        interpreter,
+        module,
+        argv,
+        use_stdin,
+        cwd,
+        source=source,
+        on_output=on_output,
+        uri=uri,
+        token=token,
+        change_dir=change_dir,
+    )[0]
+
+
+# pylint: disable=too-many-arguments,too-many-locals
+# pylint: disable-next=too-many-statements
+def _submit(
+    interpreter: Sequence[str],
+    module: str,
+    argv: Sequence[str],
+    use_stdin: bool,
+    cwd: str,
+    *,
+    source: Optional[str],
+    on_output: Optional[Callable[[str], None]],
+    uri: Optional[str],
+    token: Optional[utils.CancellationToken],
+    change_dir: bool = True,
+) -> Tuple[Future, process_manager.Runner]:
+    runner = process_manager.PROCESS_MANAGER.acquire_runner(
+        process_manager.get_runner_key(interpreter),
+        process_manager.get_runner_args(interpreter),
+        cwd,
+        uri,
+    )
+    try:
+        rpc = runner.connection()
+    except Exception:
+        process_manager.PROCESS_MANAGER.release_runner(runner)
+        raise
+    runner.modules.add(module)
+
+    msg = {
+        "method": "run",
+        "module": module,
+        "argv": argv,
+        "useStdin": use_stdin,
+        "cwd": cwd,
+        "changeDir": change_dir,
+    }
+    # The runner only reads the source when passing it over stdin.
+    sync = runner.documents if uri else None
+    if source and use_stdin:
+        if sync is not None:
+            msg.update(sync.encode(uri, source))
+        else:
+            msg["source"] = source
+
+    chunks = []
+
+    def _on_partial(chunk: str):
+        chunks.append(chunk)
+        on_output(chunk)
+
+    if on_output is not None:
+        msg["stream"] = True
+
+    sent_at = time.monotonic()
+
+    def _send() -> Future:
+        nonlocal sent_at
+        chunks.clear()
+        sent_at = time.monotonic()
+        return rpc.send_request(
+            msg, on_partial=_on_partial if on_output is not None else None
+        )
+
+    result = Future()
+
+    def _cancel():
+        # `msg` holds the id of the latest attempt, the runner ignores ids
+        # it does not know or has already answered.
+        with contextlib.suppress(Exception):
+            rpc.send_data(
+                {"id": rpc.next_id(), "method": "cancel", "cancelId": msg["id"]}
+            )
+
+    def _resend_in_full():
+        try:
+            _forward_future(_send(), result, _on_response)
+        except Exception as ex:  # pylint: disable=broad-except
+            if result.set_running_or_notify_cancel():
+                result.set_exception(ex)
+
+    def _on_response(data: Dict[str, Any]) -> Optional[RpcRunResult]:
+        if data.get("cacheMiss") and "source" not in msg:
+            sync.forget(uri)
+            msg.pop("delta", None)
+            msg["source"] = source
+            # This runs on the reader thread, which must keep draining the
+            # runner's output, so write the full request from another thread.
+            threading.Thread(target=_resend_in_full, daemon=True).start()
+            return None
+        runner.requests += 1
+        runner.rss = data.get("rss", runner.rss)
+        runner.result_cache = data.get("resultCache", runner.result_cache)
+        run_result = _to_run_result(data, "".join(chunks))
+        if run_result.timing:
+            run_result.timing["roundTrip"] = time.monotonic() - sent_at
+        return run_result
+
+    try:
+        _forward_future(_send(), result, _on_response)
+    except Exception:
+        process_manager.PROCESS_MANAGER.release_runner(runner)
+        raise
+    result.add_done_callback(
+        lambda _: process_manager.PROCESS_MANAGER.release_runner(runner)
+    )
+    if token is not None:
+        unregister = token.on_cancel(_cancel)
+        result.add_done_callback(lambda _: unregister())
+    return result, runner
+
+
+# pylint: disable=too-many-arguments
+def run_over_json_rpc(
+    workspace: str,
+    interpreter: Sequence[str],
+    module: str,
+    argv: Sequence[str],
+    use_stdin: bool,
+    cwd: str,
+    source: str = None,
+    *,
+    on_output: Optional[Callable[[str], None]] = None,
+    uri: Optional[str] = None,
+    token: Optional[utils.CancellationToken] = None,
+    timeout: Optional[float] = None,
+    change_dir: bool = True,
+) -> RpcRunResult:
+    """Uses JSON-RPC to execute a command.
+
+    If the runner does not answer within `timeout` seconds it is killed, and
+    `utils.RunTimeoutError` raised with the stacks of its threads.
+    """
+    future, runner = _submit(
+        interpreter,
+        module,
+        argv,
+        use_stdin,
+        cwd,
+        source=source,
+        on_output=on_output,
+        uri=uri,
+        token=token,
+        change_dir=change_dir,
+    )
+    try:
+        return future.result(timeout)
+    except FutureTimeoutError:
+        traceback = process_manager.PROCESS_MANAGER.kill_runner(runner)
+        raise utils.RunTimeoutError(
+            f"Runner did not respond within {timeout} seconds.",
+            traceback,
+        ) from None
+
+
+# pylint: disable-next=too-few-public-methods
+class RunJob:
+    """One run of the tool in a batch sent with `run_many_over_json_rpc`."""
+
+    def __init__(
+        self,
+        argv: Sequence[str],
+        use_stdin: bool,
+        cwd: str,
+        source: Optional[str] = None,
+        *,
+        uri: Optional[str] = None,
+        change_dir: bool = True,
+    ):
+        self.argv = argv
+        self.use_stdin = use_stdin
+        self.cwd = cwd
+        self.source = source
+        self.uri = uri
+        self.change_dir = change_dir
+
+
+# pylint: disable=too-many-arguments,unused-argument
+def run_many_over_json_rpc(
+    workspace: str,
+    interpreter: Sequence[str],
+    module: str,
+    jobs: Sequence[RunJob],
+    *,
+    on_result: Optional[Callable[[int, RpcRunResult], None]] = None,
+    token: Optional[utils.CancellationToken] = None,
+    timeout: Optional[float] = None,
+) -> List[RpcRunResult]:
+    """Uses JSON-RPC to execute several runs of `module` in one request.
+
+    The runner executes the jobs one after the other and sends each result
+    as soon as it is done; `on_result` is called with the index of the job
+    and its result, on the connection's reader thread. Returns the results
+    in the order of `jobs`. If `token` is cancelled the runner stops after
+    the job in progress, and the jobs that did not run have `cancelled` set.
+
+    `timeout` applies to each job: the runner is killed, and
+    `utils.RunTimeoutError` raised, once `timeout` seconds pass without a
+    job of the batch finishing.
+    """
+    if not jobs:
+        return []
+    results: List[Optional[RpcRunResult]] = [None] * len(jobs)
+    missed = _run_many(
+        interpreter,
+        module,
+        jobs,
+        results,
+        on_result=on_result,
+        token=token,
+        timeout=timeout,
+    )
+    if missed and not (token is not None and token.is_cancelled):
+        # The runner no longer had these documents; `_run_many` made the
+        # server forget them too, so this time they are sent in full.
+        retry = [jobs[i] for i in missed]
+        retry_results: List[Optional[RpcRunResult]] = [None] * len(retry)
+
+        def _on_retry_result(index: int, result: RpcRunResult) -> None:
+            if on_result is not None:
+                on_result(missed[index], result)
+
+        _run_many(
+            interpreter,
+            module,
+            retry,
+            retry_results,
+            on_result=_on_retry_result,
+            token=token,
+            timeout=timeout,
+        )
+        for index, result in zip(missed, retry_results):
+            results[index] = result
+    return [
+        r if r is not None else RpcRunResult("", "", cancelled=True) for r in results
+    ]
+
+
+# pylint: disable=too-many-arguments,too-many-locals
+def _run_many(
+    interpreter: Sequence[str],
+    module: str,
+    jobs: Sequence[RunJob],
+    results: List[Optional[RpcRunResult]],
+    *,
+    on_result: Optional[Callable[[int, RpcRunResult], None]],
+    token: Optional[utils.CancellationToken],
+    timeout: Optional[float],
+) -> List[int]:
+    # Fills in `results` and returns the indexes of jobs that missed the
+    # runner's document cache.
+    runner = process_manager.PROCESS_MANAGER.acquire_runner(
+        process_manager.get_runner_key(interpreter),
+        process_manager.get_runner_args(interpreter),
+        jobs[0].cwd,
+        jobs[0].uri,
+    )
+    try:
+        runner.modules.add(module)
+        msg_jobs = []
+        for job in jobs:
+            msg_job = {
+                "module": module,
+                "argv": job.argv,
+                "useStdin": job.use_stdin,
+                "cwd": job.cwd,
+                "changeDir": job.change_dir,
+            }
+            if job.source and job.use_stdin:
+                if job.uri:
+                    msg_job.update(runner.documents.encode(job.uri, job.source))
+                else:
+                    msg_job["source"] = job.source
+            msg_jobs.append(msg_job)
+
+        missed = []
+        progressed_at = time.monotonic()
+
+        def _on_partial(data: Dict[str, Any]) -> None:
+            nonlocal progressed_at
+            progressed_at = time.monotonic()
+            index = data["index"]
+            if data.get("cacheMiss"):
+                runner.documents.forget(jobs[index].uri)
+                missed.append(index)
+                return
+            runner.requests += 1
+            runner.rss = data.get("rss", runner.rss)
+            runner.result_cache = data.get("resultCache", runner.result_cache)
+            results[index] = _to_run_result(data)
+            if on_result is not None:
+                on_result(index, results[index])
+
+        rpc = runner.connection()
+        msg = {"method": "runMany", "jobs": msg_jobs}
+        future = rpc.send_request(msg, on_partial=_on_partial)
+    except Exception:
+        process_manager.PROCESS_MANAGER.release_runner(runner)
+        raise
+
+    def _cancel():
+        with contextlib.suppress(Exception):
+            rpc.send_data(
+                {"id": rpc.next_id(), "method": "cancel", "cancelId": msg["id"]}
+            )
+
+    unregister = token.on_cancel(_cancel) if token is not None else None
+    try:
+        while True:
+            # The deadline moves with each job the runner finishes.
+            remaining = None
+            if timeout is not None:
+                remaining = max(progressed_at + timeout - time.monotonic(), 0)
+            try:
+                future.result(remaining)
+                break
+            except FutureTimeoutError:
+                if time.monotonic() - progressed_at >= timeout:
+                    traceback = process_manager.PROCESS_MANAGER.kill_runner(runner)
+                    raise utils.RunTimeoutError(
+                        f"Runner did not finish a run of the batch within {timeout} seconds.",
+                        traceback,
+                    ) from None
+    finally:
+        if unregister is not None:
+            unregister()
+        process_manager.PROCESS_MANAGER.release_runner(runner)
+    return sorted(missed)
+
+
+def prewarm_json_rpc(
+    interpreter: Sequence[str], cwd: str, modules: Sequence[str]
+) -> Future:
+    """Starts a runner ahead of the first run and imports `modules` in it.
+
+    The returned future resolves to a dict with the seconds the runner took to
+    start under `startup`, and the seconds each module took to import under
+    `imports`. If an import fails, `error` holds the runner's traceback.
+    """
+    runner = process_manager.PROCESS_MANAGER.acquire_runner(
+        process_manager.get_runner_key(interpreter),
+        process_manager.get_runner_args(interpreter),
+        cwd,
+    )
+    try:
+        rpc = runner.connection()
+        response = rpc.send_request({"method": "preload", "modules": list(modules)})
+    except Exception:
+        process_manager.PROCESS_MANAGER.release_runner(runner)
+        raise
+    response.add_done_callback(
+        lambda _: process_manager.PROCESS_MANAGER.release_runner(runner)
+    )
+
+    def _to_status(data: Dict[str, Any]) -> Dict[str, Any]:
+        status = {"startup": runner.startup_time, "imports": data.get("result", {})}
+        if "error" in data:
+            status["error"] = data["error"]
+        return status
+
+    result = Future()
+    _forward_future(response, result, _to_status)
+    return result
+
+
+def forget_document(uri: str) -> None:
+    """Drops cached contents of a closed document, so it is sent in full next time."""
+    process_manager.PROCESS_MANAGER.forget_document(uri)
+
+
+def shutdown_json_rpc():
+    """Shutdown all JSON-RPC processes."""
+    process_manager.PROCESS_MANAGER.stop_all_processes()
@@ -1,6 +1,7 @@
 # Copyright (c) Microsoft Corporation. All rights reserved.
 # Licensed under the MIT License.
 """Implementation of tool support over LSP."""
+# pylint: disable=too-many-lines
 from __future__ import annotations
 
 import copy
@@ -10,9 +11,11 @@ import pathlib
 import re
 import sys
 import sysconfig
+import threading
+import time
 import traceback
 import urllib.parse
-from typing import Any, Optional, Sequence
+from typing import Any, Callable, Optional, Sequence
 
 
 # **********************************************************
@@ -38,6 +41,8 @@ update_sys_path(
 # **********************************************************
 # pylint: disable=wrong-import-position,import-error
 import lsp_jsonrpc as jsonrpc
+import lsp_process_manager as process_manager
+import lsp_runner_client as runner_client
 import lsp_utils as utils
 from lsprotocol import types as lsp
 from pygls import uris, workspace
@@ -62,7 +67,7 @@ NOTEBOOK_SYNC_OPTIONS = lsp.NotebookDocumentSyncOptions(
     save=True,
 )
 # TODO: Update the language server name and version.
-LSP_SERVER = server.LanguageServer(
+LSP_SERVER = LanguageServer(
     name="<pytool-display-name>",
     version="<server version>",
     max_workers=MAX_WORKERS,
@@ -95,6 +100,29 @@ TOOL_DISPLAY = "<pytool-display-name>"
 # all scenarios.
 TOOL_ARGS = []  # default arguments always passed to your tool.
 
+# TODO: Update these if your tool can legitimately take longer on large files.
+# Seconds a single run may take before it is abandoned, for each way of running
+# the tool. Executables from the `path` setting are killed, a JSON-RPC runner is
+# killed and restarted on the next run, and in-process runs are abandoned at the
+# next safe point (the thread cannot be stopped while inside the tool).
+PATH_RUN_TIMEOUT = 60  # seconds
+RPC_RUN_TIMEOUT = 60  # seconds
+MODULE_RUN_TIMEOUT = 60  # seconds
+
+# TODO: Set this to False if importing your tool has side effects, or if it is
+# not worth keeping a runner around before the first document is opened.
+# When enabled, `initialize` starts a runner for each configured interpreter and
+# imports TOOL_MODULE in it (or in this process), so the first lint after a
+# window reload does not wait for the interpreter and the tool to load.
+PREWARM_TOOL = True
+
+# TODO: Set this to False if your tool does not depend on the working directory,
+# for instance when it is given absolute paths and its settings in `argv`, or
+# takes the directory as an argument. In-process runs then leave the working
+# directory of the server alone, and runs for different workspaces no longer
+# wait for each other to change it. Runners are told the same with each run.
+TOOL_NEEDS_CWD = True
+
 
 # TODO: If your tool is a linter then update this section.
 # Delete "Linting features" section if your tool is NOT a linter.
@@ -105,31 +133,46 @@ TOOL_ARGS = []  # default arguments always passed to your tool.
 #  See `pylint` implementation for a full featured linter extension:
 #  Pylint: https://github.com/microsoft/vscode-pylint/blob/main/bundled/tool
 
+# TODO: Set this to False if the output of your tool cannot be parsed line by line,
+# for example if it reports diagnostics as a single JSON document.
+# When enabled, diagnostics are parsed and published in batches while the tool is
+# still running. The complete list is always published once the run finishes.
+STREAM_DIAGNOSTICS = True
+STREAM_PUBLISH_INTERVAL = 0.25  # seconds
+
+# TODO: Set this to True if your tool can lint the contents of a document passed
+# over stdin, see `_get_document_args`. Lints of single documents and of the
+# cells of a notebook both use it.
+LINT_OVER_STDIN = False
+
+# Lint runs in progress by document URI. Linting a document again, or closing
+# it, cancels the run in progress so its now stale results are not published.
+_LINT_TOKENS: dict[str, utils.CancellationToken] = {}
+_LINT_TOKENS_LOCK = threading.Lock()
+
 
 @LSP_SERVER.feature(lsp.TEXT_DOCUMENT_DID_OPEN)
+@LSP_SERVER.thread()
 def did_open(params: lsp.DidOpenTextDocumentParams) -> None:
     """LSP handler for textDocument/didOpen request."""
     document = LSP_SERVER.workspace.get_text_document(params.text_document.uri)
-    diagnostics: list[lsp.Diagnostic] = _linting_helper(document)
-    LSP_SERVER.text_document_publish_diagnostics(
-        lsp.PublishDiagnosticsParams(uri=document.uri, diagnostics=diagnostics)
-    )
+    _lint_and_publish(document)
 
 
 @LSP_SERVER.feature(lsp.TEXT_DOCUMENT_DID_SAVE)
+@LSP_SERVER.thread()
 def did_save(params: lsp.DidSaveTextDocumentParams) -> None:
     """LSP handler for textDocument/didSave request."""
     document = LSP_SERVER.workspace.get_text_document(params.text_document.uri)
-    diagnostics: list[lsp.Diagnostic] = _linting_helper(document)
-    LSP_SERVER.text_document_publish_diagnostics(
-        lsp.PublishDiagnosticsParams(uri=document.uri, diagnostics=diagnostics)
-    )
+    _lint_and_publish(document)
 
 
 @LSP_SERVER.feature(lsp.TEXT_DOCUMENT_DID_CLOSE)
 def did_close(params: lsp.DidCloseTextDocumentParams) -> None:
     """LSP handler for textDocument/didClose request."""
     document = LSP_SERVER.workspace.get_text_document(params.text_document.uri)
+    _cancel_lint(document.uri)
+    runner_client.forget_document(document.uri)
     # Publishing empty diagnostics to clear the entries for this file.
     LSP_SERVER.text_document_publish_diagnostics(
         lsp.PublishDiagnosticsParams(uri=document.uri, diagnostics=[])
@@ -137,6 +180,7 @@ def did_close(params: lsp.DidCloseTextDocumentParams) -> None:
 
 
 @LSP_SERVER.feature(lsp.NOTEBOOK_DOCUMENT_DID_OPEN)
+@LSP_SERVER.thread()
 def notebook_did_open(params: lsp.DidOpenNotebookDocumentParams) -> None:
     """LSP handler for notebookDocument/didOpen request."""
     nb = LSP_SERVER.workspace.get_notebook_document(
@@ -144,17 +188,16 @@ def notebook_did_open(params: lsp.DidOpenNotebookDocumentParams) -> None:
     )
     if nb is None:
         return
-    for cell in nb.cells:
-        if cell.kind != lsp.NotebookCellKind.Code or cell.document is None:
-            continue
-        document = LSP_SERVER.workspace.get_text_document(cell.document)
-        diagnostics: list[lsp.Diagnostic] = _linting_helper(document)
-        LSP_SERVER.text_document_publish_diagnostics(
-            lsp.PublishDiagnosticsParams(uri=document.uri, diagnostics=diagnostics)
-        )
+    documents = [
+        LSP_SERVER.workspace.get_text_document(cell.document)
+        for cell in nb.cells
+        if cell.kind == lsp.NotebookCellKind.Code and cell.document is not None
+    ]
+    _lint_and_publish_many(documents)
 
 
 @LSP_SERVER.feature(lsp.NOTEBOOK_DOCUMENT_DID_CHANGE)
+@LSP_SERVER.thread()
 def notebook_did_change(params: lsp.DidChangeNotebookDocumentParams) -> None:
     """LSP handler for notebookDocument/didChange request."""
     nb = LSP_SERVER.workspace.get_notebook_document(
@@ -170,10 +213,7 @@ def notebook_did_change(params: lsp.DidChangeNotebookDocumentParams) -> None:
             document = LSP_SERVER.workspace.get_text_document(
                 text_change.document.uri
             )
-            diagnostics: list[lsp.Diagnostic] = _linting_helper(document)
-            LSP_SERVER.text_document_publish_diagnostics(
-                lsp.PublishDiagnosticsParams(uri=document.uri, diagnostics=diagnostics)
-            )
+            _lint_and_publish(document)
 
     # Lint newly added cells (code cells only).
     if change.cells and change.cells.structure and change.cells.structure.did_open:
@@ -186,20 +226,19 @@ def notebook_did_change(params: lsp.DidChangeNotebookDocumentParams) -> None:
             if cell_doc.uri not in code_cell_uris:
                 continue
             document = LSP_SERVER.workspace.get_text_document(cell_doc.uri)
-            diagnostics = _linting_helper(document)
-            LSP_SERVER.text_document_publish_diagnostics(
-                lsp.PublishDiagnosticsParams(uri=document.uri, diagnostics=diagnostics)
-            )
+            _lint_and_publish(document)
 
     # Clear diagnostics for removed cells.
     if change.cells and change.cells.structure and change.cells.structure.did_close:
         for cell_doc in change.cells.structure.did_close:
+            _cancel_lint(cell_doc.uri)
             LSP_SERVER.text_document_publish_diagnostics(
                 lsp.PublishDiagnosticsParams(uri=cell_doc.uri, diagnostics=[])
             )
 
 
 @LSP_SERVER.feature(lsp.NOTEBOOK_DOCUMENT_DID_SAVE)
+@LSP_SERVER.thread()
 def notebook_did_save(params: lsp.DidSaveNotebookDocumentParams) -> None:
     """LSP handler for notebookDocument/didSave request."""
     nb = LSP_SERVER.workspace.get_notebook_document(
@@ -207,20 +246,20 @@ def notebook_did_save(params: lsp.DidSaveNotebookDocumentParams) -> None:
     )
     if nb is None:
         return
-    for cell in nb.cells:
-        if cell.kind != lsp.NotebookCellKind.Code or cell.document is None:
-            continue
-        document = LSP_SERVER.workspace.get_text_document(cell.document)
-        diagnostics: list[lsp.Diagnostic] = _linting_helper(document)
-        LSP_SERVER.text_document_publish_diagnostics(
-            lsp.PublishDiagnosticsParams(uri=document.uri, diagnostics=diagnostics)
-        )
+    documents = [
+        LSP_SERVER.workspace.get_text_document(cell.document)
+        for cell in nb.cells
+        if cell.kind == lsp.NotebookCellKind.Code and cell.document is not None
+    ]
+    _lint_and_publish_many(documents)
 
 
 @LSP_SERVER.feature(lsp.NOTEBOOK_DOCUMENT_DID_CLOSE)
 def notebook_did_close(params: lsp.DidCloseNotebookDocumentParams) -> None:
     """LSP handler for notebookDocument/didClose request."""
     for cell_doc in params.cell_text_documents:
+        _cancel_lint(cell_doc.uri)
+        runner_client.forget_document(cell_doc.uri)
         LSP_SERVER.text_document_publish_diagnostics(
             lsp.PublishDiagnosticsParams(uri=cell_doc.uri, diagnostics=[])
         )
@@ -242,12 +281,169 @@ def _get_document_path(document: workspace.Document) -> str:
     return uris.to_fs_path(document.uri)
 
 
-def _linting_helper(document: workspace.Document) -> list[lsp.Diagnostic]:
+def _start_lint(uri: str) -> utils.CancellationToken:
+    """Returns a token for a new lint of `uri`, cancelling any run in progress."""
+    token = utils.CancellationToken()
+    with _LINT_TOKENS_LOCK:
+        previous = _LINT_TOKENS.get(uri)
+        _LINT_TOKENS[uri] = token
+    if previous is not None:
+        previous.cancel()
+    return token
+
+
+def _finish_lint(uri: str, token: utils.CancellationToken) -> None:
+    with _LINT_TOKENS_LOCK:
+        if _LINT_TOKENS.get(uri) is token:
+            del _LINT_TOKENS[uri]
+
+
+def _cancel_lint(uri: str) -> None:
+    """Cancels the lint of `uri` in progress, if any."""
+    with _LINT_TOKENS_LOCK:
+        token = _LINT_TOKENS.pop(uri, None)
+    if token is not None:
+        token.cancel()
+
+
+def _lint_and_publish(document: workspace.Document) -> None:
+    """Lints the document and publishes the diagnostics, unless cancelled."""
+    token = _start_lint(document.uri)
+    try:
+        diagnostics = _linting_helper(document, token)
+    except utils.CancelledError:
+        return
+    except (utils.RunTimeoutError, process_manager.RunnerUnavailableError) as ex:
+        _log_run_failure(ex)
+        return
+    finally:
+        _finish_lint(document.uri, token)
+    if token.is_cancelled:
+        return
+    LSP_SERVER.text_document_publish_diagnostics(
+        lsp.PublishDiagnosticsParams(uri=document.uri, diagnostics=diagnostics)
+    )
+
+
+def _lint_and_publish_many(documents: list[workspace.Document]) -> None:
+    """Lints documents, such as the cells of a notebook, and publishes the diagnostics.
+
+    When the tool runs under another interpreter all documents go to the
+    runner in one `runMany` request, instead of a round-trip per document.
+    """
+    commands = [
+        _get_tool_command(document, use_stdin=LINT_OVER_STDIN) for document in documents
+    ]
+    runs = [(d, c) for d, c in zip(documents, commands) if c is not None]
+    if len(runs) < 2 or any(c.mode != "rpc" for _, c in runs):
+        for document in documents:
+            _lint_and_publish(document)
+        return
+
+    documents = [document for document, _ in runs]
+    settings = runs[0][1].settings
+    tokens = [_start_lint(document.uri) for document in documents]
+    # The batch stops once every document in it has been linted again or closed.
+    batch_token = utils.CancellationToken()
+    remaining = [len(tokens)]
+    remaining_lock = threading.Lock()
+
+    def _on_document_cancelled():
+        with remaining_lock:
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                batch_token.cancel()
+
+    for token in tokens:
+        token.on_cancel(_on_document_cancelled)
+
+    jobs = [
+        runner_client.RunJob(
+            argv=command.argv,
+            use_stdin=LINT_OVER_STDIN,
+            cwd=command.cwd,
+            source=document.source,
+            uri=document.uri,
+            change_dir=TOOL_NEEDS_CWD,
+        )
+        for document, command in runs
+    ]
+
+    def _on_result(index: int, result: runner_client.RpcRunResult) -> None:
+        document = documents[index]
+        if tokens[index].is_cancelled or result.cancelled:
+            return
+        _log_rpc_result(result)
+        log_to_output(f"{document.uri} :\r\n{result.stdout}")
+        diagnostics = _parse_output_using_regex(result.stdout) if result.stdout else []
+        LSP_SERVER.text_document_publish_diagnostics(
+            lsp.PublishDiagnosticsParams(uri=document.uri, diagnostics=diagnostics)
+        )
+
+    log_to_output(
+        " ".join(settings["interpreter"] + ["-m"] + jobs[0].argv)
+        + f" (batch of {len(jobs)})"
+    )
+    try:
+        runner_client.run_many_over_json_rpc(
+            workspace=settings["workspaceFS"],
+            interpreter=settings["interpreter"],
+            module=TOOL_MODULE,
+            jobs=jobs,
+            on_result=_on_result,
+            token=batch_token,
+            timeout=RPC_RUN_TIMEOUT,
+        )
+    except (utils.RunTimeoutError, process_manager.RunnerUnavailableError) as ex:
+        _log_run_failure(ex)
+    finally:
+        for document, token in zip(documents, tokens):
+            _finish_lint(document.uri, token)
+
+
+# pylint: disable-next=too-few-public-methods
+class _ProgressivePublisher:
+    """Parses streamed tool output and publishes diagnostics in batches."""
+
+    def __init__(self, uri: str, token: Optional[utils.CancellationToken] = None):
+        self._uri = uri
+        self._token = token
+        self._diagnostics: list[lsp.Diagnostic] = []
+        self._published = 0
+        self._last_publish = 0.0
+
+    def on_output(self, chunk: str) -> None:
+        """Handles a chunk of complete output lines from the tool."""
+        self._diagnostics += _parse_output_using_regex(chunk)
+        if len(self._diagnostics) == self._published:
+            return
+        if time.monotonic() - self._last_publish < STREAM_PUBLISH_INTERVAL:
+            return
+        if self._token is not None and self._token.is_cancelled:
+            return
+        LSP_SERVER.text_document_publish_diagnostics(
+            lsp.PublishDiagnosticsParams(
+                uri=self._uri, diagnostics=list(self._diagnostics)
+            )
+        )
+        self._published = len(self._diagnostics)
+        self._last_publish = time.monotonic()
+
+
+def _linting_helper(
+    document: workspace.Document, token: Optional[utils.CancellationToken] = None
+) -> list[lsp.Diagnostic]:
     # TODO: Determine if your tool supports passing file content via stdin.
     # If you want to support linting on change then your tool will need to
-    # support linting over stdin to be effective. Read, and update
-    # _run_tool_on_document and _run_tool functions as needed for your project.
-    result = _run_tool_on_document(document)
+    # support linting over stdin to be effective, see `LINT_OVER_STDIN`. Read,
+    # and update _get_tool_command, _run_tool_on_document and _run_tool
+    # functions as needed for your project.
+    on_output = None
+    if STREAM_DIAGNOSTICS:
+        on_output = _ProgressivePublisher(document.uri, token).on_output
+    result = _run_tool_on_document(
+        document, use_stdin=LINT_OVER_STDIN, on_output=on_output, token=token
+    )
     return _parse_output_using_regex(result.stdout) if result.stdout else []
 
 
@@ -345,7 +541,11 @@ def _formatting_helper(document: workspace.TextDocument) -> list[lsp.TextEdit] |
     # formatting via stdin.
     # Read, and update_run_tool_on_document and _run_tool functions as needed
     # for your formatter.
-    result = _run_tool_on_document(document, use_stdin=True)
+    try:
+        result = _run_tool_on_document(document, use_stdin=True)
+    except (utils.RunTimeoutError, process_manager.RunnerUnavailableError) as ex:
+        _log_run_failure(ex)
+        return None
     if result.stdout:
         new_source = _match_line_endings(document, result.stdout)
         return [
@@ -406,17 +606,66 @@ def initialize(params: lsp.InitializeParams) -> None:
         f"Global settings:\r\n{json.dumps(GLOBAL_SETTINGS, indent=4, ensure_ascii=False)}\r\n"
     )
 
+    if PREWARM_TOOL:
+        threading.Thread(target=_prewarm_tool, name="prewarm", daemon=True).start()
+
+
+def _prewarm_tool() -> None:
+    """Starts runners and imports the tool for all workspaces ahead of any lint."""
+    prewarmed = set()
+    for settings in list(WORKSPACE_SETTINGS.values()):
+        interpreter = settings["interpreter"]
+        if settings["path"]:
+            # Executables are started for each run, there is nothing to keep warm.
+            continue
+        if interpreter and not utils.is_current_interpreter(interpreter[0]):
+            key = process_manager.get_runner_key(interpreter)
+            if key in prewarmed:
+                continue
+            prewarmed.add(key)
+            try:
+                status = runner_client.prewarm_json_rpc(
+                    interpreter, settings["workspaceFS"], [TOOL_MODULE]
+                ).result(RPC_RUN_TIMEOUT)
+            except Exception:  # pylint: disable=broad-except
+                log_warning(
+                    f"Failed to start runner for {' '.join(interpreter)}:\r\n"
+                    f"{traceback.format_exc(chain=True)}"
+                )
+                continue
+            if "error" in status:
+                log_warning(f"Failed to import {TOOL_MODULE}:\r\n{status['error']}")
+                continue
+            log_to_output(
+                f"Runner for {' '.join(interpreter)} ready: started in "
+                f"{status['startup']:.2f}s, imported {TOOL_MODULE} in "
+                f"{status['imports'].get(TOOL_MODULE, 0):.2f}s"
+            )
+        elif None not in prewarmed:
+            # The tool runs in this process.
+            prewarmed.add(None)
+            try:
+                with utils.preserve_sys_path():
+                    seconds = utils.preload_module(TOOL_MODULE)
+            except Exception:  # pylint: disable=broad-except
+                log_warning(
+                    f"Failed to import {TOOL_MODULE}:\r\n"
+                    f"{traceback.format_exc(chain=True)}"
+                )
+                continue
+            log_to_output(f"Imported {TOOL_MODULE} in {seconds:.2f}s")
+
 
 @LSP_SERVER.feature(lsp.EXIT)
 def on_exit(_params: Optional[Any] = None) -> None:
     """Handle clean up on exit."""
-    jsonrpc.shutdown_json_rpc()
+    runner_client.shutdown_json_rpc()
 
 
 @LSP_SERVER.feature(lsp.SHUTDOWN)
 def on_shutdown(_params: Optional[Any] = None) -> None:
     """Handle clean up on shutdown."""
-    jsonrpc.shutdown_json_rpc()
+    runner_client.shutdown_json_rpc()
 
 
 def get_cwd(settings: dict, document: Optional[workspace.TextDocument]) -> str:
@@ -554,15 +803,29 @@ def _get_settings_by_document(document: workspace.TextDocument | None):
 # *****************************************************
 # Internal execution APIs.
 # *****************************************************
-def _run_tool_on_document(
+# pylint: disable-next=too-few-public-methods
+class _ToolCommand:
+    """How the tool runs for a document: its settings, argv, cwd and mode.
+
+    `mode` is "path" to run an executable, "rpc" to run in a runner under
+    another interpreter, or "module" to run in this process.
+    """
+
+    def __init__(self, settings: dict, argv: list[str], cwd: str, mode: str):
+        self.settings = settings
+        self.argv = argv
+        self.cwd = cwd
+        self.mode = mode
+
+
+def _get_tool_command(
     document: workspace.TextDocument,
     use_stdin: bool = False,
     extra_args: Optional[Sequence[str]] = None,
-) -> utils.RunResult | None:
-    """Runs tool on the given document.
+) -> _ToolCommand | None:
+    """Returns how to run the tool on the document, or None to skip it.
 
-    if use_stdin is true then contents of the document is passed to the
-    tool via stdin.
+    Single documents and batches of notebook cells both run what this returns.
     """
     if extra_args is None:
         extra_args = []
@@ -578,46 +841,55 @@ def _run_tool_on_document(
     # deep copy here to prevent accidentally updating global settings.
     settings = copy.deepcopy(_get_settings_by_document(document))
 
-    code_workspace = settings["workspaceFS"]
     # Pass document so get_cwd can resolve file-related variables for this document.
     cwd = get_cwd(settings, document)
 
-    use_path = False
-    use_rpc = False
     if settings["path"]:
         # 'path' setting takes priority over everything.
-        use_path = True
+        mode = "path"
         argv = settings["path"]
     elif settings["interpreter"] and not utils.is_current_interpreter(
         settings["interpreter"][0]
     ):
         # If there is a different interpreter set use JSON-RPC to the subprocess
         # running under that interpreter.
+        mode = "rpc"
         argv = [TOOL_MODULE]
-        use_rpc = True
     else:
         # if the interpreter is same as the interpreter running this
         # process then run as module.
+        mode = "module"
         argv = [TOOL_MODULE]
 
     argv += TOOL_ARGS + settings["args"] + extra_args
+    argv += _get_document_args(document, use_stdin)
+    return _ToolCommand(settings, argv, cwd, mode)
 
-    if use_stdin:
-        # TODO: update these to pass the appropriate arguments to provide document contents
-        # to tool via stdin.
-        # For example, for pylint args for stdin looks like this:
-        #     pylint --from-stdin <path>
-        # Here `--from-stdin` path is used by pylint to make decisions on the file contents
-        # that are being processed. Like, applying exclusion rules.
-        # It should look like this when you pass it:
-        #     argv += ["--from-stdin", document.path]
-        # Read up on how your tool handles contents via stdin. If stdin is not supported use
-        # set use_stdin to False, or provide path, what ever is appropriate for your tool.
-        argv += []
-    else:
-        argv += [document_path]
 
-    if use_path:
+def _run_tool_on_document(
+    document: workspace.TextDocument,
+    use_stdin: bool = False,
+    extra_args: Optional[Sequence[str]] = None,
+    on_output: Optional[Callable[[str], None]] = None,
+    token: Optional[utils.CancellationToken] = None,
+) -> utils.RunResult | None:
+    """Runs tool on the given document.
+
+    if use_stdin is true then contents of the document is passed to the
+    tool via stdin.
+
+    If on_output is given, it is called with chunks of complete lines of
+    stdout while the tool is still running.
+
+    If token is cancelled the run is stopped and `utils.CancelledError` raised.
+    """
+    command = _get_tool_command(document, use_stdin, extra_args)
+    if command is None:
+        return None
+    settings, argv, cwd = command.settings, command.argv, command.cwd
+    code_workspace = settings["workspaceFS"]
+
+    if command.mode == "path":
         # This mode is used when running executables.
         log_to_output(" ".join(argv))
         log_to_output(f"CWD Server: {cwd}")
@@ -626,16 +898,19 @@ def _run_tool_on_document(
             use_stdin=use_stdin,
             cwd=cwd,
             source=document.source.replace("\r\n", "\n"),
+            on_output=on_output,
+            token=token,
+            timeout=PATH_RUN_TIMEOUT,
         )
         if result.stderr:
             log_to_output(result.stderr)
-    elif use_rpc:
+    elif command.mode == "rpc":
         # This mode is used if the interpreter running this server is different from
         # the interpreter used for running this server.
         log_to_output(" ".join(settings["interpreter"] + ["-m"] + argv))
         log_to_output(f"CWD Linter: {cwd}")
 
-        result = jsonrpc.run_over_json_rpc(
+        result = runner_client.run_over_json_rpc(
             workspace=code_workspace,
             interpreter=settings["interpreter"],
             module=TOOL_MODULE,
@@ -643,19 +918,22 @@ def _run_tool_on_document(
             use_stdin=use_stdin,
             cwd=cwd,
             source=document.source,
+            on_output=on_output,
+            uri=document.uri,
+            token=token,
+            timeout=RPC_RUN_TIMEOUT,
+            change_dir=TOOL_NEEDS_CWD,
         )
-        if result.exception:
-            log_error(result.exception)
-            result = utils.RunResult(result.stdout, result.stderr)
-        elif result.stderr:
-            log_to_output(result.stderr)
+        if result.cancelled:
+            raise utils.CancelledError()
+        result = _log_rpc_result(result)
     else:
         # In this mode the tool is run as a module in the same process as the language server.
         log_to_output(" ".join([sys.executable, "-m"] + argv))
         log_to_output(f"CWD Linter: {cwd}")
         # This is needed to preserve sys.path, in cases where the tool modifies
         # sys.path and that might not work for this scenario next time around.
-        with utils.substitute_attr(sys, "path", sys.path[:]):
+        with utils.preserve_sys_path():
             try:
                 # TODO: `utils.run_module` is equivalent to running `python -m <pytool-module>`.
                 # If your tool supports a programmatic API then replace the function below
@@ -668,6 +946,10 @@ def _run_tool_on_document(
                     use_stdin=use_stdin,
                     cwd=cwd,
                     source=document.source,
+                    on_output=on_output,
+                    token=token,
+                    timeout=MODULE_RUN_TIMEOUT,
+                    change_dir=TOOL_NEEDS_CWD,
                 )
             except Exception:
                 log_error(traceback.format_exc(chain=True))
@@ -679,6 +961,23 @@ def _run_tool_on_document(
     return result
 
 
+def _get_document_args(document: workspace.Document, use_stdin: bool) -> list[str]:
+    """Returns the arguments that tell the tool which document to process."""
+    if use_stdin:
+        # TODO: update these to pass the appropriate arguments to provide document contents
+        # to tool via stdin.
+        # For example, for pylint args for stdin looks like this:
+        #     pylint --from-stdin <path>
+        # Here `--from-stdin` path is used by pylint to make decisions on the file contents
+        # that are being processed. Like, applying exclusion rules.
+        # It should look like this when you pass it:
+        #     ["--from-stdin", document.path]
+        # Read up on how your tool handles contents via stdin. If stdin is not supported use
+        # set use_stdin to False, or provide path, what ever is appropriate for your tool.
+        return []
+    return [_get_document_path(document)]
+
+
 def _run_tool(extra_args: Sequence[str]) -> utils.RunResult:
     """Runs tool."""
     # deep copy here to prevent accidentally updating global settings.
@@ -711,7 +1010,9 @@ def _run_tool(extra_args: Sequence[str]) -> utils.RunResult:
         # This mode is used when running executables.
         log_to_output(" ".join(argv))
         log_to_output(f"CWD Server: {cwd}")
-        result = utils.run_path(argv=argv, use_stdin=True, cwd=cwd)
+        result = utils.run_path(
+            argv=argv, use_stdin=True, cwd=cwd, timeout=PATH_RUN_TIMEOUT
+        )
         if result.stderr:
             log_to_output(result.stderr)
     elif use_rpc:
@@ -719,26 +1020,24 @@ def _run_tool(extra_args: Sequence[str]) -> utils.RunResult:
         # the interpreter used for running this server.
         log_to_output(" ".join(settings["interpreter"] + ["-m"] + argv))
         log_to_output(f"CWD Linter: {cwd}")
-        result = jsonrpc.run_over_json_rpc(
+        result = runner_client.run_over_json_rpc(
             workspace=code_workspace,
             interpreter=settings["interpreter"],
             module=TOOL_MODULE,
             argv=argv,
             use_stdin=True,
             cwd=cwd,
+            timeout=RPC_RUN_TIMEOUT,
+            change_dir=TOOL_NEEDS_CWD,
         )
-        if result.exception:
-            log_error(result.exception)
-            result = utils.RunResult(result.stdout, result.stderr)
-        elif result.stderr:
-            log_to_output(result.stderr)
+        result = _log_rpc_result(result)
     else:
         # In this mode the tool is run as a module in the same process as the language server.
         log_to_output(" ".join([sys.executable, "-m"] + argv))
         log_to_output(f"CWD Linter: {cwd}")
         # This is needed to preserve sys.path, in cases where the tool modifies
         # sys.path and that might not work for this scenario next time around.
-        with utils.substitute_attr(sys, "path", sys.path[:]):
+        with utils.preserve_sys_path():
             try:
                 # TODO: `utils.run_module` is equivalent to running `python -m <pytool-module>`.
                 # If your tool supports a programmatic API then replace the function below
@@ -746,7 +1045,12 @@ def _run_tool(extra_args: Sequence[str]) -> utils.RunResult:
                 # handles changing working directories, managing io streams, etc.
                 # Also update `_run_tool_on_document` function and `utils.run_module` in `lsp_runner.py`.
                 result = utils.run_module(
-                    module=TOOL_MODULE, argv=argv, use_stdin=True, cwd=cwd
+                    module=TOOL_MODULE,
+                    argv=argv,
+                    use_stdin=True,
+                    cwd=cwd,
+                    timeout=MODULE_RUN_TIMEOUT,
+                    change_dir=TOOL_NEEDS_CWD,
                 )
             except Exception:
                 log_error(traceback.format_exc(chain=True))
@@ -761,6 +1065,31 @@ def _run_tool(extra_args: Sequence[str]) -> utils.RunResult:
 # *****************************************************
 # Logging and notification.
 # *****************************************************
+def _log_rpc_result(result: runner_client.RpcRunResult) -> utils.RunResult:
+    """Logs what a runner reported about a run, and returns the run's result."""
+    if result.cached:
+        log_to_output("Runner reused the result of an identical earlier run.")
+    if result.timing:
+        log_to_output(
+            f"Runner timing: {json.dumps(result.timing)}", lsp.MessageType.Debug
+        )
+    if result.exception:
+        log_error(result.exception)
+        return utils.RunResult(result.stdout, result.stderr)
+    if result.stderr:
+        log_to_output(result.stderr)
+    return result
+
+
+def _log_run_failure(ex: Exception) -> None:
+    """Logs a run that timed out or could not start, with any captured stacks."""
+    traceback_text = getattr(ex, "traceback", "")
+    if traceback_text:
+        log_error(f"{ex}\r\n{traceback_text}")
+    else:
+        log_error(str(ex))
+
+
 def log_to_output(
     message: str, msg_type: lsp.MessageType = lsp.MessageType.Log
 ) -> None:
@@ -801,4 +1130,8 @@ def log_always(message: str) -> None:
 # Start the server.
 # *****************************************************
 if __name__ == "__main__":
-    LSP_SERVER.start_io()
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+    utils.install_thread_local_io()
+    # Left behind by runners or servers that were killed.
+    jsonrpc.remove_segments()
+    LSP_SERVER.start_io(stdin, stdout)
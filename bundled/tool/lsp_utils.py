@@ -1,9 +1,13 @@
 # Copyright (c) Microsoft Corporation. All rights reserved.
 # Licensed under the MIT License.
 """Utility functions and classes for use with running tools over LSP."""
+# pylint: disable=too-many-lines
 from __future__ import annotations
 
 import contextlib
+import faulthandler
+import importlib
+import importlib.util
 import io
 import logging
 import os
@@ -12,12 +16,134 @@ import runpy
 import site
 import subprocess
 import sys
+import sysconfig
+import tempfile
 import threading
-from typing import Any, Callable, List, Sequence, Tuple, Union
+import time
+from typing import (
+    Any,
+    Callable,
+    Collection,
+    ContextManager,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+
+class SharedLock:
+    """A lock held either exclusively, or shared by any number of threads.
+
+    Using it as a context manager holds it exclusively, like `threading.Lock`.
+    Threads waiting to hold it exclusively go before new shared holders. Given
+    a cancellation token, `exclusive` and `shared` stop waiting and raise
+    `CancelledError` once it is cancelled.
+    """
+
+    def __init__(self):
+        self._changed = threading.Condition(threading.Lock())
+        self._shared = 0
+        self._exclusive = False
+        self._waiting = 0
+        self._owner: Optional[int] = None
+
+    def __enter__(self):
+        self._acquire(None)
+        return self
+
+    def __exit__(self, *_exc_info):
+        with self._changed:
+            self._exclusive = False
+            self._owner = None
+            self._changed.notify_all()
+
+    @contextlib.contextmanager
+    def exclusive(self, token: Optional[CancellationToken] = None):
+        """Holds the lock on its own, unless `token` is cancelled first."""
+        self._acquire(token)
+        try:
+            yield
+        finally:
+            self.__exit__()
+
+    @contextlib.contextmanager
+    def shared(self, token: Optional[CancellationToken] = None):
+        """Holds the lock alongside other shared holders."""
+        with self._waking_on_cancel(token):
+            with self._changed:
+                self._changed.wait_for(
+                    lambda: _is_cancelled(token)
+                    or (not self._exclusive and not self._waiting)
+                )
+                if _is_cancelled(token):
+                    raise CancelledError()
+                self._shared += 1
+        try:
+            yield
+        finally:
+            with self._changed:
+                self._shared -= 1
+                self._changed.notify_all()
+
+    def _acquire(self, token: Optional[CancellationToken]) -> None:
+        with self._waking_on_cancel(token):
+            with self._changed:
+                self._waiting += 1
+                try:
+                    self._changed.wait_for(
+                        lambda: _is_cancelled(token)
+                        or (not self._exclusive and not self._shared)
+                    )
+                finally:
+                    self._waiting -= 1
+                if _is_cancelled(token):
+                    # Shared holders may have been waiting for this thread.
+                    self._changed.notify_all()
+                    raise CancelledError()
+                self._exclusive = True
+                self._owner = threading.get_ident()
+
+    def held_exclusively(self) -> bool:
+        """True if the calling thread holds the lock on its own."""
+        return self._exclusive and self._owner == threading.get_ident()
+
+    @contextlib.contextmanager
+    def _waking_on_cancel(self, token: Optional[CancellationToken]):
+        if token is None:
+            yield
+            return
+
+        def _wake():
+            with self._changed:
+                self._changed.notify_all()
+
+        unregister = token.on_cancel(_wake)
+        try:
+            yield
+        finally:
+            unregister()
+
+
+def _is_cancelled(token: Optional[CancellationToken]) -> bool:
+    return token is not None and token.is_cancelled
+
 
 # Save the working directory used when loading this module
 SERVER_CWD = os.getcwd()
-CWD_LOCK = threading.Lock()
+# Held exclusively while a run changes the working directory of this process,
+# and shared by runs that only rely on it staying the same.
+CWD_LOCK = SharedLock()
+# Held while a run has `sys.argv` and the stdio streams replaced, unless each
+# thread has its own (see `install_thread_local_io`).
+IO_LOCK = threading.RLock()
+# How often a run waiting for `IO_LOCK` checks whether it was cancelled.
+_LOCK_POLL_INTERVAL = 0.1  # seconds
+# Guards the `sys.path` saved by `preserve_sys_path` and how many blocks use it.
+_SYS_PATH_LOCK = threading.Lock()
+_SYS_PATH_STATE = {"users": 0, "saved": None}
 
 
 def as_list(content: Union[Any, List[Any], Tuple[Any]]) -> Union[List[Any], Tuple[Any]]:
@@ -53,6 +179,206 @@ def is_stdlib_file(file_path) -> bool:
     return os.path.normcase(os.path.normpath(file_path)).startswith(_site_paths)
 
 
+class CancelledError(BaseException):
+    """Raised when a run is cancelled because its result is no longer needed.
+
+    This derives from BaseException so tools catching Exception do not
+    swallow it.
+    """
+
+
+class CancellationToken:
+    """Tracks whether the result of a run is still needed."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._callbacks: List[Callable[[], None]] = []
+
+    @property
+    def is_cancelled(self) -> bool:
+        """True once the token is cancelled."""
+        return self._cancelled
+
+    def cancel(self) -> None:
+        """Cancels the token and calls the registered callbacks."""
+        with self._lock:
+            if self._cancelled:
+                return
+            self._cancelled = True
+            callbacks = self._callbacks
+            self._callbacks = []
+        for callback in callbacks:
+            with contextlib.suppress(Exception):
+                callback()
+
+    def on_cancel(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """Calls `callback` on cancellation, right away if already cancelled.
+
+        Returns a function that unregisters the callback.
+        """
+        with self._lock:
+            if not self._cancelled:
+                self._callbacks.append(callback)
+                return lambda: self._remove(callback)
+        callback()
+        return lambda: None
+
+    def raise_if_cancelled(self) -> None:
+        """Raises `CancelledError` if the token is cancelled."""
+        if self._cancelled:
+            raise CancelledError()
+
+    def _remove(self, callback: Callable[[], None]) -> None:
+        with self._lock:
+            with contextlib.suppress(ValueError):
+                self._callbacks.remove(callback)
+
+
+class RunTimeoutError(Exception):
+    """Raised when a run does not finish before its deadline.
+
+    `traceback` holds the stacks of the threads that were running the tool,
+    when they could be captured.
+    """
+
+    def __init__(self, message: str, traceback: str = ""):
+        super().__init__(message)
+        self.traceback = traceback
+
+
+def dump_traceback() -> str:
+    """Returns the current stacks of all threads in this process."""
+    # faulthandler only writes to real files.
+    with tempfile.TemporaryFile("w+", encoding="utf-8") as stream:
+        faulthandler.dump_traceback(stream, all_threads=True)
+        stream.seek(0)
+        return stream.read()
+
+
+class _Deadline:
+    """Cancels a run that is still going when its time is up.
+
+    Use `token` for the run. It is cancelled when the given token is, or when
+    `timeout` seconds pass, in which case `RunTimeoutError` is raised on exit.
+    """
+
+    def __init__(
+        self,
+        token: Optional[CancellationToken],
+        timeout: Optional[float],
+        dump: bool = False,
+    ):
+        self.token = token
+        self._timeout = timeout
+        self._dump = dump
+        self._expired = False
+        self._traceback = ""
+        self._timer = None
+        self._unregister = None
+
+    def __enter__(self) -> "_Deadline":
+        if self._timeout is None:
+            return self
+        outer = self.token
+        self.token = CancellationToken()
+        if outer is not None:
+            self._unregister = outer.on_cancel(self.token.cancel)
+        self._timer = threading.Timer(self._timeout, self._expire)
+        self._timer.daemon = True
+        self._timer.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb) -> None:
+        if self._timer is None:
+            return
+        self._timer.cancel()
+        if self._unregister is not None:
+            self._unregister()
+        if self._expired and exc_type in (None, CancelledError):
+            raise RunTimeoutError(
+                f"Run did not finish within {self._timeout} seconds.",
+                self._traceback,
+            )
+
+    def run(self, func: Callable[[], Any]) -> Any:
+        """Returns what `func` returns, without waiting past the deadline.
+
+        With a deadline `func` runs on a thread of its own, and `CancelledError`
+        is raised as soon as `token` is cancelled, even if `func` is stuck in
+        code that never checks it. `func` is then left to finish on its own.
+        """
+        if self._timer is None:
+            return func()
+        done = threading.Event()
+        outcome = {}
+
+        def _target():
+            try:
+                outcome["result"] = func()
+            except BaseException as ex:  # pylint: disable=broad-except
+                outcome["error"] = ex
+            finally:
+                done.set()
+
+        with call_on_cancel(self.token, done.set):
+            threading.Thread(target=_target, name="tool-run", daemon=True).start()
+            done.wait()
+        if "error" in outcome:
+            raise outcome["error"]
+        if "result" not in outcome:
+            raise CancelledError()
+        return outcome["result"]
+
+    def _expire(self) -> None:
+        if self._dump:
+            self._traceback = dump_traceback()
+        self._expired = True
+        self.token.cancel()
+
+
+def _check_cancelled(token: Optional[CancellationToken]) -> None:
+    if token is not None:
+        token.raise_if_cancelled()
+
+
+def _cancellable_output(
+    on_output: Optional[Callable[[str], None]], token: Optional[CancellationToken]
+) -> Optional[Callable[[str], None]]:
+    """Makes each chunk of streamed output a point where the run can be abandoned."""
+    if on_output is None or token is None:
+        return on_output
+
+    def _on_output(chunk: str) -> None:
+        token.raise_if_cancelled()
+        on_output(chunk)
+
+    return _on_output
+
+
+@contextlib.contextmanager
+def call_on_cancel(token: Optional[CancellationToken], callback: Callable[[], None]):
+    """Calls `callback` if the token is cancelled while the block runs."""
+    if token is None:
+        yield
+        return
+    unregister = token.on_cancel(callback)
+    try:
+        yield
+    finally:
+        unregister()
+
+
+def _kill_on_cancel(process: subprocess.Popen, token: Optional[CancellationToken]):
+    """Kills the process if the token is cancelled while the block runs."""
+
+    def _kill():
+        with contextlib.suppress(OSError):
+            process.kill()
+
+    return call_on_cancel(token, _kill)
+
+
 # pylint: disable-next=too-few-public-methods
 class RunResult:
     """Object to hold result from running tool."""
@@ -82,22 +408,294 @@ class CustomIO(io.TextIOWrapper):
         return self.read()
 
 
+class StreamingIO(CustomIO):
+    """Custom stream that also reports complete lines as they are written."""
+
+    def __init__(
+        self, name, on_output: Callable[[str], None], encoding="utf-8", newline=None
+    ):
+        super().__init__(name, encoding=encoding, newline=newline)
+        self._on_output = on_output
+        self._partial: List[str] = []
+
+    def write(self, text):
+        """Writes to the buffer and reports any newly completed lines."""
+        count = super().write(text)
+        if "\n" in text:
+            head, _, tail = text.rpartition("\n")
+            self._on_output("".join(self._partial) + head + "\n")
+            self._partial = [tail] if tail else []
+        elif text:
+            self._partial.append(text)
+        return count
+
+    def end_output(self):
+        """Reports any trailing output that did not end with a new line."""
+        if self._partial:
+            self._on_output("".join(self._partial))
+            self._partial = []
+
+
+def _create_output_io(
+    name: str, on_output: Optional[Callable[[str], None]] = None
+) -> CustomIO:
+    if on_output is None:
+        return CustomIO(name, encoding="utf-8")
+    return StreamingIO(name, on_output, encoding="utf-8")
+
+
 @contextlib.contextmanager
 def substitute_attr(obj: Any, attribute: str, new_value: Any):
     """Manage object attributes context when using runpy.run_module()."""
     old_value = getattr(obj, attribute)
     setattr(obj, attribute, new_value)
-    yield
-    setattr(obj, attribute, old_value)
+    try:
+        yield
+    finally:
+        setattr(obj, attribute, old_value)
+
+
+@contextlib.contextmanager
+def preserve_sys_path():
+    """Undoes the changes a tool makes to `sys.path` once the block exits.
+
+    Blocks that overlap on different threads share one copy of `sys.path`,
+    and the `sys.path` from before the first of them is put back when the
+    last of them exits, so no block restores a path another left behind.
+    """
+    with _SYS_PATH_LOCK:
+        if _SYS_PATH_STATE["users"] == 0:
+            _SYS_PATH_STATE["saved"] = sys.path
+            sys.path = sys.path[:]
+        _SYS_PATH_STATE["users"] += 1
+    try:
+        yield
+    finally:
+        with _SYS_PATH_LOCK:
+            _SYS_PATH_STATE["users"] -= 1
+            if _SYS_PATH_STATE["users"] == 0:
+                sys.path = _SYS_PATH_STATE["saved"]
+                _SYS_PATH_STATE["saved"] = None
+
+
+_NO_VALUE = object()
+
+
+class ThreadLocalIO:
+    """Stands in for a stdio stream, sending each thread to the one it redirected to.
+
+    Threads that have not redirected it use `default`.
+    """
+
+    def __init__(self, default):
+        self._default = default
+        self._local = threading.local()
+
+    def current(self):
+        """Returns the stream of the calling thread."""
+        return getattr(self._local, "stream", self._default)
+
+    @contextlib.contextmanager
+    def redirect(self, new_stream):
+        """Redirects the calling thread to `new_stream`."""
+        old_stream = getattr(self._local, "stream", _NO_VALUE)
+        self._local.stream = new_stream
+        try:
+            yield
+        finally:
+            if old_stream is _NO_VALUE:
+                del self._local.stream
+            else:
+                self._local.stream = old_stream
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.current(), name)
+
+    def __iter__(self):
+        return iter(self.current())
+
+    def __next__(self):
+        return next(self.current())
+
+    def __enter__(self):
+        return self.current().__enter__()
+
+    def __exit__(self, *exc_info):
+        return self.current().__exit__(*exc_info)
+
+
+class ThreadLocalArgv(list):
+    """Stands in for `sys.argv`, giving each thread the list it substituted.
+
+    Threads that have not substituted it use the list it replaced. C code that
+    reads list items directly, like `str.join`, always sees that list's items.
+    """
+
+    def __init__(self, default: List[str]):
+        super().__init__(default)
+        self._default = default
+        self._local = threading.local()
+
+    def current(self) -> List[str]:
+        """Returns the list of the calling thread."""
+        return getattr(self._local, "argv", self._default)
+
+    @contextlib.contextmanager
+    def substitute(self, argv: Sequence[str]):
+        """Substitutes `argv` for the calling thread."""
+        old_argv = getattr(self._local, "argv", _NO_VALUE)
+        self._local.argv = list(argv)
+        try:
+            yield
+        finally:
+            if old_argv is _NO_VALUE:
+                del self._local.argv
+            else:
+                self._local.argv = old_argv
+
+
+def _delegate_to_current(name: str) -> Callable[..., Any]:
+    def _method(self, *args, **kwargs):
+        return getattr(self.current(), name)(*args, **kwargs)
+
+    _method.__name__ = name
+    return _method
+
+
+# In-place operators are left out: they would rebind `sys.argv` to the list of
+# the calling thread.
+for _name in (
+    "__add__",
+    "__contains__",
+    "__delitem__",
+    "__eq__",
+    "__ge__",
+    "__getitem__",
+    "__gt__",
+    "__iter__",
+    "__le__",
+    "__len__",
+    "__lt__",
+    "__mul__",
+    "__ne__",
+    "__repr__",
+    "__reversed__",
+    "__rmul__",
+    "__setitem__",
+    "append",
+    "clear",
+    "copy",
+    "count",
+    "extend",
+    "index",
+    "insert",
+    "pop",
+    "remove",
+    "reverse",
+    "sort",
+):
+    setattr(ThreadLocalArgv, _name, _delegate_to_current(_name))
+
+
+def install_thread_local_io() -> None:
+    """Replaces `sys.argv` and the stdio streams with per-thread stand-ins.
+
+    Call this once at startup, after taking the streams the protocol is spoken
+    over. Afterwards in-process runs only redirect them for their own thread,
+    and runs on different threads no longer wait on `IO_LOCK`. Threads that
+    are not in a run, like those a tool starts itself, read the original
+    stdin and write to the original stderr, also what they print, so it does
+    not corrupt the protocol on stdout.
+    """
+    with IO_LOCK:
+        defaults = {"stdin": sys.stdin, "stdout": sys.stderr, "stderr": sys.stderr}
+        for stream, default in defaults.items():
+            if not isinstance(getattr(sys, stream), ThreadLocalIO):
+                setattr(sys, stream, ThreadLocalIO(default))
+        if not isinstance(sys.argv, ThreadLocalArgv):
+            sys.argv = ThreadLocalArgv(sys.argv)
+
+
+@contextlib.contextmanager
+def _io_lock(token: Optional[CancellationToken] = None):
+    """Holds `IO_LOCK`, unless `sys.argv` and stdio are per thread.
+
+    Waiting for it ends with `CancelledError` when `token` is cancelled.
+    """
+    if isinstance(sys.argv, ThreadLocalArgv) and all(
+        isinstance(getattr(sys, stream), ThreadLocalIO)
+        for stream in ("stdin", "stdout", "stderr")
+    ):
+        yield
+        return
+    while not IO_LOCK.acquire(timeout=_LOCK_POLL_INTERVAL):
+        _check_cancelled(token)
+    try:
+        yield
+    finally:
+        IO_LOCK.release()
+
+
+@contextlib.contextmanager
+def substitute_argv(argv: Sequence[str]):
+    """Substitutes `sys.argv`, for the calling thread only if it is per thread."""
+    old_argv = sys.argv
+    if not isinstance(old_argv, ThreadLocalArgv):
+        with substitute_attr(sys, "argv", argv):
+            yield
+        return
+    with old_argv.substitute(argv):
+        try:
+            yield
+        finally:
+            # In case the tool replaced it.
+            sys.argv = old_argv
 
 
 @contextlib.contextmanager
 def redirect_io(stream: str, new_stream):
-    """Redirect stdio streams to a custom stream."""
+    """Redirect stdio streams to a custom stream.
+
+    Only the calling thread is redirected if the stream is per thread.
+    """
     old_stream = getattr(sys, stream)
+    if isinstance(old_stream, ThreadLocalIO):
+        with old_stream.redirect(new_stream):
+            try:
+                yield
+            finally:
+                # In case the tool replaced it.
+                setattr(sys, stream, old_stream)
+        return
     setattr(sys, stream, new_stream)
-    yield
-    setattr(sys, stream, old_stream)
+    try:
+        yield
+    finally:
+        setattr(sys, stream, old_stream)
+
+
+@contextlib.contextmanager
+def _working_directory(
+    cwd: str, change_dir: bool, token: Optional[CancellationToken] = None
+):
+    """Holds `CWD_LOCK` for a run in `cwd`, exclusively only when needed.
+
+    The process working directory is only changed if `change_dir` is set and it
+    is not `cwd` already. Runs with module isolation always hold it exclusively,
+    as they restore state other runs may be using. Waiting for the lock ends
+    with `CancelledError` when `token` is cancelled.
+    """
+    if not ISOLATE_MODULES:
+        with CWD_LOCK.shared(token):
+            if not change_dir or is_same_path(os.getcwd(), cwd):
+                yield
+                return
+    with CWD_LOCK.exclusive(token):
+        if change_dir and not is_same_path(os.getcwd(), cwd):
+            with change_cwd(cwd):
+                yield
+        else:
+            yield
 
 
 @contextlib.contextmanager
@@ -120,15 +718,163 @@ def change_cwd(new_cwd):
         os.chdir(SERVER_CWD)
 
 
+# Compiled code of the modules tools run from, so a run does not find the module
+# and read and unmarshal its code again. An entry is used while the source file
+# keeps its modification time and size.
+_ENTRY_POINTS: Dict[str, Tuple[str, Any, Any, Tuple[int, int]]] = {}
+_ENTRY_POINTS_LOCK = threading.Lock()
+
+
+def _get_source_stamp(path: Optional[str]) -> Optional[Tuple[int, int]]:
+    try:
+        stat = os.stat(path)
+    except (OSError, TypeError):
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def get_entry_point(module: str) -> Tuple[str, Any, Any]:
+    """Returns the name, spec and code `runpy.run_module` would run for `module`."""
+    with _ENTRY_POINTS_LOCK:
+        cached = _ENTRY_POINTS.get(module)
+    if cached is not None:
+        mod_name, spec, code, stamp = cached
+        if _get_source_stamp(spec.origin) == stamp:
+            return mod_name, spec, code
+
+    # pylint: disable-next=protected-access
+    mod_name, spec, code = runpy._get_module_details(module)
+    stamp = _get_source_stamp(spec.origin)
+    if stamp is not None:
+        # Modules without a source file, like frozen ones, are not cached.
+        with _ENTRY_POINTS_LOCK:
+            _ENTRY_POINTS[module] = (mod_name, spec, code, stamp)
+    return mod_name, spec, code
+
+
+# Entered around the tool's own code in in-process runs. A host that cancels
+# runs by raising into them, like the runner does from its SIGINT handler,
+# replaces it so that only the tool is interrupted and never the locking and
+# restoring around it.
+# pylint: disable-next=invalid-name
+TOOL_CODE_CONTEXT: Callable[[], ContextManager[Any]] = contextlib.nullcontext
+
+
+def _run_entry_point(module: str, timing: Optional[Dict[str, float]] = None) -> None:
+    # Same as `runpy.run_module(module, run_name="__main__")`, with the code
+    # taken from the cache.
+    start = time.perf_counter()
+    _, spec, code = get_entry_point(module)
+    started = time.perf_counter()
+    try:
+        with TOOL_CODE_CONTEXT():
+            # pylint: disable-next=protected-access
+            runpy._run_code(code, {}, None, "__main__", spec)
+    finally:
+        if timing is not None:
+            timing["import"] = started - start
+            timing["run"] = time.perf_counter() - started
+
+
+# Opt-in with LS_ISOLATE_MODULES=1: modules a tool imports during an in-process
+# run are unloaded after it, and changes it makes to the import system and the
+# environment are undone, so they do not pile up over the life of the process.
+# Such runs take turns with all other runs and imports, see `isolate_modules`.
+# The standard library, modules that were loaded before the run, and the
+# packages named in LS_KEEP_MODULES (comma separated) stay loaded, so heavy
+# dependencies that keep no state are not imported again on every run.
+ISOLATE_MODULES = os.getenv("LS_ISOLATE_MODULES", "0") == "1"
+KEEP_MODULES = frozenset(filter(None, os.getenv("LS_KEEP_MODULES", "").split(",")))
+
+_STDLIB_DIR = os.path.normcase(sysconfig.get_paths()["stdlib"])
+
+
+def _is_stdlib_module(name: str, module: Any) -> bool:
+    if name in getattr(sys, "stdlib_module_names", ()):
+        return True
+    path = getattr(module, "__file__", None)
+    if not path:
+        # Built in, nothing to unload.
+        return True
+    path = os.path.normcase(path)
+    return path.startswith(_STDLIB_DIR) and "site-packages" not in path
+
+
+def _restore_environ(saved: Dict[str, str]) -> None:
+    for name in [n for n in os.environ if n not in saved]:
+        del os.environ[name]
+    for name, value in saved.items():
+        if os.environ.get(name) != value:
+            os.environ[name] = value
+
+
+@contextlib.contextmanager
+def isolate_modules(keep: Optional[Collection[str]] = None):
+    """Unloads the modules first imported inside the block, unless kept.
+
+    Modules in the standard library stay, as do packages in `keep`, matched
+    by their top-level name, which defaults to `KEEP_MODULES`. A submodule
+    imported inside the block is unloaded even if its package was loaded
+    before, for example by a prewarm. `sys.meta_path`, `sys.path_hooks`,
+    `sys.path_importer_cache` and `os.environ` are restored as well. Changes
+    a tool makes to modules that stay loaded are not undone.
+
+    This cannot tell which thread imported a module or set a variable, so the
+    calling thread must hold `CWD_LOCK` exclusively; `RuntimeError` is raised
+    otherwise. Runs and `preload_module` hold it at least shared, so nothing
+    else here imports while the block runs. Threads the tool starts itself
+    are not waited for.
+    """
+    if not CWD_LOCK.held_exclusively():
+        raise RuntimeError("isolate_modules needs CWD_LOCK held exclusively.")
+    keep = KEEP_MODULES if keep is None else keep
+    modules = dict(sys.modules)
+    meta_path = sys.meta_path[:]
+    path_hooks = sys.path_hooks[:]
+    importer_cache = dict(sys.path_importer_cache)
+    environ = dict(os.environ)
+    try:
+        yield
+    finally:
+        for name, module in list(sys.modules.items()):
+            if name in modules:
+                continue
+            top = name.partition(".")[0]
+            if top in keep or _is_stdlib_module(top, module):
+                continue
+            del sys.modules[name]
+            parent, _, child = name.rpartition(".")
+            if getattr(sys.modules.get(parent), child, None) is module:
+                # Do not let a package that stays loaded hold on to it.
+                delattr(sys.modules[parent], child)
+        for name, module in modules.items():
+            if sys.modules.get(name) is not module:
+                sys.modules[name] = module
+        sys.meta_path[:] = meta_path
+        sys.path_hooks[:] = path_hooks
+        sys.path_importer_cache.clear()
+        sys.path_importer_cache.update(importer_cache)
+        _restore_environ(environ)
+
+
+# pylint: disable-next=too-many-arguments
 def _run_module(
-    module: str, argv: Sequence[str], use_stdin: bool, source: str = None
+    module: str,
+    argv: Sequence[str],
+    use_stdin: bool,
+    source: str = None,
+    *,
+    on_output: Optional[Callable[[str], None]] = None,
+    timing: Optional[Dict[str, float]] = None,
+    token: Optional[CancellationToken] = None,
 ) -> RunResult:
     """Runs as a module."""
-    str_output = CustomIO("<stdout>", encoding="utf-8")
+    str_output = _create_output_io("<stdout>", on_output)
     str_error = CustomIO("<stderr>", encoding="utf-8")
 
-    with contextlib.suppress(SystemExit):
-        with substitute_attr(sys, "argv", argv):
+    isolation = isolate_modules() if ISOLATE_MODULES else contextlib.nullcontext()
+    with _io_lock(token), isolation, contextlib.suppress(SystemExit):
+        with substitute_argv(argv):
             with redirect_io("stdout", str_output):
                 with redirect_io("stderr", str_error):
                     if use_stdin and source is not None:
@@ -136,76 +882,257 @@ def _run_module(
                         with redirect_io("stdin", str_input):
                             str_input.write(source)
                             str_input.seek(0)
-                            runpy.run_module(module, run_name="__main__")
+                            _run_entry_point(module, timing)
                     else:
-                        runpy.run_module(module, run_name="__main__")
+                        _run_entry_point(module, timing)
 
+    if on_output is not None:
+        str_output.end_output()
     return RunResult(str_output.get_value(), str_error.get_value())
 
 
+def preload_module(module: str) -> float:
+    """Imports the module a tool runs, ahead of its first run.
+
+    Returns the seconds the import took. For a module inside a package only
+    the package is imported, because runpy warns about running a module that
+    is already imported. The code runs execute is compiled and cached too.
+    """
+    start = time.perf_counter()
+    # Not while a run with module isolation is in progress, see
+    # `isolate_modules`.
+    with CWD_LOCK.shared():
+        spec = importlib.util.find_spec(module)
+        if spec is None:
+            raise ImportError(f"No module named {module}")
+        if spec.submodule_search_locations is None and "." in module:
+            importlib.import_module(module.rpartition(".")[0])
+        else:
+            importlib.import_module(module)
+        get_entry_point(module)
+    return time.perf_counter() - start
+
+
+# pylint: disable-next=too-many-arguments
 def run_module(
-    module: str, argv: Sequence[str], use_stdin: bool, cwd: str, source: str = None
+    module: str,
+    argv: Sequence[str],
+    use_stdin: bool,
+    cwd: str,
+    source: str = None,
+    *,
+    on_output: Optional[Callable[[str], None]] = None,
+    token: Optional[CancellationToken] = None,
+    timeout: Optional[float] = None,
+    timing: Optional[Dict[str, float]] = None,
+    change_dir: bool = True,
 ) -> RunResult:
-    """Runs as a module."""
-    with CWD_LOCK:
-        if is_same_path(os.getcwd(), cwd):
-            return _run_module(module, argv, use_stdin, source)
-        with change_cwd(cwd):
-            return _run_module(module, argv, use_stdin, source)
+    """Runs as a module.
+
+    The working directory of this process is changed to `cwd` for the run,
+    which keeps other runs needing a different one waiting. Tools that take
+    everything they need from `argv`, or are passed `cwd` in it, can be run
+    with `change_dir=False` so runs in different directories do not wait on
+    each other for it.
+
+    If `on_output` is given it is called with complete lines of stdout as the
+    module writes them. If `token` is cancelled the run is abandoned, and
+    `CancelledError` raised, at the next safe point: while it waits for the
+    working directory, before the module starts, when it writes a line of
+    streamed output, or once it returns. With a `timeout` the module runs on a
+    thread of its own, and `RunTimeoutError` is raised with the stacks of all
+    threads as soon as the deadline passes, even if the module is stuck. The
+    module is then left to stop at its next safe point.
+
+    If `timing` is given, the seconds spent finding and loading the module's
+    code and running it are stored in it under `import` and `run`.
+    """
+    with _Deadline(token, timeout, dump=True) as deadline:
+        token = deadline.token
+        on_output = _cancellable_output(on_output, token)
+        _check_cancelled(token)
+
+        def _run() -> RunResult:
+            with _working_directory(cwd, change_dir, token):
+                _check_cancelled(token)
+                return _run_module(
+                    module,
+                    argv,
+                    use_stdin,
+                    source,
+                    on_output=on_output,
+                    timing=timing,
+                    token=token,
+                )
+
+        result = deadline.run(_run)
+        _check_cancelled(token)
+    return result
+
+
+# pylint: disable-next=too-many-arguments
+def _run_path_streaming(
+    argv: Sequence[str],
+    use_stdin: bool,
+    cwd: str,
+    source: Optional[str],
+    *,
+    on_output: Callable[[str], None],
+    token: Optional[CancellationToken],
+) -> RunResult:
+    """Runs an executable, reporting each line of stdout as it is produced."""
+    with subprocess.Popen(
+        argv,
+        encoding="utf-8",
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        stdin=subprocess.PIPE if use_stdin else None,
+        cwd=cwd,
+    ) as process, _kill_on_cancel(process, token):
+        stderr_chunks: List[str] = []
+
+        def _read_stderr():
+            stderr_chunks.append(process.stderr.read())
+
+        def _write_stdin():
+            with contextlib.suppress(BrokenPipeError):
+                if source:
+                    process.stdin.write(source)
+                process.stdin.close()
+
+        # Drain stderr and feed stdin on helper threads so neither pipe can
+        # fill up and block the process while stdout is being read.
+        helpers = [threading.Thread(target=_read_stderr, daemon=True)]
+        if use_stdin:
+            helpers.append(threading.Thread(target=_write_stdin, daemon=True))
+        for helper in helpers:
+            helper.start()
 
+        stdout_lines: List[str] = []
+        for line in process.stdout:
+            stdout_lines.append(line)
+            on_output(line)
 
+        for helper in helpers:
+            helper.join()
+        process.wait()
+    _check_cancelled(token)
+    return RunResult("".join(stdout_lines), "".join(stderr_chunks))
+
+
+# pylint: disable-next=too-many-arguments
 def run_path(
-    argv: Sequence[str], use_stdin: bool, cwd: str, source: str = None
+    argv: Sequence[str],
+    use_stdin: bool,
+    cwd: str,
+    source: str = None,
+    *,
+    on_output: Optional[Callable[[str], None]] = None,
+    token: Optional[CancellationToken] = None,
+    timeout: Optional[float] = None,
+) -> RunResult:
+    """Runs as an executable.
+
+    If `on_output` is given it is called with each line of stdout as the
+    executable writes it. If `token` is cancelled the process is killed and
+    `CancelledError` raised. If it is still running after `timeout` seconds
+    it is killed and `RunTimeoutError` raised.
+    """
+    with _Deadline(token, timeout) as deadline:
+        return _run_path(
+            argv, use_stdin, cwd, source, on_output=on_output, token=deadline.token
+        )
+
+
+# pylint: disable-next=too-many-arguments
+def _run_path(
+    argv: Sequence[str],
+    use_stdin: bool,
+    cwd: str,
+    source: Optional[str],
+    *,
+    on_output: Optional[Callable[[str], None]],
+    token: Optional[CancellationToken],
 ) -> RunResult:
-    """Runs as an executable."""
-    if use_stdin:
+    if on_output is not None:
+        return _run_path_streaming(
+            argv, use_stdin, cwd, source, on_output=on_output, token=token
+        )
+    if use_stdin or token is not None:
         with subprocess.Popen(
             argv,
             encoding="utf-8",
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            stdin=subprocess.PIPE,
-            cwd=cwd,
-        ) as process:
-            return RunResult(*process.communicate(input=source))
-    else:
-        result = subprocess.run(
-            argv,
-            encoding="utf-8",
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            check=False,
+            stdin=subprocess.PIPE if use_stdin else None,
             cwd=cwd,
-        )
-        return RunResult(result.stdout, result.stderr)
+        ) as process, _kill_on_cancel(process, token):
+            result = RunResult(
+                *process.communicate(input=source if use_stdin else None)
+            )
+        _check_cancelled(token)
+        return result
+    result = subprocess.run(
+        argv,
+        encoding="utf-8",
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        check=False,
+        cwd=cwd,
+    )
+    return RunResult(result.stdout, result.stderr)
 
 
+# pylint: disable-next=too-many-arguments
 def run_api(
     callback: Callable[[Sequence[str], CustomIO, CustomIO, CustomIO | None], None],
     argv: Sequence[str],
     use_stdin: bool,
     cwd: str,
     source: str = None,
+    *,
+    on_output: Optional[Callable[[str], None]] = None,
+    token: Optional[CancellationToken] = None,
+    timeout: Optional[float] = None,
+    change_dir: bool = True,
 ) -> RunResult:
-    """Run a API."""
-    with CWD_LOCK:
-        if is_same_path(os.getcwd(), cwd):
-            return _run_api(callback, argv, use_stdin, source)
-        with change_cwd(cwd):
-            return _run_api(callback, argv, use_stdin, source)
+    """Run a API.
+
+    See `run_module` for when to pass `change_dir=False`, and for how `token`
+    and `timeout` end the run.
+    """
+    with _Deadline(token, timeout, dump=True) as deadline:
+        token = deadline.token
+        on_output = _cancellable_output(on_output, token)
+        _check_cancelled(token)
 
+        def _run() -> RunResult:
+            with _working_directory(cwd, change_dir, token):
+                _check_cancelled(token)
+                return _run_api(
+                    callback, argv, use_stdin, source, on_output=on_output, token=token
+                )
 
+        result = deadline.run(_run)
+        _check_cancelled(token)
+    return result
+
+
+# pylint: disable-next=too-many-arguments
 def _run_api(
     callback: Callable[[Sequence[str], CustomIO, CustomIO, CustomIO | None], None],
     argv: Sequence[str],
     use_stdin: bool,
     source: str = None,
+    *,
+    on_output: Optional[Callable[[str], None]] = None,
+    token: Optional[CancellationToken] = None,
 ) -> RunResult:
-    str_output = CustomIO("<stdout>", encoding="utf-8")
+    str_output = _create_output_io("<stdout>", on_output)
     str_error = CustomIO("<stderr>", encoding="utf-8")
 
-    with contextlib.suppress(SystemExit):
-        with substitute_attr(sys, "argv", argv):
+    with _io_lock(token), contextlib.suppress(SystemExit):
+        with substitute_argv(argv):
             with redirect_io("stdout", str_output):
                 with redirect_io("stderr", str_error):
                     if use_stdin and source is not None:
@@ -213,8 +1140,12 @@ def _run_api(
                         with redirect_io("stdin", str_input):
                             str_input.write(source)
                             str_input.seek(0)
-                            callback(argv, str_output, str_error, str_input)
+                            with TOOL_CODE_CONTEXT():
+                                callback(argv, str_output, str_error, str_input)
                     else:
-                        callback(argv, str_output, str_error)
+                        with TOOL_CODE_CONTEXT():
+                            callback(argv, str_output, str_error)
 
+    if on_output is not None:
+        str_output.end_output()
     return RunResult(str_output.get_value(), str_error.get_value())
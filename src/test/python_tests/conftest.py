@@ -0,0 +1,45 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+"""Shared setup and fixtures for the unit tests of the bundled tool modules."""
+
+import os
+import pathlib
+import sys
+
+import pytest
+
+# Ensure bundled libs and tool are importable.
+_PROJECT_ROOT = pathlib.Path(__file__).parent.parent.parent.parent
+sys.path.insert(0, os.fsdecode(_PROJECT_ROOT / "bundled" / "libs"))
+sys.path.insert(0, os.fsdecode(_PROJECT_ROOT / "bundled" / "tool"))
+
+# Loaded before any test module is collected, so the stubs test_get_cwd.py
+# installs for modules that are not loaded yet never replace these.
+# pylint: disable=wrong-import-position,unused-import
+import lsp_documents  # noqa: E402,F401
+import lsp_jsonrpc  # noqa: E402
+import lsp_process_manager  # noqa: E402,F401
+import lsp_runner_client  # noqa: E402,F401
+import lsp_utils  # noqa: E402,F401
+
+
+@pytest.fixture
+def rpc_pair():
+    """A connected (client, server) pair of JSON-RPC objects over pipes."""
+    client_read, server_write = os.pipe()
+    server_read, client_write = os.pipe()
+    client = lsp_jsonrpc.create_json_rpc(
+        os.fdopen(client_read, "rb"), os.fdopen(client_write, "wb")
+    )
+    server = lsp_jsonrpc.create_json_rpc(
+        os.fdopen(server_read, "rb"), os.fdopen(server_write, "wb")
+    )
+    yield client, server
+    client.close()
+    server.close()
+
+
+@pytest.fixture
+def slow_argv():
+    """Arguments that keep `python -m timeit` busy for a minute."""
+    return ["timeit", "-n", "1", "-r", "1", "-s", "import time", "time.sleep(60)"]
@@ -0,0 +1,128 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+"""Unit tests for cancelling tool runs."""
+
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+import lsp_process_manager
+import lsp_runner_client
+import lsp_utils
+
+TIMEOUT = 10  # 10 seconds
+
+
+def _cancel_later(token, delay=0.5):
+    timer = threading.Timer(delay, token.cancel)
+    timer.start()
+    return timer
+
+
+def test_token_callbacks():
+    """Callbacks run once on cancel, or right away when registered too late."""
+    token = lsp_utils.CancellationToken()
+    calls = []
+    token.on_cancel(lambda: calls.append("a"))
+    unregister = token.on_cancel(lambda: calls.append("b"))
+    unregister()
+
+    token.cancel()
+    token.cancel()
+    token.on_cancel(lambda: calls.append("c"))
+
+    assert calls == ["a", "c"]
+    with pytest.raises(lsp_utils.CancelledError):
+        token.raise_if_cancelled()
+
+
+def test_run_path_kills_cancelled_process(tmp_path):
+    """Cancelling a run kills the process instead of waiting for it."""
+    token = lsp_utils.CancellationToken()
+    _cancel_later(token)
+    start = time.monotonic()
+    with pytest.raises(lsp_utils.CancelledError):
+        lsp_utils.run_path(
+            argv=[sys.executable, "-c", "import time; time.sleep(60)"],
+            use_stdin=False,
+            cwd=os.fspath(tmp_path),
+            token=token,
+        )
+    assert time.monotonic() - start < TIMEOUT
+
+
+def test_run_module_skips_cancelled_run(tmp_path):
+    """An in-process run that is already cancelled does not start."""
+    token = lsp_utils.CancellationToken()
+    token.cancel()
+    with pytest.raises(lsp_utils.CancelledError):
+        lsp_utils.run_module(
+            module="this_module_does_not_exist",
+            argv=["this_module_does_not_exist"],
+            use_stdin=False,
+            cwd=os.fspath(tmp_path),
+            token=token,
+        )
+
+
+NEEDS_FORK = pytest.mark.skipif(not hasattr(os, "fork"), reason="Needs os.fork.")
+
+
+@pytest.mark.parametrize(
+    "fork, workers",
+    [
+        (False, 1),
+        pytest.param(True, 1, marks=NEEDS_FORK),
+        pytest.param(True, 2, marks=NEEDS_FORK),
+    ],
+)
+def test_runner_interrupts_cancelled_run(
+    tmp_path, monkeypatch, fork, workers, slow_argv
+):
+    """The runner stops a cancelled run and keeps serving later ones."""
+    monkeypatch.setattr(lsp_process_manager, "RUNNER_FORK", fork)
+    monkeypatch.setattr(lsp_process_manager, "RUNNER_WORKERS", workers)
+    workspace = os.fspath(tmp_path)
+    kwargs = {
+        "workspace": workspace,
+        "interpreter": [sys.executable],
+        "use_stdin": True,
+        "cwd": workspace,
+    }
+    token = lsp_utils.CancellationToken()
+    try:
+        start = time.monotonic()
+        future = lsp_runner_client.submit_over_json_rpc(
+            module="timeit", argv=slow_argv, token=token, **kwargs
+        )
+        _cancel_later(token)
+        assert future.result(TIMEOUT).cancelled
+        assert time.monotonic() - start < TIMEOUT
+
+        result = lsp_runner_client.run_over_json_rpc(
+            module="json.tool", argv=["json.tool"], source="[]", **kwargs
+        )
+        assert result.stdout == "[]\n"
+        assert not result.cancelled
+    finally:
+        lsp_runner_client.shutdown_json_rpc()
+
+
+def test_cancelled_batch_skips_remaining_jobs(tmp_path, slow_argv):
+    """Cancelling a batch stops the job in progress and the ones after it."""
+    workspace = os.fspath(tmp_path)
+    jobs = [lsp_runner_client.RunJob(slow_argv, False, workspace) for _ in range(3)]
+    token = lsp_utils.CancellationToken()
+    try:
+        start = time.monotonic()
+        _cancel_later(token)
+        results = lsp_runner_client.run_many_over_json_rpc(
+            workspace, [sys.executable], "timeit", jobs, token=token
+        )
+        assert all(result.cancelled for result in results)
+        assert time.monotonic() - start < TIMEOUT
+    finally:
+        lsp_runner_client.shutdown_json_rpc()
@@ -6,6 +6,7 @@ import logging
 import os
 import pathlib
 import sys
+import threading
 from unittest.mock import patch
 
 # Ensure bundled libs and tool are importable.
@@ -66,4 +67,60 @@ def test_change_cwd_oserror_does_not_crash(caplog):
     assert body_executed
     assert os.path.normcase(os.getcwd()) == os.path.normcase(original_cwd)
     assert any("/inaccessible" in r.message for r in caplog.records)
-    assert any("Some OS error" in r.message for r in caplog.records)
\ No newline at end of file
+    assert any("Some OS error" in r.message for r in caplog.records)
+
+
+def _record_cwd(cwds):
+    def _callback(_argv, _stdout, _stderr, _stdin=None):
+        cwds.append(os.getcwd())
+
+    return _callback
+
+
+def test_run_api_changes_cwd_only_when_asked(tmp_path):
+    """Without change_dir the run keeps the process cwd instead of the one given."""
+    original_cwd = os.getcwd()
+    cwds = []
+    for change_dir in (True, False):
+        lsp_utils.run_api(
+            callback=_record_cwd(cwds),
+            argv=[],
+            use_stdin=False,
+            cwd=os.fspath(tmp_path),
+            change_dir=change_dir,
+        )
+    os.chdir(original_cwd)
+
+    assert os.path.normcase(cwds[0]) == os.path.normcase(os.fspath(tmp_path))
+    assert os.path.normcase(cwds[1]) == os.path.normcase(original_cwd)
+
+
+def test_run_without_change_dir_shares_cwd_lock(tmp_path):
+    """A run that leaves the cwd alone does not wait for other runs to finish with it."""
+    cwds = []
+
+    def _start_run():
+        thread = threading.Thread(
+            target=lsp_utils.run_api,
+            kwargs={
+                "callback": _record_cwd(cwds),
+                "argv": [],
+                "use_stdin": False,
+                "cwd": os.fspath(tmp_path),
+                "change_dir": False,
+            },
+        )
+        thread.start()
+        return thread
+
+    with lsp_utils.CWD_LOCK.shared():
+        _start_run().join(5)
+        assert len(cwds) == 1
+
+    # The process cwd may be changing while the lock is held exclusively.
+    with lsp_utils.CWD_LOCK:
+        thread = _start_run()
+        thread.join(0.5)
+        assert len(cwds) == 1
+    thread.join(5)
+    assert len(cwds) == 2
@@ -0,0 +1,49 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+"""Unit tests for the cache of compiled tool entry points."""
+
+import os
+
+import lsp_utils
+
+
+def _run(tmp_path, module):
+    return lsp_utils.run_module(
+        module=module,
+        argv=[module, "--flag"],
+        use_stdin=False,
+        cwd=os.fspath(tmp_path),
+    )
+
+
+def test_entry_point_is_reused_until_source_changes(tmp_path, monkeypatch):
+    """Runs reuse the compiled code until the module's source file changes."""
+    monkeypatch.syspath_prepend(os.fspath(tmp_path))
+    script = tmp_path / "entry_point_tool.py"
+    script.write_text("import sys\nprint(__name__, sys.argv[1:])\n", encoding="utf-8")
+
+    assert _run(tmp_path, "entry_point_tool").stdout == "__main__ ['--flag']\n"
+    _, _, code = lsp_utils.get_entry_point("entry_point_tool")
+    assert lsp_utils.get_entry_point("entry_point_tool")[2] is code
+
+    script.write_text("print('changed')\n", encoding="utf-8")
+    stat = script.stat()
+    os.utime(script, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+    assert _run(tmp_path, "entry_point_tool").stdout == "changed\n"
+    assert lsp_utils.get_entry_point("entry_point_tool")[2] is not code
+
+
+def test_package_entry_point_runs_main(tmp_path, monkeypatch):
+    """A package runs its __main__ module, as with `python -m`."""
+    monkeypatch.syspath_prepend(os.fspath(tmp_path))
+    package = tmp_path / "entry_point_pkg"
+    package.mkdir()
+    (package / "__init__.py").write_text("", encoding="utf-8")
+    (package / "__main__.py").write_text(
+        "from . import __name__ as parent\nprint(parent, __name__)\n",
+        encoding="utf-8",
+    )
+
+    result = _run(tmp_path, "entry_point_pkg")
+    assert result.stdout == "entry_point_pkg __main__\n"
@@ -21,6 +21,9 @@ def _setup_mocks():
         def command(self, *args, **kwargs):
             return lambda f: f
 
+        def thread(self, *args, **kwargs):
+            return lambda f: f
+
         def window_log_message(self, *args, **kwargs):
             pass
 
@@ -77,7 +80,8 @@ def _setup_mocks():
         ("pygls.uris", mock_uris),
         ("lsprotocol", types.ModuleType("lsprotocol")),
         ("lsprotocol.types", mock_lsp),
-        ("lsp_jsonrpc", types.ModuleType("lsp_jsonrpc")),
+        ("lsp_process_manager", types.ModuleType("lsp_process_manager")),
+        ("lsp_runner_client", types.ModuleType("lsp_runner_client")),
         ("lsp_utils", types.ModuleType("lsp_utils")),
     ]:
         if _mod_name not in sys.modules:
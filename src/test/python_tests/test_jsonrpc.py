@@ -0,0 +1,985 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+"""Unit tests for the JSON-RPC transport, document sync and runner processes."""
+
+import contextlib
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import types
+
+import pytest
+
+import lsp_documents
+import lsp_jsonrpc
+import lsp_process_manager
+import lsp_runner_client
+
+TIMEOUT = 10  # 10 seconds
+
+
+def test_out_of_order_responses_are_routed_by_id(rpc_pair):
+    """Pipelined requests get their own responses even when answered out of order."""
+    client, server = rpc_pair
+    futures = [client.send_request({"method": "run", "n": i}) for i in range(3)]
+    requests = [server.receive_data() for _ in range(3)]
+
+    assert all(isinstance(r["id"], int) for r in requests)
+    assert len({r["id"] for r in requests}) == 3
+
+    for request in reversed(requests):
+        server.send_data({"id": request["id"], "result": str(request["n"])})
+
+    results = [f.result(TIMEOUT)["result"] for f in futures]
+    assert results == ["0", "1", "2"]
+
+
+def test_stray_response_is_dropped(rpc_pair):
+    """A response with an unknown id does not disturb other requests."""
+    client, server = rpc_pair
+    future = client.send_request({"method": "run"})
+    request = server.receive_data()
+
+    server.send_data({"id": -1, "result": "stray"})
+    server.send_data({"id": request["id"], "result": "expected"})
+
+    assert future.result(TIMEOUT)["result"] == "expected"
+    assert client.pending_count() == 0
+
+
+def test_pending_requests_fail_when_stream_closes(rpc_pair):
+    """Requests in flight fail instead of blocking forever when the peer exits."""
+    client, server = rpc_pair
+    future = client.send_request({"method": "run"})
+    server.receive_data()
+    server.close()
+
+    with pytest.raises(lsp_jsonrpc.StreamClosedException):
+        future.result(TIMEOUT)
+
+    with pytest.raises(lsp_jsonrpc.StreamClosedException):
+        client.send_request({"method": "run"})
+
+
+def test_concurrent_senders(rpc_pair):
+    """Many threads can submit requests on one connection at the same time."""
+    client, server = rpc_pair
+
+    def _echo():
+        while True:
+            try:
+                request = server.receive_data()
+            except Exception:  # pylint: disable=broad-except
+                return
+            server.send_data({"id": request["id"], "result": request["value"]})
+
+    echo_thread = threading.Thread(target=_echo, daemon=True)
+    echo_thread.start()
+
+    results = {}
+
+    def _submit(value):
+        results[value] = client.send_request({"method": "run", "value": value})
+
+    threads = [threading.Thread(target=_submit, args=(str(i),)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for value, future in results.items():
+        assert future.result(TIMEOUT)["result"] == value
+
+
+@pytest.mark.parametrize("size", [0, 10, 100 * 1024, 5 * 1024 * 1024])
+def test_framing_round_trip(size, rpc_pair):
+    """Messages of any size, including non-ASCII text, survive the byte-level framing."""
+    client, server = rpc_pair
+    source = ("xé中\n" * size)[:size]
+
+    def _send():
+        for i in range(3):
+            client.send_data({"id": i, "source": source})
+
+    sender = threading.Thread(target=_send, daemon=True)
+    sender.start()
+    try:
+        for i in range(3):
+            data = server.receive_data()
+            assert data["id"] == i
+            assert data["source"] == source
+    finally:
+        sender.join(TIMEOUT)
+
+
+@pytest.mark.parametrize("codec", sorted(lsp_jsonrpc.CODECS))
+def test_codec_round_trip(codec, rpc_pair):
+    """Every available codec carries the runner message shapes unchanged."""
+    client, server = rpc_pair
+    client.set_codec(lsp_jsonrpc.CODECS[codec])
+    server.set_codec(lsp_jsonrpc.CODECS[codec])
+    future = client.send_request(
+        {"method": "run", "argv": ["tool", "-x"], "source": "print('é')\n"}
+    )
+    request = server.receive_data()
+    assert request["argv"] == ["tool", "-x"]
+    assert request["source"] == "print('é')\n"
+
+    server.send_data({"id": request["id"], "result": "out", "exception": False})
+    assert future.result(TIMEOUT)["result"] == "out"
+
+
+def test_select_codec_falls_back_to_json():
+    """Unknown codec names fall back to stdlib json."""
+    assert lsp_jsonrpc.select_codec(["not-a-codec"]) is lsp_jsonrpc.JSON_CODEC
+    assert lsp_jsonrpc.select_codec(["json"]) is lsp_jsonrpc.JSON_CODEC
+
+
+def test_runner_negotiates_codec(tmp_path):
+    """The runner agrees on the fastest shared codec and keeps working after switching."""
+    rpc = lsp_runner_client.get_or_start_json_rpc(
+        os.fspath(tmp_path), [sys.executable], os.fspath(tmp_path)
+    )
+    assert rpc is not None
+    result = lsp_runner_client.run_over_json_rpc(
+        workspace=os.fspath(tmp_path),
+        interpreter=[sys.executable],
+        module="json.tool",
+        argv=["json.tool"],
+        use_stdin=True,
+        cwd=os.fspath(tmp_path),
+        source='{"a": "é"}',
+    )
+    try:
+        assert result.stdout.strip() == '{\n    "a": "\\u00e9"\n}'
+        assert rpc._writer._codec is lsp_jsonrpc.select_codec(list(lsp_jsonrpc.CODECS))
+    finally:
+        lsp_runner_client.shutdown_json_rpc()
+
+
+def test_runner_pool_grows_under_load(tmp_path, monkeypatch):
+    """Concurrent requests are spread over up to RUNNER_POOL_SIZE runners."""
+    monkeypatch.setattr(lsp_process_manager, "RUNNER_POOL_SIZE", 2)
+    workspace = os.fspath(tmp_path)
+    argv = ["timeit", "-n", "1", "-r", "1", "-s", "import time", "time.sleep(0.5)"]
+    try:
+        futures = [
+            lsp_runner_client.submit_over_json_rpc(
+                workspace, [sys.executable], "timeit", argv, False, workspace
+            )
+            for _ in range(4)
+        ]
+        for future in futures:
+            assert not future.result(TIMEOUT).stderr
+
+        key = lsp_process_manager.get_runner_key([sys.executable])
+        runners = lsp_process_manager.PROCESS_MANAGER.get_runners(key)
+        assert len({r.peer["pid"] for r in runners}) == 2
+    finally:
+        lsp_runner_client.shutdown_json_rpc()
+
+
+def test_runner_selection_is_sticky_unless_busy(monkeypatch):
+    """Documents go back to their runner, unless it is busy and another is idle."""
+    monkeypatch.setattr(lsp_process_manager, "RUNNER_POOL_SIZE", 2)
+    manager = lsp_process_manager.ProcessManager()
+    key = ("workspace", "python")
+    first, second = [
+        lsp_process_manager.Runner(key, rpc=types.SimpleNamespace(closed=False))
+        for _ in range(2)
+    ]
+    manager._runners[key] = [first, second]
+
+    def _acquire(uri):
+        return manager.acquire_runner(key, [], "", uri)
+
+    assert _acquire("a") is first
+    assert _acquire("b") is second
+    manager.release_runner(first)
+    manager.release_runner(second)
+
+    assert _acquire("b") is second
+    assert _acquire("b") is first
+    assert _acquire("a") is first
+
+
+def test_workspaces_share_runners(tmp_path):
+    """Workspaces on the same interpreter use the same runner process."""
+    first = tmp_path / "first"
+    second = tmp_path / "second"
+    first.mkdir()
+    second.mkdir()
+    try:
+        for workspace in (first, second):
+            result = lsp_runner_client.run_over_json_rpc(
+                workspace=os.fspath(workspace),
+                interpreter=[sys.executable],
+                module="json.tool",
+                argv=["json.tool"],
+                use_stdin=True,
+                cwd=os.fspath(workspace),
+                source="[]",
+            )
+            assert result.stdout == "[]\n"
+
+        key = lsp_process_manager.get_runner_key([sys.executable])
+        assert len(lsp_process_manager.PROCESS_MANAGER.get_runners(key)) == 1
+    finally:
+        lsp_runner_client.shutdown_json_rpc()
+
+
+def test_runner_key_keeps_virtual_environments_apart(tmp_path):
+    """A venv python linking to the base interpreter gets its own runners."""
+    if not hasattr(os, "symlink"):
+        pytest.skip("Needs symlinks.")
+    venv_python = tmp_path / "bin" / "python"
+    venv_python.parent.mkdir()
+    os.symlink(sys.executable, venv_python)
+
+    key = lsp_process_manager.get_runner_key([os.fspath(venv_python)])
+    assert key != lsp_process_manager.get_runner_key([sys.executable])
+    assert key == lsp_process_manager.get_runner_key(
+        [os.fspath(tmp_path / "bin" / ".." / "bin" / "python")]
+    )
+
+
+def test_process_cap_stops_idle_runner_of_other_interpreter(monkeypatch):
+    """At the cap, a new interpreter takes the place of an idle runner."""
+    monkeypatch.setattr(lsp_process_manager, "RUNNER_MAX_PROCESSES", 1)
+    manager = lsp_process_manager.ProcessManager()
+    stopped = []
+    idle = lsp_process_manager.Runner(("a",), rpc=types.SimpleNamespace(closed=False))
+    idle.stop = lambda: stopped.append(idle)
+    manager._runners[("a",)] = [idle]
+
+    started = lsp_process_manager.Runner(
+        ("b",), rpc=types.SimpleNamespace(closed=False)
+    )
+    monkeypatch.setattr(lsp_jsonrpc, "use_socket_transport", lambda: False)
+    monkeypatch.setattr(
+        manager, "start_process", lambda *args: manager._add(started) or started
+    )
+
+    assert manager.acquire_runner(("b",), [], "") is started
+    assert stopped == [idle]
+    assert manager.get_runners(("a",)) == []
+
+
+def test_process_cap_stops_least_recently_used_runner(monkeypatch):
+    """At the cap, the idle runner that was used longest ago is stopped."""
+    monkeypatch.setattr(lsp_process_manager, "RUNNER_MAX_PROCESSES", 2)
+    manager = lsp_process_manager.ProcessManager()
+    stopped = []
+    for key, idle_time in ((("a",), 1.0), (("c",), 2.0)):
+        idle = lsp_process_manager.Runner(key, rpc=types.SimpleNamespace(closed=False))
+        idle.stop = lambda runner=idle: stopped.append(runner)
+        # Recent enough that the idle reaper leaves them alone.
+        idle.last_used = time.monotonic() - idle_time
+        manager._runners[key] = [idle]
+    old = manager._runners[("c",)][0]
+
+    started = lsp_process_manager.Runner(
+        ("b",), rpc=types.SimpleNamespace(closed=False)
+    )
+    monkeypatch.setattr(lsp_jsonrpc, "use_socket_transport", lambda: False)
+    monkeypatch.setattr(
+        manager, "start_process", lambda *args: manager._add(started) or started
+    )
+
+    assert manager.acquire_runner(("b",), [], "") is started
+    assert stopped == [old]
+    assert len(manager.get_runners(("a",))) == 1
+
+
+def test_child_watcher_reports_exits():
+    """Exits of many children are reported without a thread per child."""
+    watcher = lsp_process_manager.ChildWatcher()
+    exited = threading.Semaphore(0)
+    procs = [
+        subprocess.Popen([sys.executable, "-c", "import time; time.sleep(0.2)"])
+        for _ in range(20)
+    ]
+    threads = threading.active_count()
+    for proc in procs:
+        watcher.watch(proc, exited.release)
+    if hasattr(os, "pidfd_open"):
+        assert threading.active_count() <= threads + 1
+
+    for _ in procs:
+        assert exited.acquire(timeout=TIMEOUT)
+    assert all(proc.returncode == 0 for proc in procs)
+
+
+@pytest.mark.parametrize(
+    "old, new",
+    [
+        ("", "abc"),
+        ("abc", ""),
+        ("abc", "abc"),
+        ("line 1\nline 2\n", "line 1\nline 2 changed\n"),
+        ("aaaa", "aaaaa"),
+        ("xé中y", "x中y"),
+    ],
+)
+def test_text_delta_applies(old, new):
+    """A delta computed against the old text reproduces the new text."""
+    delta = lsp_documents.get_text_delta(old, new)
+    assert old[: delta["start"]] + delta["text"] + old[delta["end"] :] == new
+
+
+def test_document_sync_sends_hash_then_delta():
+    """Unchanged documents are sent by hash and edits as deltas the runner can apply."""
+    sync = lsp_documents.DocumentSync()
+    cache = lsp_documents.DocumentCache()
+    source = "import os\n" * 1000
+
+    first = sync.encode("file:///a.py", source)
+    assert first["source"] == source
+    assert cache.resolve(first) == source
+
+    second = sync.encode("file:///a.py", source)
+    assert "source" not in second and "delta" not in second
+    assert cache.resolve(second) == source
+
+    edited = source + "x = 1\n"
+    third = sync.encode("file:///a.py", edited)
+    assert "source" not in third
+    assert third["delta"]["text"] == "x = 1\n"
+    assert cache.resolve(third) == edited
+
+
+def test_document_cache_miss():
+    """A runner that lost the base contents reports a miss instead of guessing."""
+    sync = lsp_documents.DocumentSync()
+    sync.encode("file:///a.py", "a = 1\n")
+    message = sync.encode("file:///a.py", "a = 2\n")
+
+    with pytest.raises(lsp_documents.DocumentCacheMiss):
+        lsp_documents.DocumentCache().resolve(message)
+
+
+def test_runner_recovers_from_cache_miss(tmp_path):
+    """The full source is resent when the runner does not know the document."""
+    workspace = os.fspath(tmp_path)
+    kwargs = {
+        "workspace": workspace,
+        "interpreter": [sys.executable],
+        "module": "json.tool",
+        "argv": ["json.tool"],
+        "use_stdin": True,
+        "cwd": workspace,
+        "uri": "file:///doc.json",
+    }
+    try:
+        first = lsp_runner_client.run_over_json_rpc(source='{"a": 1}', **kwargs)
+        # Make the server believe the runners hold contents they never received.
+        key = lsp_process_manager.get_runner_key([sys.executable])
+        for runner in lsp_process_manager.PROCESS_MANAGER.get_runners(key):
+            runner.documents.encode("file:///doc.json", '{"a": 3}')
+        second = lsp_runner_client.run_over_json_rpc(source='{"a": 2}', **kwargs)
+        third = lsp_runner_client.run_over_json_rpc(source='{"a": 2}', **kwargs)
+    finally:
+        lsp_runner_client.shutdown_json_rpc()
+
+    assert first.stdout == '{\n    "a": 1\n}\n'
+    assert second.stdout == '{\n    "a": 2\n}\n'
+    assert third.stdout == '{\n    "a": 2\n}\n'
+
+
+def test_moved_names_are_importable_from_jsonrpc():
+    """The run API and runner classes can still be imported from lsp_jsonrpc."""
+    assert lsp_jsonrpc.run_over_json_rpc is lsp_runner_client.run_over_json_rpc
+    assert lsp_jsonrpc.shutdown_json_rpc is lsp_runner_client.shutdown_json_rpc
+    assert lsp_jsonrpc.ProcessManager is lsp_process_manager.ProcessManager
+    assert lsp_jsonrpc.DocumentSync is lsp_documents.DocumentSync
+    with pytest.raises(AttributeError):
+        getattr(lsp_jsonrpc, "not_a_name")
+
+
+def _own_segments():
+    return {
+        name
+        for name in os.listdir(lsp_jsonrpc.SHARED_MEMORY_DIR)
+        if name.startswith(f"lsp-rpc-{os.getpid()}-")
+    }
+
+
+@pytest.mark.skipif(
+    lsp_jsonrpc.SHARED_MEMORY_DIR is None, reason="Shared memory is not available."
+)
+@pytest.mark.parametrize("codec", sorted(lsp_jsonrpc.CODECS))
+def test_large_messages_use_shared_memory(codec, rpc_pair):
+    """Large bodies go through a shared memory segment that the reader removes."""
+    client, server = rpc_pair
+    client.set_codec(lsp_jsonrpc.CODECS[codec])
+    server.set_codec(lsp_jsonrpc.CODECS[codec])
+    client.enable_shared_memory()
+    source = "é" * lsp_jsonrpc.SHARED_MEMORY_THRESHOLD
+
+    before = _own_segments()
+    sender = threading.Thread(
+        target=client.send_data, args=({"id": 1, "source": source},), daemon=True
+    )
+    sender.start()
+    try:
+        data = server.receive_data()
+        assert data == {"id": 1, "source": source}
+        assert _own_segments() == before
+    finally:
+        sender.join(TIMEOUT)
+
+
+@pytest.mark.skipif(
+    lsp_jsonrpc.SHARED_MEMORY_DIR is None, reason="Shared memory is not available."
+)
+def test_unread_segments_are_removed_on_close(rpc_pair):
+    """Segments the peer never read are removed when the connection closes."""
+    client, server = rpc_pair
+    client.enable_shared_memory()
+    before = _own_segments()
+    # Nothing reads this, the pipe buffer holds the small reference.
+    client.send_data({"id": 1, "source": "x" * lsp_jsonrpc.SHARED_MEMORY_THRESHOLD})
+    assert len(_own_segments() - before) == 1
+    client.close()
+    server.close()
+    assert _own_segments() == before
+
+
+@pytest.mark.skipif(
+    lsp_jsonrpc.SHARED_MEMORY_DIR is None, reason="Shared memory is not available."
+)
+def test_stale_segments_are_removed():
+    """Segments of processes that are gone are swept, others are left alone."""
+    gone = subprocess.run(
+        [sys.executable, "-c", "import os; print(os.getpid())"],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    stale = os.path.join(
+        lsp_jsonrpc.SHARED_MEMORY_DIR, f"lsp-rpc-{gone.stdout.strip()}-1"
+    )
+    live = os.path.join(lsp_jsonrpc.SHARED_MEMORY_DIR, f"lsp-rpc-{os.getpid()}-0")
+    try:
+        for path in (stale, live):
+            with open(path, "wb"):
+                pass
+        lsp_jsonrpc.remove_segments()
+        assert not os.path.exists(stale)
+        assert os.path.exists(live)
+    finally:
+        for path in (stale, live):
+            with contextlib.suppress(OSError):
+                os.unlink(path)
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="Needs Unix sockets.")
+def test_socket_runner_serves_concurrent_connections(tmp_path, monkeypatch):
+    """A socket runner is started once and used over several pooled connections."""
+    socket_path = os.fspath(tmp_path / "runner.sock")
+    monkeypatch.setattr(lsp_jsonrpc, "RUNNER_SOCKET", socket_path)
+    workspace = os.fspath(tmp_path)
+
+    def _run(value):
+        return lsp_runner_client.submit_over_json_rpc(
+            workspace=workspace,
+            interpreter=[sys.executable],
+            module="json.tool",
+            argv=["json.tool"],
+            use_stdin=True,
+            cwd=workspace,
+            source=f'{{"a": {value}}}',
+        )
+
+    futures = [_run(i) for i in range(8)]
+    try:
+        for i, future in enumerate(futures):
+            assert future.result(TIMEOUT).stdout == f'{{\n    "a": {i}\n}}\n'
+
+        # Another client can attach to the same runner on its own.
+        pool = lsp_jsonrpc.ConnectionPool(socket_path)
+        rpc = pool.acquire()
+        response = rpc.send_request(
+            {
+                "method": "run",
+                "module": "json.tool",
+                "argv": ["json.tool"],
+                "useStdin": True,
+                "cwd": workspace,
+                "source": "[]",
+            }
+        ).result(TIMEOUT)
+        assert response["result"] == "[]\n"
+    finally:
+        key = lsp_process_manager.get_runner_key([sys.executable])
+        for runner in lsp_process_manager.PROCESS_MANAGER.get_runners(key):
+            rpc = runner.connection()
+            rpc.send_data({"id": rpc.next_id(), "method": "exit"})
+        lsp_runner_client.shutdown_json_rpc()
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="Needs Unix sockets.")
+def test_runner_sockets_are_private(tmp_path, monkeypatch):
+    """Sockets go in a directory of the user's own, which is refused if others can use it."""
+    monkeypatch.setenv("XDG_RUNTIME_DIR", os.fspath(tmp_path))
+    path = lsp_jsonrpc.get_runner_socket_path([sys.executable])
+    directory = os.path.dirname(path)
+    assert directory == os.fspath(tmp_path / "lsp-runner")
+    assert os.stat(directory).st_mode & 0o777 == 0o700
+
+    os.chmod(directory, 0o755)
+    with pytest.raises(PermissionError):
+        lsp_jsonrpc.get_runner_socket_path([sys.executable])
+
+    left, right = socket.socketpair(socket.AF_UNIX)
+    with left, right:
+        lsp_jsonrpc.check_socket_peer(left)
+
+
+def test_prewarm_starts_runner_and_imports_module(tmp_path):
+    """Prewarming starts a runner that later runs reuse, with the module imported."""
+    workspace = os.fspath(tmp_path)
+    try:
+        status = lsp_runner_client.prewarm_json_rpc(
+            [sys.executable], workspace, ["json.tool", "no_such_module_here"]
+        ).result(TIMEOUT)
+        assert status["startup"] > 0
+        assert "json.tool" in status["imports"]
+        assert "no_such_module_here" in status["error"]
+
+        key = lsp_process_manager.get_runner_key([sys.executable])
+        runners = lsp_process_manager.PROCESS_MANAGER.get_runners(key)
+        assert len(runners) == 1
+        result = lsp_runner_client.run_over_json_rpc(
+            workspace,
+            [sys.executable],
+            "json.tool",
+            ["json.tool"],
+            True,
+            workspace,
+            "[]",
+        )
+        assert result.stdout == "[]\n"
+        assert lsp_process_manager.PROCESS_MANAGER.get_runners(key) == runners
+    finally:
+        lsp_runner_client.shutdown_json_rpc()
+
+
+def test_runner_is_recycled_after_max_requests(tmp_path, monkeypatch):
+    """A runner past its request limit is replaced without dropping requests."""
+    monkeypatch.setattr(lsp_process_manager, "RUNNER_MAX_REQUESTS", 2)
+    workspace = os.fspath(tmp_path)
+    key = lsp_process_manager.get_runner_key([sys.executable])
+
+    def _run():
+        result = lsp_runner_client.run_over_json_rpc(
+            workspace,
+            [sys.executable],
+            "json.tool",
+            ["json.tool"],
+            True,
+            workspace,
+            "[]",
+        )
+        assert result.stdout == "[]\n"
+
+    try:
+        _run()
+        (old,) = lsp_process_manager.PROCESS_MANAGER.get_runners(key)
+        assert old.rss is None or old.rss > 0
+        _run()
+
+        old.proc.wait(TIMEOUT)
+        (new,) = lsp_process_manager.PROCESS_MANAGER.get_runners(key)
+        assert new is not old
+        assert "json.tool" in new.modules
+        _run()
+    finally:
+        lsp_runner_client.shutdown_json_rpc()
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="Needs Unix sockets.")
+def test_recycled_socket_runner_exits(tmp_path, monkeypatch):
+    """A recycled socket runner exits, and its socket is not reused meanwhile."""
+    monkeypatch.setenv("XDG_RUNTIME_DIR", os.fspath(tmp_path))
+    monkeypatch.setattr(lsp_jsonrpc, "use_socket_transport", lambda: True)
+    monkeypatch.setattr(lsp_process_manager, "RUNNER_MAX_REQUESTS", 2)
+    workspace = os.fspath(tmp_path)
+    key = lsp_process_manager.get_runner_key([sys.executable])
+
+    def _run():
+        result = lsp_runner_client.run_over_json_rpc(
+            workspace,
+            [sys.executable],
+            "json.tool",
+            ["json.tool"],
+            True,
+            workspace,
+            "[]",
+        )
+        assert result.stdout == "[]\n"
+
+    try:
+        _run()
+        (old,) = lsp_process_manager.PROCESS_MANAGER.get_runners(key)
+        _run()
+
+        old.proc.wait(TIMEOUT)
+        (new,) = lsp_process_manager.PROCESS_MANAGER.get_runners(key)
+        assert new.peer["pid"] != old.peer["pid"]
+        assert new.socket_index != old.socket_index
+        _run()
+    finally:
+        for runner in lsp_process_manager.PROCESS_MANAGER.get_runners(key):
+            runner.stop(retire=True)
+        lsp_runner_client.shutdown_json_rpc()
+
+
+def test_idle_runner_is_reaped(tmp_path, monkeypatch):
+    """Runners left idle past the timeout exit without counting as failures."""
+    monkeypatch.setattr(lsp_process_manager, "RUNNER_IDLE_TIMEOUT", 0.5)
+    workspace = os.fspath(tmp_path)
+    key = lsp_process_manager.get_runner_key([sys.executable])
+    try:
+        result = lsp_runner_client.run_over_json_rpc(
+            workspace,
+            [sys.executable],
+            "json.tool",
+            ["json.tool"],
+            True,
+            workspace,
+            "[]",
+        )
+        assert result.stdout == "[]\n"
+        (runner,) = lsp_process_manager.PROCESS_MANAGER.get_runners(key)
+
+        assert runner.proc.wait(TIMEOUT) == 0
+        assert lsp_process_manager.PROCESS_MANAGER.get_runners(key) == []
+        lsp_process_manager.PROCESS_MANAGER.check_restart(key)
+    finally:
+        lsp_runner_client.shutdown_json_rpc()
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="Needs os.fork.")
+def test_fork_runner_isolates_runs(tmp_path, monkeypatch):
+    """In fork mode state a run leaves behind is not seen by the next run."""
+    monkeypatch.setattr(lsp_process_manager, "RUNNER_FORK", True)
+    monkeypatch.setenv("PYTHONPATH", os.fspath(tmp_path))
+    # Identical runs would otherwise be answered from the result cache.
+    monkeypatch.setenv("LS_RUNNER_RESULT_CACHE_SIZE", "0")
+    (tmp_path / "leaky.py").write_text(
+        "import sys\n"
+        "sys.leaked = getattr(sys, 'leaked', 0) + 1\n"
+        "print(sys.leaked)\n",
+        encoding="utf-8",
+    )
+    workspace = os.fspath(tmp_path)
+    try:
+        outputs = [
+            lsp_runner_client.run_over_json_rpc(
+                workspace, [sys.executable], "leaky", ["leaky"], False, workspace
+            ).stdout
+            for _ in range(3)
+        ]
+        assert len(set(outputs)) == 1
+
+        key = lsp_process_manager.get_runner_key([sys.executable])
+        (runner,) = lsp_process_manager.PROCESS_MANAGER.get_runners(key)
+        assert "--fork" in runner.args
+    finally:
+        lsp_runner_client.shutdown_json_rpc()
+
+
+def _wait_until(predicate) -> bool:
+    deadline = time.monotonic() + TIMEOUT
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def _is_running(pid: int) -> bool:
+    try:
+        with open(f"/proc/{pid}/stat", encoding="utf-8") as stream:
+            # Exited children not yet reaped by their new parent are zombies.
+            return stream.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="Needs /proc.")
+def test_killing_fork_runner_kills_its_children(tmp_path, monkeypatch):
+    """Killing a runner in fork mode also kills the child running the tool."""
+    monkeypatch.setattr(lsp_process_manager, "RUNNER_FORK", True)
+    monkeypatch.setenv("PYTHONPATH", os.fspath(tmp_path))
+    # Keeps the failure recorded for the killed runner from delaying later tests.
+    monkeypatch.setattr(lsp_process_manager.PROCESS_MANAGER, "_failures", {})
+    pid_file = tmp_path / "child.pid"
+    (tmp_path / "sleepy.py").write_text(
+        "import os, sys, time\n"
+        "if __name__ == '__main__':\n"
+        "    with open(sys.argv[1], 'w') as f:\n"
+        "        f.write(str(os.getpid()))\n"
+        "    time.sleep(60)\n",
+        encoding="utf-8",
+    )
+    workspace = os.fspath(tmp_path)
+    key = lsp_process_manager.get_runner_key([sys.executable])
+    try:
+        future = lsp_runner_client.submit_over_json_rpc(
+            workspace,
+            [sys.executable],
+            "sleepy",
+            ["sleepy", os.fspath(pid_file)],
+            False,
+            workspace,
+        )
+        assert _wait_until(lambda: pid_file.exists() and pid_file.read_text())
+        child = int(pid_file.read_text())
+        (runner,) = lsp_process_manager.PROCESS_MANAGER.get_runners(key)
+        assert child != runner.proc.pid
+
+        lsp_process_manager.PROCESS_MANAGER.kill_runner(runner)
+        assert _wait_until(lambda: not _is_running(child))
+        with pytest.raises(Exception):
+            future.result(TIMEOUT)
+    finally:
+        lsp_runner_client.shutdown_json_rpc()
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="Needs os.fork.")
+def test_runner_workers_execute_runs_concurrently(tmp_path, monkeypatch):
+    """A runner with several workers executes runs at the same time."""
+    monkeypatch.setattr(lsp_process_manager, "RUNNER_POOL_SIZE", 1)
+    monkeypatch.setattr(lsp_process_manager, "RUNNER_FORK", True)
+    monkeypatch.setattr(lsp_process_manager, "RUNNER_WORKERS", 3)
+    workspace = os.fspath(tmp_path)
+    argv = ["timeit", "-n", "1", "-r", "1", "-s", "import time", "time.sleep(1)"]
+    try:
+        # Start the runner first so startup does not count.
+        lsp_runner_client.run_over_json_rpc(
+            workspace,
+            [sys.executable],
+            "json.tool",
+            ["json.tool"],
+            True,
+            workspace,
+            "[]",
+        )
+        start = time.monotonic()
+        futures = [
+            lsp_runner_client.submit_over_json_rpc(
+                workspace, [sys.executable], "timeit", argv, False, workspace
+            )
+            for _ in range(3)
+        ]
+        for future in futures:
+            assert not future.result(TIMEOUT).stderr
+        assert time.monotonic() - start < 2.5
+
+        key = lsp_process_manager.get_runner_key([sys.executable])
+        (runner,) = lsp_process_manager.PROCESS_MANAGER.get_runners(key)
+        assert runner.capacity == 3
+    finally:
+        lsp_runner_client.shutdown_json_rpc()
+
+
+def test_run_many_returns_results_in_order(tmp_path):
+    """A batch runs every job and reports each result with its index."""
+    workspace = os.fspath(tmp_path)
+    key = lsp_process_manager.get_runner_key([sys.executable])
+    jobs = [
+        lsp_runner_client.RunJob(
+            ["json.tool"], True, workspace, f"[{i}]", uri=f"file:///doc{i}.json"
+        )
+        for i in range(3)
+    ]
+    reported = {}
+    try:
+        lsp_runner_client.run_over_json_rpc(
+            workspace,
+            [sys.executable],
+            "json.tool",
+            ["json.tool"],
+            True,
+            workspace,
+            "[]",
+        )
+        (runner,) = lsp_process_manager.PROCESS_MANAGER.get_runners(key)
+        # The server believes the runner has an older version of this document,
+        # so the runner misses its cache and the job is sent again in full.
+        runner.documents.encode(jobs[1].uri, "[]")
+
+        results = lsp_runner_client.run_many_over_json_rpc(
+            workspace,
+            [sys.executable],
+            "json.tool",
+            jobs,
+            on_result=lambda i, r: reported.setdefault(i, r.stdout),
+        )
+        expected = [f"[\n    {i}\n]\n" for i in range(3)]
+        assert [r.stdout for r in results] == expected
+        assert [reported[i] for i in range(3)] == expected
+        assert lsp_process_manager.PROCESS_MANAGER.get_runners(key) == [runner]
+    finally:
+        lsp_runner_client.shutdown_json_rpc()
+
+
+def test_runner_reuses_result_of_identical_run(tmp_path):
+    """Identical runs are answered from the cache until an input changes."""
+    workspace = os.fspath(tmp_path)
+    config = tmp_path / "pyproject.toml"
+    config.write_text("", encoding="utf-8")
+    key = lsp_process_manager.get_runner_key([sys.executable])
+
+    def _run(source):
+        return lsp_runner_client.run_over_json_rpc(
+            workspace,
+            [sys.executable],
+            "json.tool",
+            ["json.tool"],
+            True,
+            workspace,
+            source,
+        )
+
+    try:
+        assert not _run("[1]").cached
+        result = _run("[1]")
+        assert result.cached
+        assert result.stdout == "[\n    1\n]\n"
+        assert not _run("[2]").cached
+
+        config.write_text("[tool]\n", encoding="utf-8")
+        assert not _run("[1]").cached
+
+        (runner,) = lsp_process_manager.PROCESS_MANAGER.get_runners(key)
+        assert runner.result_cache["hits"] == 1
+        assert runner.result_cache["misses"] == 3
+    finally:
+        lsp_runner_client.shutdown_json_rpc()
+
+
+def test_run_on_directory_is_not_cached(tmp_path, monkeypatch):
+    """Edits to files inside a linted directory give fresh output."""
+    monkeypatch.setenv("PYTHONPATH", os.fspath(tmp_path))
+    (tmp_path / "catdir.py").write_text(
+        "import os, sys\n"
+        "for name in sorted(os.listdir(sys.argv[1])):\n"
+        "    with open(os.path.join(sys.argv[1], name)) as f:\n"
+        "        print(f.read().strip())\n",
+        encoding="utf-8",
+    )
+    linted = tmp_path / "linted"
+    linted.mkdir()
+    (linted / "a.py").write_text("one", encoding="utf-8")
+    workspace = os.fspath(tmp_path)
+
+    def _run():
+        return lsp_runner_client.run_over_json_rpc(
+            workspace,
+            [sys.executable],
+            "catdir",
+            ["catdir", "linted"],
+            True,
+            workspace,
+            "x",
+        )
+
+    try:
+        assert _run().stdout == "one\n"
+        (linted / "a.py").write_text("two", encoding="utf-8")
+        result = _run()
+        assert not result.cached
+        assert result.stdout == "two\n"
+    finally:
+        lsp_runner_client.shutdown_json_rpc()
+
+
+def test_result_cache_notices_edits_to_uninstalled_tool(tmp_path, monkeypatch):
+    """A tool that is not installed is versioned by its module file."""
+    monkeypatch.setenv("PYTHONPATH", os.fspath(tmp_path))
+    tool = tmp_path / "edited.py"
+    tool.write_text("print('one')\n", encoding="utf-8")
+    workspace = os.fspath(tmp_path)
+
+    def _run():
+        return lsp_runner_client.run_over_json_rpc(
+            workspace, [sys.executable], "edited", ["edited"], True, workspace, "x"
+        )
+
+    try:
+        assert _run().stdout == "one\n"
+        assert _run().cached
+
+        tool.write_text("print('three')\n", encoding="utf-8")
+        result = _run()
+        assert not result.cached
+        assert result.stdout == "three\n"
+    finally:
+        lsp_runner_client.shutdown_json_rpc()
+
+
+def test_run_without_change_dir_keeps_runner_cwd(tmp_path, monkeypatch):
+    """The server tells the runner whether to change its working directory."""
+    monkeypatch.setattr(lsp_process_manager, "RUNNER_POOL_SIZE", 1)
+    monkeypatch.setenv("PYTHONPATH", os.fspath(tmp_path))
+    monkeypatch.setenv("LS_RUNNER_RESULT_CACHE_SIZE", "0")
+    (tmp_path / "printcwd.py").write_text(
+        "import os\nprint(os.getcwd())\n", encoding="utf-8"
+    )
+    started_in = tmp_path / "a"
+    run_in = tmp_path / "b"
+    started_in.mkdir()
+    run_in.mkdir()
+
+    def _run(cwd, change_dir):
+        return lsp_runner_client.run_over_json_rpc(
+            os.fspath(tmp_path),
+            [sys.executable],
+            "printcwd",
+            ["printcwd"],
+            False,
+            os.fspath(cwd),
+            change_dir=change_dir,
+        ).stdout.strip()
+
+    try:
+        assert _run(started_in, True) == os.fspath(started_in)
+        assert _run(run_in, True) == os.fspath(run_in)
+        assert _run(run_in, False) == os.fspath(started_in)
+    finally:
+        lsp_runner_client.shutdown_json_rpc()
+
+
+def test_run_result_reports_timing(tmp_path, monkeypatch):
+    """Responses break down where the time of a run went."""
+    monkeypatch.setenv("LS_RUNNER_RESULT_CACHE_SIZE", "0")
+    workspace = os.fspath(tmp_path)
+    key = lsp_process_manager.get_runner_key([sys.executable])
+
+    def _run():
+        return lsp_runner_client.run_over_json_rpc(
+            workspace,
+            [sys.executable],
+            "json.tool",
+            ["json.tool"],
+            True,
+            workspace,
+            "[]",
+        )
+
+    try:
+        first, second = _run(), _run()
+        (runner,) = lsp_process_manager.PROCESS_MANAGER.get_runners(key)
+        for phase in ("queued", "resolve", "setup", "import", "run", "total"):
+            assert second.timing[phase] >= 0
+        assert second.timing["pid"] == runner.peer["pid"]
+        assert second.timing["seq"] == first.timing["seq"] + 1
+        assert second.timing["roundTrip"] >= second.timing["total"]
+    finally:
+        lsp_runner_client.shutdown_json_rpc()
@@ -0,0 +1,158 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+"""Unit tests for unloading what a tool imports during an in-process run."""
+
+import os
+import sys
+import threading
+import types
+
+import pytest
+
+import lsp_utils
+
+TOOL_SOURCE = """
+import os
+import sys
+
+import iso_dependency
+import iso_kept.sub
+
+os.environ["ISO_TOOL_RAN"] = "1"
+sys.meta_path.append(object())
+print(iso_dependency.VALUE, iso_kept.sub.VALUE)
+"""
+
+
+def _write_modules(tmp_path):
+    (tmp_path / "iso_tool.py").write_text(TOOL_SOURCE, encoding="utf-8")
+    (tmp_path / "iso_dependency.py").write_text("VALUE = 1\n", encoding="utf-8")
+    package = tmp_path / "iso_kept"
+    package.mkdir()
+    (package / "__init__.py").write_text("", encoding="utf-8")
+    (package / "sub.py").write_text("VALUE = 2\n", encoding="utf-8")
+
+
+def _run(tmp_path):
+    return lsp_utils.run_module(
+        module="iso_tool",
+        argv=["iso_tool"],
+        use_stdin=False,
+        cwd=os.fspath(tmp_path),
+    )
+
+
+def test_isolation_unloads_tool_imports(tmp_path, monkeypatch):
+    """Imports and changes of a run are undone, except for modules kept loaded."""
+    _write_modules(tmp_path)
+    monkeypatch.syspath_prepend(os.fspath(tmp_path))
+    monkeypatch.setattr(lsp_utils, "ISOLATE_MODULES", True)
+    monkeypatch.setattr(lsp_utils, "KEEP_MODULES", frozenset(["iso_kept"]))
+    meta_path = sys.meta_path[:]
+    try:
+        for _ in range(2):
+            assert _run(tmp_path).stdout == "1 2\n"
+            assert "iso_tool" not in sys.modules
+            assert "iso_dependency" not in sys.modules
+            assert "iso_kept.sub" in sys.modules
+            assert "ISO_TOOL_RAN" not in os.environ
+            assert sys.meta_path == meta_path
+    finally:
+        for name in ("iso_kept", "iso_kept.sub"):
+            sys.modules.pop(name, None)
+
+
+def test_imports_stay_without_isolation(tmp_path, monkeypatch):
+    """Without isolation, modules a run imports stay loaded."""
+    _write_modules(tmp_path)
+    monkeypatch.syspath_prepend(os.fspath(tmp_path))
+    monkeypatch.setattr(lsp_utils, "ISOLATE_MODULES", False)
+    try:
+        assert _run(tmp_path).stdout == "1 2\n"
+        assert "iso_dependency" in sys.modules
+    finally:
+        sys.meta_path[:] = [m for m in sys.meta_path if type(m) is not object]
+        os.environ.pop("ISO_TOOL_RAN", None)
+        for name in ("iso_dependency", "iso_kept", "iso_kept.sub"):
+            sys.modules.pop(name, None)
+
+
+def test_isolation_unloads_submodules_of_prewarmed_tool(tmp_path, monkeypatch):
+    """Submodules a run imports are unloaded though the tool was preloaded."""
+    package = tmp_path / "faketool"
+    package.mkdir()
+    (package / "__init__.py").write_text("", encoding="utf-8")
+    (package / "heavy.py").write_text("VALUE = 3\n", encoding="utf-8")
+    (package / "__main__.py").write_text(
+        "from faketool import heavy\nprint(heavy.VALUE)\n", encoding="utf-8"
+    )
+    monkeypatch.syspath_prepend(os.fspath(tmp_path))
+    monkeypatch.setattr(lsp_utils, "ISOLATE_MODULES", True)
+    monkeypatch.setattr(lsp_utils, "KEEP_MODULES", frozenset())
+    try:
+        lsp_utils.preload_module("faketool")
+        for _ in range(2):
+            result = lsp_utils.run_module(
+                module="faketool",
+                argv=["faketool"],
+                use_stdin=False,
+                cwd=os.fspath(tmp_path),
+            )
+            assert result.stdout == "3\n"
+            assert "faketool" in sys.modules
+            assert "faketool.heavy" not in sys.modules
+            assert not hasattr(sys.modules["faketool"], "heavy")
+    finally:
+        for name in ("faketool", "faketool.heavy", "faketool.__main__"):
+            sys.modules.pop(name, None)
+
+
+def test_isolation_needs_exclusive_cwd_lock():
+    """Isolation refuses to run unless other runs and imports are held off."""
+    with pytest.raises(RuntimeError):
+        with lsp_utils.isolate_modules():
+            pass
+    with lsp_utils.CWD_LOCK.shared():
+        with pytest.raises(RuntimeError):
+            with lsp_utils.isolate_modules():
+                pass
+
+
+def test_preload_waits_for_isolated_run(tmp_path, monkeypatch):
+    """A module preloaded during an isolated run is imported after it, and stays."""
+    (tmp_path / "iso_waiting.py").write_text(
+        "import iso_gate\niso_gate.started.set()\niso_gate.release.wait(10)\n",
+        encoding="utf-8",
+    )
+    (tmp_path / "iso_other.py").write_text("VALUE = 4\n", encoding="utf-8")
+    monkeypatch.syspath_prepend(os.fspath(tmp_path))
+    monkeypatch.setattr(lsp_utils, "ISOLATE_MODULES", True)
+    gate = types.SimpleNamespace(started=threading.Event(), release=threading.Event())
+    monkeypatch.setitem(sys.modules, "iso_gate", gate)
+
+    run = threading.Thread(
+        target=lsp_utils.run_module,
+        kwargs={
+            "module": "iso_waiting",
+            "argv": ["iso_waiting"],
+            "use_stdin": False,
+            "cwd": os.fspath(tmp_path),
+        },
+    )
+    preload = threading.Thread(target=lsp_utils.preload_module, args=("iso_other",))
+    try:
+        run.start()
+        assert gate.started.wait(10)
+        preload.start()
+        preload.join(0.5)
+        assert preload.is_alive()
+        assert "iso_other" not in sys.modules
+
+        gate.release.set()
+        run.join(10)
+        preload.join(10)
+        assert "iso_waiting" not in sys.modules
+        assert "iso_other" in sys.modules
+    finally:
+        gate.release.set()
+        sys.modules.pop("iso_other", None)
@@ -0,0 +1,66 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+"""Unit tests for streaming tool output line by line."""
+
+import os
+import sys
+
+import lsp_runner_client
+import lsp_utils
+
+
+def test_streaming_io_reports_complete_lines():
+    """Only complete lines are reported while writing, the rest at the end."""
+    chunks = []
+    stream = lsp_utils.StreamingIO("<stdout>", chunks.append)
+
+    stream.write("a:1")
+    assert not chunks
+    stream.write(":x\nb:2")
+    assert chunks == ["a:1:x\n"]
+    print("\nc:3", file=stream)
+    assert "".join(chunks) == "a:1:x\nb:2\nc:3\n"
+    stream.write("tail")
+    stream.end_output()
+
+    assert "".join(chunks) == "a:1:x\nb:2\nc:3\ntail"
+    assert stream.get_value() == "a:1:x\nb:2\nc:3\ntail"
+
+
+def test_run_path_streams_lines(tmp_path):
+    """run_path reports each line before the process exits and returns full output."""
+    lines = []
+    script = "import sys\nfor line in sys.stdin:\n    print(line.upper(), end='')\n"
+    result = lsp_utils.run_path(
+        argv=[sys.executable, "-c", script],
+        use_stdin=True,
+        cwd=os.fspath(tmp_path),
+        source="one\ntwo\n",
+        on_output=lines.append,
+    )
+
+    assert lines == ["ONE\n", "TWO\n"]
+    assert result.stdout == "ONE\nTWO\n"
+
+
+def test_runner_streams_partial_results(tmp_path):
+    """Output streamed from the runner adds up to the complete result."""
+    chunks = []
+    workspace = os.fspath(tmp_path)
+    try:
+        result = lsp_runner_client.run_over_json_rpc(
+            workspace=workspace,
+            interpreter=[sys.executable],
+            module="json.tool",
+            argv=["json.tool"],
+            use_stdin=True,
+            cwd=workspace,
+            source='{"a": 1, "b": 2}',
+            on_output=chunks.append,
+        )
+    finally:
+        lsp_runner_client.shutdown_json_rpc()
+
+    assert chunks
+    assert result.stdout == '{\n    "a": 1,\n    "b": 2\n}\n'
+    assert "".join(chunks) in result.stdout
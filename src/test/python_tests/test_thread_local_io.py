@@ -0,0 +1,110 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+"""Unit tests for running tools in-process on several threads at once."""
+
+import os
+import sys
+import threading
+
+import pytest
+
+import lsp_utils
+
+TIMEOUT = 5  # seconds
+
+
+@pytest.fixture
+def restore_io(monkeypatch):
+    """Puts `sys.argv` and the stdio streams back after the test."""
+    for name in ("argv", "stdin", "stdout", "stderr"):
+        monkeypatch.setattr(sys, name, getattr(sys, name))
+
+
+def test_concurrent_runs_keep_their_own_io(tmp_path, restore_io):
+    """Runs on different threads overlap without mixing their argv or output."""
+    # Installed here, pytest replaces the streams between fixtures and the test.
+    lsp_utils.install_thread_local_io()
+    barrier = threading.Barrier(2, timeout=TIMEOUT)
+
+    def _callback(argv, _stdout, _stderr, _stdin=None):
+        print(sys.argv[0])
+        barrier.wait()
+        print(sys.stdin.read(), file=sys.stderr)
+        barrier.wait()
+        print(argv[0], len(sys.argv))
+
+    results = {}
+
+    def _run(name):
+        results[name] = lsp_utils.run_api(
+            callback=_callback,
+            argv=[name],
+            use_stdin=True,
+            cwd=os.fspath(tmp_path),
+            source=f"{name} source",
+            change_dir=False,
+        )
+
+    threads = [threading.Thread(target=_run, args=(name,)) for name in "ab"]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(TIMEOUT)
+
+    for name in "ab":
+        assert results[name].stdout == f"{name}\n{name} 1\n"
+        assert results[name].stderr == f"{name} source\n"
+    assert isinstance(sys.stdout, lsp_utils.ThreadLocalIO)
+    assert isinstance(sys.argv, lsp_utils.ThreadLocalArgv)
+
+
+def test_replaced_stream_is_restored(tmp_path, restore_io):
+    """A tool replacing a stream or argv only affects its own run."""
+    lsp_utils.install_thread_local_io()
+    stdout = sys.stdout
+    argv = sys.argv[:]
+
+    def _callback(_argv, _stdout, _stderr, _stdin=None):
+        sys.stdout = sys.stderr
+        sys.argv = ["replaced"]
+
+    lsp_utils.run_api(
+        callback=_callback,
+        argv=["tool"],
+        use_stdin=False,
+        cwd=os.fspath(tmp_path),
+        change_dir=False,
+    )
+    assert sys.stdout is stdout
+    assert sys.argv == argv
+
+
+def test_threads_outside_runs_print_to_stderr(capsys, restore_io):
+    """Output of threads that are not in a run stays off stdout."""
+    lsp_utils.install_thread_local_io()
+    thread = threading.Thread(target=print, args=("from a thread",))
+    thread.start()
+    thread.join(TIMEOUT)
+
+    captured = capsys.readouterr()
+    assert captured.out == ""
+    assert captured.err == "from a thread\n"
+
+
+def test_overlapping_runs_restore_sys_path(monkeypatch):
+    """The path from before overlapping runs is back once the last one ends."""
+    monkeypatch.setattr(sys, "path", sys.path[:])
+    original = sys.path
+    first = lsp_utils.preserve_sys_path()
+    second = lsp_utils.preserve_sys_path()
+
+    first.__enter__()
+    sys.path.append("first")
+    second.__enter__()
+    sys.path.append("second")
+    first.__exit__(None, None, None)
+    assert sys.path[-2:] == ["first", "second"]
+    second.__exit__(None, None, None)
+
+    assert sys.path is original
+    assert "first" not in sys.path and "second" not in sys.path
@@ -0,0 +1,166 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+"""Unit tests for run deadlines and runner restarts."""
+
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+import lsp_process_manager
+import lsp_runner_client
+import lsp_utils
+
+TIMEOUT = 10  # 10 seconds
+
+
+def test_run_path_timeout_kills_process(tmp_path):
+    """A process still running at the deadline is killed."""
+    start = time.monotonic()
+    with pytest.raises(lsp_utils.RunTimeoutError):
+        lsp_utils.run_path(
+            argv=[sys.executable, "-c", "import time; time.sleep(60)"],
+            use_stdin=False,
+            cwd=os.fspath(tmp_path),
+            timeout=0.5,
+        )
+    assert time.monotonic() - start < TIMEOUT
+
+
+def test_run_api_timeout_reports_stacks(tmp_path):
+    """An in-process run is abandoned at a safe point after its deadline."""
+
+    def _callback(_argv, stdout, _stderr, _stdin=None):
+        while True:
+            stdout.write("line\n")
+            time.sleep(0.05)
+
+    with pytest.raises(lsp_utils.RunTimeoutError) as info:
+        lsp_utils.run_api(
+            callback=_callback,
+            argv=[],
+            use_stdin=False,
+            cwd=os.fspath(tmp_path),
+            on_output=lambda _chunk: None,
+            timeout=0.5,
+        )
+    assert "_callback" in info.value.traceback
+
+
+def test_hung_tool_does_not_stall_later_runs(tmp_path):
+    """Runs time out while a hung run holds the working directory."""
+    release = threading.Event()
+
+    def _hang(*_args):
+        release.wait()
+
+    def _run(callback):
+        lsp_utils.run_api(
+            callback=callback,
+            argv=[],
+            use_stdin=False,
+            cwd=os.fspath(tmp_path),
+            timeout=0.5,
+        )
+
+    try:
+        start = time.monotonic()
+        with pytest.raises(lsp_utils.RunTimeoutError):
+            _run(_hang)
+        # The hung run still holds the lock, this one times out waiting for it.
+        with pytest.raises(lsp_utils.RunTimeoutError):
+            _run(lambda *_args: None)
+        assert time.monotonic() - start < TIMEOUT
+    finally:
+        release.set()
+
+
+def test_hung_runner_is_killed_and_restarted(tmp_path, monkeypatch, slow_argv):
+    """A runner that misses the deadline is replaced, after a backoff."""
+    workspace = os.fspath(tmp_path)
+    kwargs = {
+        "workspace": workspace,
+        "interpreter": [sys.executable],
+        "use_stdin": True,
+        "cwd": workspace,
+    }
+    try:
+        with pytest.raises(lsp_utils.RunTimeoutError) as info:
+            lsp_runner_client.run_over_json_rpc(
+                module="timeit", argv=slow_argv, timeout=1, **kwargs
+            )
+        if hasattr(lsp_process_manager.signal, "SIGUSR1"):
+            assert "timeit.py" in info.value.traceback
+
+        with pytest.raises(lsp_process_manager.RunnerUnavailableError):
+            lsp_runner_client.run_over_json_rpc(
+                module="json.tool", argv=["json.tool"], source="[]", **kwargs
+            )
+
+        monkeypatch.setattr(lsp_process_manager, "RESTART_BACKOFF", 0)
+        result = lsp_runner_client.run_over_json_rpc(
+            module="json.tool", argv=["json.tool"], source="[]", **kwargs
+        )
+        assert result.stdout == "[]\n"
+    finally:
+        lsp_runner_client.shutdown_json_rpc()
+
+
+def test_hung_batch_times_out_per_job(tmp_path, monkeypatch, slow_argv):
+    """A batch is given up on once a job runs too long, however many jobs it has."""
+    monkeypatch.setattr(lsp_process_manager.PROCESS_MANAGER, "_failures", {})
+    workspace = os.fspath(tmp_path)
+    fast = ["timeit", "-n", "1", "-r", "1", "-s", "import time", "time.sleep(0.4)"]
+    jobs = [lsp_runner_client.RunJob(fast, False, workspace) for _ in range(3)]
+    jobs += [lsp_runner_client.RunJob(slow_argv, False, workspace) for _ in range(50)]
+    try:
+        start = time.monotonic()
+        with pytest.raises(lsp_utils.RunTimeoutError):
+            lsp_runner_client.run_many_over_json_rpc(
+                workspace, [sys.executable], "timeit", jobs, timeout=1
+            )
+        # The three fast jobs together took longer than the timeout.
+        assert 1.2 < time.monotonic() - start < TIMEOUT
+    finally:
+        lsp_runner_client.shutdown_json_rpc()
+
+
+def test_crash_loop_stops_restarts(monkeypatch):
+    """Too many recent failures stop restarts regardless of the backoff."""
+    manager = lsp_process_manager.ProcessManager()
+    monkeypatch.setattr(lsp_process_manager, "RESTART_BACKOFF", 0)
+    for _ in range(lsp_process_manager.CRASH_LOOP_LIMIT - 1):
+        manager._record_failure(("w",))
+    manager.check_restart(("w",))
+
+    manager._record_failure(("w",))
+    with pytest.raises(
+        lsp_process_manager.RunnerUnavailableError, match="not restarting"
+    ):
+        manager.check_restart(("w",))
+
+
+def test_shutdown_stops_busy_runners_within_deadline(tmp_path, monkeypatch, slow_argv):
+    """Runners stuck in a run are terminated once the shutdown deadline passes."""
+    monkeypatch.setattr(lsp_process_manager, "RUNNER_POOL_SIZE", 3)
+    monkeypatch.setattr(lsp_process_manager, "SHUTDOWN_TIMEOUT", 0.5)
+    # Runners killed by earlier tests would delay starting new ones.
+    monkeypatch.setattr(lsp_process_manager.PROCESS_MANAGER, "_failures", {})
+    workspace = os.fspath(tmp_path)
+    try:
+        for _ in range(3):
+            lsp_runner_client.submit_over_json_rpc(
+                workspace, [sys.executable], "timeit", slow_argv, False, workspace
+            )
+        key = lsp_process_manager.get_runner_key([sys.executable])
+        procs = [r.proc for r in lsp_process_manager.PROCESS_MANAGER.get_runners(key)]
+        assert len(procs) == 3
+    finally:
+        start = time.monotonic()
+        lsp_runner_client.shutdown_json_rpc()
+        elapsed = time.monotonic() - start
+
+    assert all(proc.poll() is not None for proc in procs)
+    assert elapsed < 0.5 + 2 * lsp_process_manager.TERMINATE_TIMEOUT